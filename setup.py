@@ -8,11 +8,13 @@ classifiers = [
     'License :: OSI Approved :: BSD License',
     'Operating System :: OS Independent',
     'Programming Language :: Python',
+    'Programming Language :: Python :: 2.7',
     'Topic :: Utilities',
     'Topic :: Communications :: Email',
 ]
 
 # Depends: 
+# python 2.7 (collections.OrderedDict, gzip mtime)
 # django
 setup(
     name = "django-xslt",
@@ -25,7 +27,12 @@ setup(
     url = "http://github.com/woome/django-xslt",
     download_url="http://github.com/woome/django-xslt/downloads",
     platforms = ["unix"],
-    packages = ["djangoxslt", "djangoxslt.xslt"],
+    packages = [
+        "djangoxslt",
+        "djangoxslt.xslt",
+        "djangoxslt.xslt.management",
+        "djangoxslt.xslt.management.commands",
+        ],
     package_dir = {"":"src"},
 # Not sure we need a script, it would be nice to ship a django command line xsltproc?
 #    scripts=['src/md'],   
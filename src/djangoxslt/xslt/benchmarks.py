@@ -0,0 +1,616 @@
+# Benchmarks
+from __future__ import with_statement
+
+"""Microbenchmarks for the engine and managers hot paths.
+
+Each benchmark is a setup function registered with the 'benchmark'
+decorator. The setup function is called once and returns the callable
+which is timed, or a tuple of the callable and a dict of extra values
+to record alongside the timings:
+
+  @benchmark("contextfunc_call")
+  def bench_contextfunc_call():
+      func = DjangoContextFunc("benchvalue")
+      return lambda: func(None)
+
+A benchmark can be parametrized by putting a %s in the name and
+passing 'params', either a tuple of values or the name of a run
+option (like "rows") holding the values. The setup function is then
+called once per value. A setup function can return None to skip the
+benchmark.
+
+The benchmarks that need model rows use the XSLTTestModel table so
+the suite must run against a (test) database. The xsltbench management
+command creates an in-memory SQLite one for the run:
+
+  python manage.py xsltbench --output=bench.json
+  python manage.py xsltbench --compare=bench.json
+
+Results are plain dicts; 'save' writes them as JSON and 'compare'
+checks them against a previously saved baseline.
+"""
+
+from django.conf import settings
+from django.template import Context
+from django.utils import simplejson as json
+
+from lxml import etree
+from datetime import datetime
+from contextlib import contextmanager
+import platform
+import time
+import os
+import gc
+
+from engine import Transformer
+from engine import TransformerFile
+from engine import DjangoContextFunc
+from engine import djangothread
+import managers
+import loader
+import prefetch
+from pipeline import Pipeline
+import bulk
+import bundle
+
+# How long a single timing sample should take at least, in seconds.
+MIN_TIME = 0.2
+# The number of samples taken for each benchmark.
+REPEAT = 5
+# The model row counts used by the row based benchmarks.
+ROW_COUNTS = (100, 10000, 100000)
+# The number of xdjango: calls used by the call based benchmarks.
+CALL_COUNTS = (10, 100)
+
+STYLESHEET = """<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0"
+                xmlns="http://www.w3.org/1999/xhtml"
+                xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+                xmlns:xdjango="http://djangoproject.com/template/xslt"
+                extension-element-prefixes="xdjango"
+                exclude-result-prefixes="xdjango">
+    <xsl:output omit-xml-declaration="yes"/>
+    <xsl:template match="/">
+%s
+    </xsl:template>
+%s
+</xsl:stylesheet>
+"""
+
+def stylesheet(body, templates=""):
+    """Wrap 'body' in the root template of a benchmark stylesheet."""
+    return STYLESHEET % (body, templates)
+
+
+# Registry
+
+BENCHMARKS = []
+
+def benchmark(name, params=None):
+    """Register the decorated setup function as benchmark 'name'."""
+    def register(setup):
+        BENCHMARKS.append((name, params, setup))
+        return setup
+    return register
+
+
+# Timing
+
+def _sample(fn, number):
+    gc.collect()
+    gcenabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.time()
+        for i in xrange(number):
+            fn()
+        return time.time() - start
+    finally:
+        if gcenabled:
+            gc.enable()
+
+def measure(fn, repeat=REPEAT, min_time=MIN_TIME):
+    """Time 'fn' and return a dict of per call timings in seconds.
+
+    The number of calls per sample is raised by powers of 10 until a
+    sample takes at least 'min_time'; 'repeat' samples are then taken.
+    """
+    number = 1
+    while _sample(fn, number) < min_time and number < 1000000:
+        number *= 10
+    times = sorted(_sample(fn, number) / number for i in range(repeat))
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min": times[0],
+        "median": times[len(times) // 2],
+        "mean": sum(times) / len(times),
+        }
+
+
+# Fixtures
+
+def ensure_rows(count):
+    """Make sure there are at least 'count' XSLTTestModel rows."""
+    from django.db import connection
+    from django.db import transaction
+    from models import XSLTTestModel
+
+    existing = XSLTTestModel.objects.count()
+    if existing >= count:
+        return
+    table = connection.ops.quote_name(XSLTTestModel._meta.db_table)
+    cursor = connection.cursor()
+    cursor.executemany(
+        "INSERT INTO %s (name, about, count) VALUES (%%s, %%s, %%s)" % table,
+        [("name%d" % i, "about %d" % i, i) for i in xrange(existing, count)]
+        )
+    transaction.commit_unless_managed()
+
+def rows_qs(count):
+    from models import XSLTTestModel
+    ensure_rows(count)
+    return XSLTTestModel.objects.order_by("id")[:count]
+
+class Row(object):
+    def __init__(self, name):
+        self.name = name
+
+
+# Engine benchmarks
+
+def _calls_stylesheet(count):
+    return stylesheet("\n".join(
+            """<p><xsl:value-of select="xdjango:benchvalue%d()"/></p>""" % i
+            for i in range(count)))
+
+@benchmark("compile_%s_calls", params="calls")
+def bench_compile(count):
+    tmpl = _calls_stylesheet(count)
+    return lambda: Transformer(tmpl)
+
+@benchmark("transform_%s_calls", params="calls")
+def bench_transform(count):
+    t = Transformer(_calls_stylesheet(count))
+    c = Context(dict(("benchvalue%d" % i, "value %d" % i) for i in range(count)))
+    return lambda: t(context=c)
+
+PAGE_CALLS = 100
+
+def _page():
+    t = Transformer(stylesheet(
+            "\n".join("""<p><xsl:value-of select="xdjango:benchvalue%d()"/></p>""" % i
+                      for i in range(PAGE_CALLS))
+            + """<xsl:call-template name="panel"/>""",
+            """<xsl:template name="panel">
+                 <div><xsl:value-of select="xdjango:benchvalue0()"/></div>
+               </xsl:template>"""))
+    c = Context(dict(("benchvalue%d" % i, "value %d" % i) for i in range(PAGE_CALLS)))
+    return t, c
+
+@benchmark("page_full")
+def bench_page_full():
+    """A 100 call page with a one call panel template."""
+    t, c = _page()
+    return lambda: t(context=c)
+
+@benchmark("page_fragment")
+def bench_page_fragment():
+    t, c = _page()
+    return lambda: t.fragment("panel")(context=c)
+
+PIPELINE_ITEMS = 1000
+
+def _pipeline_stages():
+    content = Transformer(stylesheet(
+            """<content><xsl:for-each select="xdjango:benchitems('parse')//item">
+                 <section><p><xsl:value-of select="position()"/></p></section>
+               </xsl:for-each></content>""").replace('xmlns="http://www.w3.org/1999/xhtml"', ""))
+    layout = Transformer(stylesheet(
+            """<html><body><xsl:copy-of select="/content/section"/></body></html>"""))
+    c = Context({"benchitems": "<items>%s</items>" % ("<item/>" * PIPELINE_ITEMS)})
+    return content, layout, c
+
+@benchmark("pipeline_strings")
+def bench_pipeline_strings():
+    """Two stages, a 1000 section document between them."""
+    content, layout, c = _pipeline_stages()
+    return lambda: layout(content(context=c), context=c)
+
+@benchmark("pipeline_trees")
+def bench_pipeline_trees():
+    content, layout, c = _pipeline_stages()
+    pipeline = Pipeline(content, layout)
+    return lambda: pipeline(context=c)
+
+@contextmanager
+def _settings(**values):
+    """Set the settings 'values' for the with block."""
+    missing = object()
+    saved = dict((name, getattr(settings, name, missing)) for name in values)
+    for name, value in values.iteritems():
+        setattr(settings, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.iteritems():
+            if value is missing:
+                delattr(settings, name)
+            else:
+                setattr(settings, name, value)
+
+MENU = "<menu>%s</menu>" % "".join(
+    '<entry href="/page%d/" title="Page %d"><label>Page %d</label></entry>' % (i, i, i)
+    for i in range(200))
+
+def _menu_transform():
+    return Transformer(stylesheet(
+            """<ul><xsl:for-each select="/menu/entry[position() &lt; 10]">
+                 <li><a href="{@href}"><xsl:value-of select="label"/></a></li>
+               </xsl:for-each></ul>"""))
+
+@benchmark("input_string")
+def bench_input_string():
+    """A transform of a 200 entry menu string."""
+    t = _menu_transform()
+    return lambda: t(MENU)
+
+@benchmark("input_string_cached")
+def bench_input_string_cached():
+    """input_string with settings.XSLT_INPUT_CACHE_SIZE set."""
+    t = _menu_transform()
+    def cached():
+        with _settings(XSLT_INPUT_CACHE_SIZE=16, XSLT_INPUT_CACHE_VALIDATE=False):
+            return t(MENU)
+    return cached
+
+BULK_CONTEXTS = 1000
+
+def _bulk_setup():
+    t = Transformer(_calls_stylesheet(10))
+    contexts = [
+        Context(dict(("benchvalue%d" % i, "value %d %d" % (i, n)) for i in range(10)))
+        for n in range(BULK_CONTEXTS)]
+    return t, contexts
+
+@benchmark("bulk_calls")
+def bench_bulk_calls():
+    """Rendering a batch of contexts one __call__ at a time."""
+    t, contexts = _bulk_setup()
+    def calls():
+        for c in contexts:
+            t(context=c)
+    return calls
+
+@benchmark("bulk_render_many")
+def bench_bulk_render_many():
+    t, contexts = _bulk_setup()
+    def render():
+        for output in bulk.render_many(t, contexts):
+            pass
+    return render
+
+@benchmark("bulk_render_many_4_workers")
+def bench_bulk_render_many_workers():
+    t, contexts = _bulk_setup()
+    def render():
+        for output in bulk.render_many(t, contexts, workers=4):
+            pass
+    return render
+
+@benchmark("contextfunc_call")
+def bench_contextfunc_call():
+    func = DjangoContextFunc("benchvalue")
+    djangothread.context = Context({"benchvalue": "a value"})
+    return lambda: func(None)
+
+@benchmark("contextfunc_call_dotted")
+def bench_contextfunc_call_dotted():
+    func = DjangoContextFunc("benchvalue.name")
+    djangothread.context = Context({"benchvalue": Row("a value")})
+    return lambda: func(None)
+
+PARSE_DOC = "<div>%s</div>" % "".join(
+    """<p class="c%d">paragraph <b>%d</b></p>""" % (i, i) for i in range(50))
+
+@benchmark("contextfunc_parse")
+def bench_contextfunc_parse():
+    func = DjangoContextFunc("benchvalue")
+    return lambda: func.parse(PARSE_DOC)
+
+@benchmark("contextfunc_parsehtml")
+def bench_contextfunc_parsehtml():
+    func = DjangoContextFunc("benchvalue")
+    return lambda: func.parsehtml(PARSE_DOC)
+
+NODES_VALUE = [
+    {"name": "name%d" % i, "count": i, "tags": ["a", "b"]} for i in range(100)]
+
+@benchmark("renderer_nodes")
+def bench_renderer_nodes():
+    func = DjangoContextFunc("benchvalue")
+    return lambda: func.nodes(NODES_VALUE, "rows", "row", "attributes")
+
+@benchmark("renderer_parse_roundtrip")
+def bench_renderer_parse_roundtrip():
+    """The 'nodes' work done by serializing to a string and 'parse'."""
+    func = DjangoContextFunc("benchvalue")
+    def roundtrip():
+        return func.parse("<rows>%s</rows>" % "".join(
+                """<row name="%s" count="%d"><tags>%s</tags></row>""" % (
+                    row["name"], row["count"],
+                    "".join("<row>%s</row>" % tag for tag in row["tags"]))
+                for row in NODES_VALUE))
+    return roundtrip
+
+LOOP_ITEMS = "<items>%s</items>" % ("<item/>" * 100)
+
+def _loop_transform(hoist):
+    t = Transformer(stylesheet(
+            """<xsl:for-each select="xdjango:benchitems('parse')//item">
+                 <p class="{xdjango:benchclass()}"><xsl:value-of select="xdjango:benchvalue()"/></p>
+               </xsl:for-each>"""), hoist=hoist)
+    c = Context({"benchitems": LOOP_ITEMS, "benchclass": "c", "benchvalue": "v"})
+    return lambda: t(context=c)
+
+@benchmark("loop_calls")
+def bench_loop_calls():
+    """Two invariant xdjango: calls in a 100 item for-each."""
+    return _loop_transform(False)
+
+@benchmark("loop_calls_hoisted")
+def bench_loop_calls_hoisted():
+    return _loop_transform(True)
+
+SLOW_CALLS = 20
+
+class _SlowValue(object):
+    @property
+    def value(self):
+        time.sleep(0.001)
+        return "v"
+
+def _slow_transform(budget):
+    t = Transformer(stylesheet(
+            "<p><xsl:value-of select='xdjango:benchslow.value()'/></p>" * SLOW_CALLS),
+                    budget=budget)
+    c = Context({"benchslow": _SlowValue()})
+    return lambda: t(context=c)
+
+@benchmark("slow_calls")
+def bench_slow_calls():
+    """Twenty xdjango: calls of a variable taking 1ms."""
+    return _slow_transform(None)
+
+@benchmark("slow_calls_budget")
+def bench_slow_calls_budget():
+    return _slow_transform(0.005)
+
+PREFETCH_VARIABLES = 4
+
+class _WaitingRenderer(object):
+    def __xml__(self, *args):
+        time.sleep(0.002)
+        return "<rendered/>"
+
+def _prefetch(threads):
+    # xsltbench's in-memory database would keep Transformer's prefetch
+    # in the calling thread, these objects don't use the database
+    c = Context(dict(("benchwaiting%d" % i, _WaitingRenderer())
+                     for i in range(PREFETCH_VARIABLES)))
+    refs = dict(("benchwaiting%d" % i, (prefetch.CALL, None))
+                for i in range(PREFETCH_VARIABLES))
+    return lambda: prefetch.prefetch(c, refs, PREFETCH_VARIABLES, threads=threads)
+
+@benchmark("prefetch_serial")
+def bench_prefetch_serial():
+    """Four context objects each waiting 2ms to render."""
+    return _prefetch(False)
+
+@benchmark("prefetch_threads")
+def bench_prefetch_threads():
+    return _prefetch(True)
+
+IMPORTED_STYLESHEETS = 5
+
+def _import_stylesheets():
+    """Write a stylesheet importing IMPORTED_STYLESHEETS others, return its filename."""
+    import tempfile
+    from os.path import join
+    directory = join(tempfile.gettempdir(), "djangoxslt-bench-imports")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    imports = []
+    for i in range(IMPORTED_STYLESHEETS):
+        name = "imported%d.xslt" % i
+        with open(join(directory, name), "w") as fd:
+            fd.write(stylesheet("", "\n".join(
+                        """<xsl:template name="t%d_%d"><p><xsl:value-of select="xdjango:benchvalue%d()"/></p></xsl:template>""" % (
+                            i, j, j) for j in range(20))).replace(
+                    '<xsl:template match="/">\n\n    </xsl:template>', ""))
+        imports.append('<xsl:import href="%s"/>' % name)
+    main = join(directory, "main.xslt")
+    with open(main, "w") as fd:
+        fd.write(stylesheet("<p/>").replace(
+                '<xsl:output', "%s\n<xsl:output" % "\n".join(imports)))
+    return main
+
+@benchmark("compile_imports")
+def bench_compile_imports():
+    """Compiling a stylesheet which imports others."""
+    main = _import_stylesheets()
+    bundle.remove(main)
+    return lambda: TransformerFile(main)
+
+@benchmark("compile_imports_bundled")
+def bench_compile_imports_bundled():
+    """Compiling the same stylesheet flattened into a bundle."""
+    main = _import_stylesheets()
+    bundle.bundle(main)
+    return lambda: TransformerFile(bundle.bundle_path(main))
+
+def template_stylesheets():
+    """The names of the stylesheets the template loader can find."""
+    return sorted(
+        name for name in loader.stylesheet_index.names()
+        if name.endswith(".xslt"))
+
+@benchmark("compact_%s", params="stylesheets")
+def bench_compact(name):
+    """Transform a compacted stylesheet, recording the bytes saved."""
+    filename = loader.find_template(name)
+    try:
+        plain = TransformerFile(filename)
+        compact = TransformerFile(filename, compact=True)
+        plain_bytes = len(plain(context=Context()))
+        compact_bytes = len(compact(context=Context()))
+    except (etree.LxmlError, IOError):
+        # Stylesheets that need more than an empty context can't be measured
+        return None
+    return (lambda: compact(context=Context())), {
+        "bytes": plain_bytes,
+        "compact_bytes": compact_bytes,
+        "saved": plain_bytes - compact_bytes,
+        }
+
+
+# Managers benchmarks
+
+@benchmark("xmlify_%s_rows", params="rows")
+def bench_xmlify(count):
+    qs = rows_qs(count)
+    return lambda: managers.xmlify(qs, name="name", count="count").__xml__()
+
+@benchmark("xmlify_objects_%s_rows", params="rows")
+def bench_xmlify_objects(count):
+    qs = rows_qs(count)
+    return lambda: managers.xmlify(qs, use_values=False).__xml__()
+
+def _row_fragments(count):
+    return [row.__xml__() for row in rows_qs(count)]
+
+@benchmark("parse_fragments_%s_rows", params="rows")
+def bench_parse_fragments(count):
+    """xmlify's no-kwargs path, parsing all the rows' XML in one go."""
+    fragments = _row_fragments(count)
+    return lambda: managers.parse_fragments(fragments)
+
+@benchmark("parse_fragments_perrow_%s_rows", params="rows")
+def bench_parse_fragments_perrow(count):
+    """The same parse done one etree.XML call per row."""
+    fragments = _row_fragments(count)
+    return lambda: [etree.XML(fragment) for fragment in fragments]
+
+@benchmark("queryset_element_%s_rows", params="rows")
+def bench_queryset_element(count):
+    t = Transformer(stylesheet(
+            """<ul><xdjango:queryset key="benchrows" dest="benchrow"/></ul>""",
+            """<xsl:template match="xdjango:benchrow">
+                 <li><xsl:value-of select="xdjango:benchrow.name()"/></li>
+               </xsl:template>"""))
+    rows = list(rows_qs(count))
+    return lambda: t(context=Context({"benchrows": rows}))
+
+
+# The lengths of the filter chains used by the cloning benchmarks.
+CHAIN_DEPTHS = (10, 100)
+
+def _filter_chain(qs, depth):
+    for i in xrange(depth):
+        qs = qs.filter(count__gte=i)
+    return qs
+
+@benchmark("queryset_chain_%s_filters", params=CHAIN_DEPTHS)
+def bench_queryset_chain(depth):
+    """A plain QuerySet filter chain, the baseline for xml chains."""
+    from django.db.models.query import QuerySet
+    from models import XSLTTestModel
+    return lambda: _filter_chain(QuerySet(XSLTTestModel), depth)
+
+@benchmark("xmlqueryset_chain_%s_filters", params=CHAIN_DEPTHS)
+def bench_xmlqueryset_chain(depth):
+    from models import XSLTTestModel
+    return lambda: _filter_chain(
+        XSLTTestModel.objects.xml(name="name", count="count"), depth)
+
+
+# Running
+
+def run(only=None, log=None, **options):
+    """Run the registered benchmarks and return the results dict.
+
+    'only' is an optional list of substrings, a benchmark is only run
+    if its name contains one of them. 'log' is an optional callable
+    which is passed a line of progress for each benchmark.
+
+    The options are 'rows', 'calls' and 'stylesheets' (the parameter
+    lists), 'repeat' and 'min_time'.
+    """
+    options.setdefault("rows", ROW_COUNTS)
+    options.setdefault("calls", CALL_COUNTS)
+    if "stylesheets" not in options:
+        options["stylesheets"] = template_stylesheets()
+    repeat = options.get("repeat", REPEAT)
+    min_time = options.get("min_time", MIN_TIME)
+
+    results = {}
+    for name, params, setup in BENCHMARKS:
+        if isinstance(params, basestring):
+            params = options[params]
+        cases = [(name % p, (p,)) for p in params] if params else [(name, ())]
+        for case_name, args in cases:
+            if only and not [o for o in only if o in case_name]:
+                continue
+            fn = setup(*args)
+            if fn is None:
+                if log:
+                    log("%-40s skipped" % case_name)
+                continue
+            extra = {}
+            if isinstance(fn, tuple):
+                fn, extra = fn
+            result = measure(fn, repeat=repeat, min_time=min_time)
+            result.update(extra)
+            results[case_name] = result
+            if log:
+                log("%-40s %12.6fms%s" % (
+                        case_name,
+                        result["median"] * 1000,
+                        " saved %d bytes" % extra["saved"] if "saved" in extra else ""))
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "lxml": etree.__version__,
+            "libxslt": ".".join(str(v) for v in etree.LIBXSLT_VERSION),
+            },
+        "results": results,
+        }
+
+def save(results, filename):
+    with open(filename, "w") as fd:
+        json.dump(results, fd, indent=2, sort_keys=True)
+
+def load(filename):
+    with open(filename) as fd:
+        return json.load(fd)
+
+def compare(results, baseline, threshold=0.1):
+    """Compare 'results' with 'baseline' median timings.
+
+    Returns a list of (name, baseline, current, ratio, regressed)
+    tuples for the benchmarks present in both. A benchmark has
+    regressed when it is more than 'threshold' (a fraction) slower.
+    """
+    comparison = []
+    for name in sorted(results["results"]):
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        current = results["results"][name]["median"]
+        ratio = current / base["median"] if base["median"] else 1.0
+        comparison.append(
+            (name, base["median"], current, ratio, ratio > 1 + threshold))
+    return comparison
+
+# End
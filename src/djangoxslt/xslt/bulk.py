@@ -0,0 +1,119 @@
+# Bulk rendering
+from __future__ import with_statement
+
+"""Render one stylesheet against many contexts.
+
+For newsletters and notifications the same compiled transformer is
+run for every recipient:
+
+  from djangoxslt.xslt import bulk, loader
+  template = loader.get_template("newsletter.xslt")
+  for html in bulk.render_many(template.transformer, contexts):
+      send(html)
+
+'render_many' is a generator: contexts are taken from the iterable
+and outputs are yielded in order, one at a time, so a batch of any
+size is never held in memory. The input document is parsed, the
+metrics sink looked up and the percall hooks called once for the
+batch rather than once per context.
+
+With 'workers' (or settings.XSLT_BULK_WORKERS) the transforms run on
+a pool of threads; libxslt runs without the GIL so this helps when
+the transforms, rather than their xdjango: callbacks, are the cost.
+Each thread has its own copy of the compiled stylesheet and its own
+database connection, closed after each render. At most
+'window' contexts are being rendered or waiting to be yielded at any
+time, so a slow consumer holds the producer back.
+"""
+
+from django.conf import settings
+from django.template import Context
+
+from multiprocessing.pool import ThreadPool
+from collections import deque
+import threading
+import copy
+
+from engine import EMPTYDOC
+from engine import _transformer_percall_hook
+import metrics
+
+class _ThreadTransformers(threading.local):
+    """A copy of a transformer, its stylesheet and the input document for each thread."""
+    def __init__(self, transformer, doc):
+        self.original = (transformer, doc)
+        self.transformer = None
+
+    def get(self):
+        if self.transformer is None:
+            transformer, doc = self.original
+            self.transformer = copy.copy(transformer)
+            self.transformer.xslt = copy.copy(transformer.xslt)
+            self.doc = copy.deepcopy(doc)
+        return self.transformer, self.doc
+
+
+def _contexts(contexts):
+    for context in contexts:
+        yield context if isinstance(context, Context) else Context(context)
+
+def render_many(transformer, contexts, doc=None, workers=None, window=None, **params):
+    """Yield the output of 'transformer' for each of 'contexts'.
+
+    'contexts' is an iterable of Contexts or dicts. 'doc' is the input
+    document for every transform, EMPTYDOC by default, and the params
+    are passed to the XSLT as stylesheet parameters.
+
+    'workers' is the number of threads to render with, the default is
+    settings.XSLT_BULK_WORKERS or none, rendering in the calling
+    thread. 'window' bounds the contexts in flight, the default is
+    4 per worker.
+
+    The percall hooks are called once, with the first context.
+    """
+    if workers is None:
+        workers = getattr(settings, "XSLT_BULK_WORKERS", None)
+    doc = doc if doc is not None else EMPTYDOC
+    contexts = _contexts(contexts)
+    try:
+        first = contexts.next()
+    except StopIteration:
+        return
+    _transformer_percall_hook(transformer, doc, first, params)
+    doc = transformer.input_document(doc)
+    sink = metrics.sink()
+
+    def pending():
+        yield first
+        for context in contexts:
+            yield context
+
+    if not workers:
+        for context in pending():
+            yield transformer.render_document(doc, context, sink, params)
+        return
+
+    local = _ThreadTransformers(transformer, doc)
+    def render(context):
+        from django.db import connection
+        try:
+            thread_transformer, thread_doc = local.get()
+            return thread_transformer.render_document(thread_doc, context, sink, params)
+        finally:
+            # The pool's threads don't outlive the batch, nor should their connections
+            connection.close()
+
+    window = window or workers * 4
+    pool = ThreadPool(workers)
+    try:
+        results = deque()
+        for context in pending():
+            if len(results) >= window:
+                yield results.popleft().get()
+            results.append(pool.apply_async(render, (context,)))
+        while results:
+            yield results.popleft().get()
+    finally:
+        pool.terminate()
+
+# End
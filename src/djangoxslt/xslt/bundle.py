@@ -0,0 +1,474 @@
+# Stylesheet bundles
+from __future__ import with_statement
+
+"""Flatten stylesheets and their includes and imports into bundles.
+
+'bundle' writes a single document standing for a stylesheet and
+everything it includes or imports, at deploy time, next to the
+stylesheet:
+
+  page.xslt.bundle        the stylesheet with its xsl:include and
+                          xsl:import elements replaced by what they
+                          refer to
+  page.xslt.bundle.json   the manifest: the files the bundle was made
+                          from, with their mtimes, and the xdjango:
+                          functions the bundle calls
+
+fresh_manifest says whether a bundle is still up to date.
+
+TransformerFile doesn't use bundles: the included and imported files
+are read through the process document cache, so compiling a bundle
+measured no faster than compiling the stylesheet (see the
+compile_imports benchmarks).
+
+Included stylesheets are inlined where they're included. Imported
+stylesheets are added before the importing stylesheet's own
+declarations and import precedence is kept by shifting the priority
+of every template rule by PRECEDENCE_STEP per precedence level; of
+named templates, variables and params with the same name only the
+highest precedence one is kept. The xsl:outputs are merged into one,
+the higher precedence attribute winning. xsl:keys aren't subject to
+import precedence and are kept as they are.
+
+Every declaration keeps the namespace declarations of the stylesheet
+it came from, so literal result elements come out as they would from
+the stylesheets themselves. Only the prefixes of the
+extension-element-prefixes and exclude-result-prefixes lists, which
+apply to the whole bundle, are declared on its root.
+
+Some stylesheets can't be flattened like that and 'bundle' raises
+BundleError for them (they are then used as they are):
+
+ * xsl:apply-imports needs the import tree
+ * a prefix of those lists bound to different namespaces in different
+   stylesheets, or declared but not listed by one of them
+ * #default in those lists
+ * an explicit template priority too big to shift
+ * xsl:attribute-set (of one name), xsl:strip-space or
+   xsl:preserve-space and xsl:namespace-alias (of one prefix) in
+   stylesheets of different import precedence
+ * xsl:output QNames whose prefixes mean different things
+ * document('') refers to the stylesheet's own file, as do relative
+   document() calls in stylesheets in other directories; document()
+   calls there with anything but a literal URI may too
+
+  python manage.py xsltbundle
+"""
+
+from django.utils import simplejson as json
+
+from lxml import etree
+from os.path import join
+from os.path import dirname
+from os.path import abspath
+from os.path import exists
+from os.path import isabs
+import os
+import re
+
+from engine import xdjango_calls
+from engine import XSLT_NAMESPACE
+
+BUNDLE_SUFFIX = ".bundle"
+MANIFEST_SUFFIX = ".bundle.json"
+VERSION = 1
+
+# Template priorities are shifted this much per import precedence level
+PRECEDENCE_STEP = 1000
+MAX_PRIORITY = PRECEDENCE_STEP / 2
+
+# A document() call and its first argument if that is a string literal
+DOCUMENT_RE = re.compile(r"""(?<![\w.:-])document\(\s*(?:(['"])(.*?)\1)?""")
+
+def _xsl(name):
+    return "{%s}%s" % (XSLT_NAMESPACE, name)
+
+# Declarations that are kept only for the highest import precedence
+NAMED_DECLARATIONS = (_xsl("template"), _xsl("variable"), _xsl("param"))
+
+# Declarations import precedence decides between that can't be
+# resolved by dropping some, so they may only come from one level
+LEVELLED_DECLARATIONS = (
+    _xsl("attribute-set"), _xsl("strip-space"), _xsl("preserve-space"),
+    _xsl("namespace-alias"))
+
+# The xsl:output attributes holding QNames
+OUTPUT_QNAMES = ("method", "cdata-section-elements")
+
+# The xsl:stylesheet attributes listing prefixes
+PREFIX_LISTS = ("extension-element-prefixes", "exclude-result-prefixes")
+
+class BundleError(Exception):
+    """The stylesheet can't be flattened."""
+
+
+def bundle_path(filename):
+    return filename + BUNDLE_SUFFIX
+
+def manifest_path(filename):
+    return filename + MANIFEST_SUFFIX
+
+
+# Default priorities
+
+def _split_pattern(pattern):
+    """Split a pattern on the top level |s."""
+    parts = []
+    depth = 0
+    quote = None
+    current = []
+    for c in pattern:
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c in "[(":
+            depth += 1
+        elif c in "])":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            parts.append("".join(current).strip())
+            current = []
+            continue
+        current.append(c)
+    parts.append("".join(current).strip())
+    return parts
+
+NAME_TEST_RE = re.compile(r"^(?:child::|attribute::|@)?[\w.-]+(?::[\w.-]+)?$")
+NAMESPACE_TEST_RE = re.compile(r"^(?:child::|attribute::|@)?[\w.-]+:\*$")
+NODE_TEST_RE = re.compile(
+    r"^(?:child::|attribute::|@)?(?:\*|node\(\)|text\(\)|comment\(\)|processing-instruction\(\))$")
+PI_TEST_RE = re.compile(r"""^(?:child::)?processing-instruction\(\s*['"][^'"]*['"]\s*\)$""")
+
+def default_priority(pattern):
+    """The XSLT 1.0 default priority of a pattern with no |."""
+    pattern = pattern.strip()
+    if NAME_TEST_RE.match(pattern) or PI_TEST_RE.match(pattern):
+        return 0.0
+    if NAMESPACE_TEST_RE.match(pattern):
+        return -0.25
+    if NODE_TEST_RE.match(pattern):
+        return -0.5
+    return 0.5
+
+
+# Flattening
+
+class _Module(object):
+    """A stylesheet module: its declarations and its imports."""
+    def __init__(self, filename, root):
+        self.filename = filename
+        self.root = root
+        self.imports = []
+        self.declarations = []
+        # (filename, nsmap, {attribute: prefixes}) of the module's
+        # stylesheets, for the xsl:stylesheet prefix lists
+        self.stylesheets = []
+
+def _load(filename, files):
+    filename = abspath(filename)
+    if filename not in files:
+        files.append(filename)
+    try:
+        return etree.parse(filename).getroot()
+    except (IOError, etree.XMLSyntaxError), e:
+        raise BundleError("can't read %s: %s" % (filename, e))
+
+def _href(module_filename, href):
+    if ":" in href.split("/")[0]:
+        raise BundleError("can't bundle %s from %s" % (href, module_filename))
+    return href if isabs(href) else join(dirname(module_filename), href)
+
+def _check(module_filename, root, main_filename):
+    if root.tag not in (_xsl("stylesheet"), _xsl("transform")):
+        raise BundleError("%s is not an xsl:stylesheet" % module_filename)
+    for el in root.iter(_xsl("apply-imports")):
+        raise BundleError("%s uses xsl:apply-imports" % module_filename)
+    elsewhere = dirname(module_filename) != dirname(main_filename)
+    for el in root.iter():
+        if not isinstance(el.tag, basestring):
+            continue
+        for value in el.attrib.values():
+            for quote, href in DOCUMENT_RE.findall(value):
+                if quote and href == "":
+                    raise BundleError("%s uses document('')" % module_filename)
+                if not elsewhere:
+                    continue
+                if not quote:
+                    # Might be relative to the stylesheet's directory
+                    raise BundleError(
+                        "%s calls document() with a computed URI" % module_filename)
+                if not isabs(href) and ":" not in href.split("/")[0]:
+                    raise BundleError(
+                        "%s reads %s relative to its own directory" % (
+                            module_filename, href))
+
+def _read_module(filename, root, module, files, main_filename, stack):
+    """Add the declarations and imports of 'root' (inlining includes) to 'module'."""
+    _check(filename, root, main_filename)
+    for child in root:
+        if not isinstance(child.tag, basestring):
+            continue
+        if child.tag == _xsl("import"):
+            module.imports.append(_href(filename, child.get("href")))
+        elif child.tag == _xsl("include"):
+            included = abspath(_href(filename, child.get("href")))
+            if included in stack:
+                raise BundleError("%s includes itself" % included)
+            _read_module(included, _load(included, files), module, files,
+                         main_filename, stack + [included])
+        else:
+            module.declarations.append(child)
+    prefixes = {}
+    for attribute in PREFIX_LISTS:
+        prefixes[attribute] = (root.get(attribute) or "").split()
+        if "#default" in prefixes[attribute]:
+            raise BundleError("%s has #default in %s" % (filename, attribute))
+    module.stylesheets.append((filename, root.nsmap, prefixes))
+
+def _modules(filename, files, main_filename, stack):
+    """Return the modules of 'filename' in increasing import precedence."""
+    filename = abspath(filename)
+    if filename in stack:
+        raise BundleError("%s imports itself" % filename)
+    module = _Module(filename, _load(filename, files))
+    _read_module(filename, module.root, module, files, main_filename, [filename])
+    modules = []
+    for imported in module.imports:
+        modules.extend(_modules(imported, files, main_filename, stack + [filename]))
+    modules.append(module)
+    return modules
+
+def _template_rules(template, level):
+    """Return the template as rules with their priority shifted for 'level'."""
+    match = template.get("match")
+    if match is None:
+        return [template]
+    priority = template.get("priority")
+    if priority is not None:
+        try:
+            priority = float(priority)
+        except ValueError:
+            raise BundleError("bad template priority %r" % priority)
+        if abs(priority) >= MAX_PRIORITY:
+            raise BundleError("template priority %s is too big to shift" % priority)
+        alternatives = [(match, priority)]
+    else:
+        alternatives = [(p, default_priority(p)) for p in _split_pattern(match)]
+        if len(set(p for m, p in alternatives)) == 1:
+            alternatives = [(match, alternatives[0][1])]
+    rules = []
+    for i, (pattern, priority) in enumerate(alternatives):
+        rule = template if i == 0 else _copy(template)
+        if i > 0 and rule.get("name"):
+            del rule.attrib["name"]
+        rule.set("match", pattern)
+        rule.set("priority", repr(priority + level * PRECEDENCE_STEP))
+        rules.append(rule)
+    return rules
+
+def _copy(el):
+    from copy import deepcopy
+    copied = deepcopy(el)
+    copied.tail = None
+    return copied
+
+def _rescoped(el):
+    """Return 'el' declaring the namespaces in scope in its own stylesheet."""
+    rescoped = etree.Element(el.tag, nsmap=el.nsmap)
+    for attribute, value in el.attrib.items():
+        rescoped.set(attribute, value)
+    rescoped.text = el.text
+    for child in list(el):
+        rescoped.append(child)
+    return rescoped
+
+def _declaration_key(el):
+    if el.tag in NAMED_DECLARATIONS and el.get("name"):
+        return (el.tag == _xsl("template"), el.get("name"))
+    return None
+
+def _levelled_key(el):
+    if el.tag in (_xsl("strip-space"), _xsl("preserve-space")):
+        # Any two of these might match the same elements
+        return ("space",)
+    if el.tag == _xsl("attribute-set"):
+        return (el.tag, el.get("name"))
+    if el.tag == _xsl("namespace-alias"):
+        return (el.tag, el.get("stylesheet-prefix"))
+    return None
+
+def _merged_output(outputs):
+    """Merge 'outputs', in increasing import precedence, into one xsl:output.
+
+    Each attribute comes from the highest precedence output with it,
+    except cdata-section-elements which are all kept.
+    """
+    attributes = {}
+    cdata = []
+    nsmap = {}
+    for el in outputs:
+        for attribute, value in el.attrib.items():
+            if attribute in OUTPUT_QNAMES:
+                # The QNames' prefixes must mean the same in the bundle
+                for name in value.split():
+                    prefix = name.split(":")[0] if ":" in name else None
+                    if prefix is None and attribute == "method":
+                        continue
+                    uri = el.nsmap.get(prefix)
+                    if nsmap.get(prefix, uri) != uri:
+                        raise BundleError(
+                            "xsl:output %s %s means different things in different stylesheets" % (
+                                attribute, name))
+                    nsmap[prefix] = uri
+            if attribute == "cdata-section-elements":
+                cdata.extend(name for name in value.split() if name not in cdata)
+            else:
+                attributes[attribute] = value
+    output = etree.Element(_xsl("output"), nsmap=dict(
+            (prefix, uri) for prefix, uri in nsmap.iteritems() if uri is not None))
+    for attribute, value in sorted(attributes.iteritems()):
+        output.set(attribute, value)
+    if cdata:
+        output.set("cdata-section-elements", " ".join(cdata))
+    return output
+
+def flatten(filename):
+    """Flatten stylesheet 'filename' returning (root, files).
+
+    'files' are the stylesheet files the flattened root was made from.
+    Raises BundleError if the stylesheet can't be flattened.
+    """
+    files = []
+    filename = abspath(filename)
+    modules = _modules(filename, files, filename, [])
+    main = modules[-1]
+
+    stylesheets = [stylesheet for module in modules for stylesheet in module.stylesheets]
+
+    # The listed prefixes go on the root, all the stylesheets must agree on them
+    nsmap = {main.root.prefix: XSLT_NAMESPACE}
+    lists = {}
+    for attribute in PREFIX_LISTS:
+        lists[attribute] = []
+        for module_filename, module_nsmap, prefixes in stylesheets:
+            for prefix in prefixes[attribute]:
+                uri = module_nsmap.get(prefix)
+                if uri is None:
+                    raise BundleError("%s lists undeclared prefix %s" % (
+                            module_filename, prefix))
+                if nsmap.get(prefix, uri) != uri:
+                    raise BundleError("prefix %s is %s in %s but %s elsewhere" % (
+                            prefix, uri, module_filename, nsmap[prefix]))
+                nsmap[prefix] = uri
+                if prefix not in lists[attribute]:
+                    lists[attribute].append(prefix)
+    for attribute, listed in lists.iteritems():
+        for module_filename, module_nsmap, prefixes in stylesheets:
+            for prefix in listed:
+                if prefix in module_nsmap and prefix not in prefixes[attribute]:
+                    raise BundleError("%s doesn't list prefix %s in %s" % (
+                            module_filename, prefix, attribute))
+    root = etree.Element(main.root.tag, nsmap=nsmap)
+    for attribute, value in main.root.attrib.items():
+        if attribute not in PREFIX_LISTS:
+            root.set(attribute, value)
+    for attribute in PREFIX_LISTS:
+        if lists[attribute]:
+            root.set(attribute, " ".join(lists[attribute]))
+
+    # Highest precedence first, so the first of a name wins
+    seen = set()
+    levelled = {}
+    outputs = []
+    levels = []
+    for level in reversed(range(len(modules))):
+        kept = []
+        outputs[:0] = [el for el in modules[level].declarations
+                       if el.tag == _xsl("output")]
+        for el in modules[level].declarations:
+            if el.tag == _xsl("output"):
+                continue
+            key = _levelled_key(el)
+            if key is not None and levelled.setdefault(key, level) != level:
+                raise BundleError("xsl:%s in %s and %s needs import precedence" % (
+                        etree.QName(el).localname, modules[level].filename,
+                        modules[levelled[key]].filename))
+            key = _declaration_key(el)
+            if key is not None:
+                if key in seen:
+                    if el.tag == _xsl("template") and el.get("match"):
+                        # Still a template rule, just not a named one
+                        del el.attrib["name"]
+                    else:
+                        continue
+                else:
+                    seen.add(key)
+            kept.append(el)
+        levels.append((level, kept))
+
+    if outputs:
+        output = _merged_output(outputs)
+        output.tail = "\n"
+        root.append(output)
+    for level, declarations in reversed(levels):
+        for el in declarations:
+            el = _rescoped(el)
+            if el.tag == _xsl("template"):
+                for rule in _template_rules(el, level):
+                    rule.tail = "\n"
+                    root.append(rule)
+            else:
+                el.tail = "\n"
+                root.append(el)
+    root.text = "\n"
+    return root, files
+
+def _mtimes(files):
+    return dict((f, os.stat(f).st_mtime) for f in files)
+
+def bundle(filename):
+    """Write the bundle and manifest of stylesheet 'filename'.
+
+    Returns the manifest. Raises BundleError if the stylesheet can't
+    be flattened.
+    """
+    root, files = flatten(filename)
+    functions = sorted(set(name for element, attribute, name, args in xdjango_calls(root)))
+    with open(bundle_path(filename), "w") as fd:
+        fd.write(etree.tostring(root, xml_declaration=True, encoding="utf-8"))
+    manifest = {
+        "version": VERSION,
+        "stylesheet": abspath(filename),
+        "files": _mtimes(files),
+        "functions": functions,
+        }
+    with open(manifest_path(filename), "w") as fd:
+        json.dump(manifest, fd, indent=2, sort_keys=True)
+    return manifest
+
+def fresh_manifest(filename):
+    """Return the manifest of the bundle of 'filename' if it is fresh, else None."""
+    path = manifest_path(filename)
+    if not exists(path) or not exists(bundle_path(filename)):
+        return None
+    try:
+        with open(path) as fd:
+            manifest = json.load(fd)
+        if manifest.get("version") != VERSION:
+            return None
+        for f, mtime in manifest["files"].iteritems():
+            if os.stat(f).st_mtime != mtime:
+                return None
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    return manifest
+
+def remove(filename):
+    """Remove the bundle and manifest of 'filename' if there are any."""
+    for path in (bundle_path(filename), manifest_path(filename)):
+        if exists(path):
+            os.remove(path)
+
+# End
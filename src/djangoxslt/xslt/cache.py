@@ -0,0 +1,60 @@
+# Caches
+from __future__ import with_statement
+
+"""Bounded caches."""
+
+from collections import OrderedDict
+import threading
+
+class LRUCache(object):
+    """A dict like cache holding at most 'size' items.
+
+    When the cache is full, setting a new key drops the least recently
+    used item. The cache is safe to share between threads.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.items[key]
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+# End
@@ -4,12 +4,16 @@ from __future__ import with_statement
 """
 A Django template engine for XSLT.
 
-This isn't a real template engine, in the sense that it does not
-provide any Template class. We'll work towards that.
-
-It does allow Django to use XSLT templates and to include context
+It allows Django to use XSLT templates and to include context
 variables in your templates with an xpath syntax.
 
+Template wraps a compiled Transformer in the Django Template
+interface and the loader module finds, compiles and caches templates
+by name, like django.template.loader:
+
+  from djangoxslt.xslt import loader
+  html = loader.render_to_string("page.xslt", context)
+
 In order to do this we implement an extension system that makes
 context variables map to xpath functions. 
 
@@ -22,7 +26,7 @@ allow abstracted rendering behaviour. The argument is called the
 used to render the of the context variable to a legal XPath value. The
 callable mapped to is called the ''renderer''.
 
-Three renderers are defined by default:
+Four renderers are defined by default:
 
  * xml 
 
@@ -41,6 +45,22 @@ Three renderers are defined by default:
 
    Currently, we fix any HTML parsed document with the XHTML namespace.
 
+ * nodes
+
+   converts dicts, lists, tuples and scalars in the context variable
+   straight to elements, without making and parsing a string:
+
+     xdjango:users('nodes')
+     xdjango:users('nodes', 'users', 'user', 'attributes')
+
+   The optional arguments are the name of the root element (by
+   default the last part of the variable name), the name of list item
+   elements ('item') and 'attributes' to make scalar dict values
+   attributes rather than child elements. See to_nodes.
+
+   This is a convenience, not the fast path: where speed matters write
+   the XML with a format string and use 'parse'.
+
 
 Further renderers may be specified in settings with the variable
 XSLT_MAPPER:
@@ -61,6 +81,17 @@ from StringIO import StringIO
 import re
 import logging
 import traceback
+import time
+import copy
+import hashlib
+import os
+from urlparse import urljoin
+
+import metrics
+from cache import LRUCache
+from managers import xml_events_element
+from managers import render_xml
+from managers import has_xml
 
 # This is a simple empty document you can pass into Transformer.__call__ if you need to.
 EMPTYDOC = etree.Element("empty")
@@ -69,6 +100,32 @@ EMPTYDOC = etree.Element("empty")
 FUNC_MATCH_RE1 = re.compile(r"{?xdjango:[^}]+}?")
 FUNC_MATCH_RE2 = re.compile(r"{?xdjango:([^(]+)\((.*?)\)}?")
 
+def xdjango_calls(xslt_doc):
+    """Index the xdjango: function calls in the attributes of 'xslt_doc'.
+
+    Returns a list of (element, attribute name, function name, args)
+    tuples, one per call, in document order. 'args' is the text
+    between the call's parentheses.
+    """
+    calls = []
+    results = xslt_doc.xpath(
+        "//@*",
+        namespaces={
+            # The tag used here is relied upon in the following regexing
+            "xdjango": DJANGO_NAMESPACE,
+            })
+    # Not a perfect regex here, {} should wrap, or not.
+    djangocalls = [r for r in results if FUNC_MATCH_RE1.search(r)]
+    for call in djangocalls:
+        offset = 0
+        while True:
+            m = FUNC_MATCH_RE2.search(call, offset)
+            if m is None:
+                break
+            offset = m.end()
+            calls.append((call.getparent(), call.attrname, m.group(1), m.group(2)))
+    return calls
+
 # taken from drivel.config
 def dotted_import(name):
     mod, attr = name.split('.'), []
@@ -113,23 +170,123 @@ class Exml(object):
 
 class Xml(object):
     def __init__(self, data, base_url=None, parser=None):
-        self.parser = parser if parser else etree.XMLParser()
+        self.parser = parser
         self.data = data
         self.base_url = base_url
 
     def __call__(self):
         doc = etree.fromstring(
             self.data,
-            parser=self.parser,
+            parser=self.parser if self.parser else self.pooled_parser(),
             base_url=self.base_url)
         return doc
 
+    def pooled_parser(self):
+        return xml_parser()
+
 class Html(Xml):
-    def __init__(self, data, base_url=None, parser=None):
-        super(Html,self).__init__(data, base_url, parser if parser else etree.HTMLParser())
+    def pooled_parser(self):
+        return html_parser()
+
+class FileInput(object):
+    """The filename (or URL) of an input document for a Transformer.
+
+    Strings passed to a Transformer are always parsed as XML, a file
+    to be read must be wrapped in a FileInput:
+
+      transformer(FileInput("/var/feeds/menu.xml"), context=c)
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+_NODE_TEXT_TYPES = (str, unicode, int, long, float, bool)
+
+def _node_text(value):
+    if type(value) is bool:
+        return "true" if value else "false"
+    if type(value) is str:
+        try:
+            value.decode("ascii")
+        except UnicodeDecodeError:
+            # lxml only takes ASCII byte strings
+            return value.decode("utf-8")
+        return value
+    if type(value) is unicode:
+        return value
+    return str(value) if isinstance(value, (int, long, float)) else unicode(value)
+
+def _set_node_text(el, attribute, value):
+    if attribute is None:
+        el.text = _node_text(value)
+    else:
+        el.set(attribute, _node_text(value))
+
+def _subelement(parent, name, item_name):
+    try:
+        return etree.SubElement(parent, _node_text(name))
+    except (TypeError, ValueError):
+        # Not a legal element name
+        return etree.SubElement(parent, item_name, name=_node_text(name))
+
+def _fill_nodes(el, value, item_name, attributes):
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            if type(item) in _NODE_TEXT_TYPES:
+                if attributes:
+                    try:
+                        _set_node_text(el, _node_text(key), item)
+                        continue
+                    except (TypeError, ValueError):
+                        # Not a legal attribute name
+                        pass
+                _set_node_text(_subelement(el, key, item_name), None, item)
+            else:
+                _fill_nodes(_subelement(el, key, item_name), item, item_name, attributes)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            if type(item) in _NODE_TEXT_TYPES:
+                _set_node_text(etree.SubElement(el, item_name), None, item)
+            else:
+                _fill_nodes(etree.SubElement(el, item_name), item, item_name, attributes)
+    elif has_xml(value):
+        xml = render_xml(value)
+        for node in xml if isinstance(xml, list) else [xml]:
+            if etree.iselement(node):
+                el.append(node)
+            else:
+                el.text = (el.text or "") + _node_text(node)
+    elif value is not None:
+        _set_node_text(el, None, value)
+
+def to_nodes(value, name="value", item_name="item", attributes=False):
+    """Convert 'value' to an element called 'name'.
+
+    Dicts become elements with a child element for each key, lists and
+    tuples become elements with an 'item_name' child for each item
+    and scalars become text; None is empty. Keys that aren't legal
+    element names become 'item_name' elements with a 'name' attribute.
+    Objects supporting __xml__ are rendered with it.
+
+    If 'attributes' is true, scalar dict values become attributes
+    (unless the key isn't a legal attribute name):
+
+      to_nodes([{"name": "nic", "age": 40}], "people", "person", True)
+      => <people><person name="nic" age="40"/></people>
+
+    Making the elements one at a time is slower than parsing the same
+    XML written out with a format string, three or four times slower in
+    the renderer_nodes benchmark. Only the 'nodes' renderer uses this, where
+    the convenience is worth it.
+    """
+    el = etree.Element(name)
+    _fill_nodes(el, value, item_name, attributes)
+    return el
+
 
 XHTML_NAMESPACE = "http://www.w3.org/1999/xhtml"
 DJANGO_NAMESPACE="http://djangoproject.com/template/xslt"
+XSLT_NAMESPACE = "http://www.w3.org/1999/XSL/Transform"
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
 
 from django.template import Variable
 from django.template import VariableDoesNotExist
@@ -147,9 +304,12 @@ class DjangoContextFunc(object):
         self.mappers = {
             "xml": self.xml,
             "parsehtml": self.parsehtml,
-            "parse": self.parse
+            "parse": self.parse,
+            "nodes": self.nodes,
             }
         self._context = context
+        # Last good values, by args, for settings.XSLT_RENDER_STALE
+        self._stale = LRUCache(getattr(settings, "XSLT_RENDER_STALE_SIZE", 100))
         try:
             self.mappers.update(settings.XSLT_MAPPER)
         except AttributeError:
@@ -200,12 +360,12 @@ class DjangoContextFunc(object):
     def parsehtml(self, ctx_value, *args):
         try:
             # First make it HTML
-            htmldoc = etree.HTML(ctx_value)
-            xmldoc = etree.XML(re.sub(
+            htmldoc = etree.fromstring(ctx_value, html_parser())
+            xmldoc = etree.fromstring(re.sub(
                     "<html>", 
                     """<html xmlns="%s">""" % XHTML_NAMESPACE,
                     etree.tostring(htmldoc)
-                    ))
+                    ), xml_parser())
             self.logger.debug(etree.tostring(xmldoc))
             doc= [xmldoc]
             return doc
@@ -223,7 +383,7 @@ class DjangoContextFunc(object):
         try:
             ## Not sure if it's better to return EMPTYDOC from here if nothing is passed in
             if ctx_value:
-                xmldoc = etree.fromstring(unicode(ctx_value))
+                xmldoc = etree.fromstring(unicode(ctx_value), xml_parser())
                 doc= [xmldoc]
                 return doc
             else:
@@ -238,6 +398,12 @@ class DjangoContextFunc(object):
                 return [E.ol(*errors)]
             return ""
 
+    def nodes(self, ctx_value, *args):
+        name = args[0] if len(args) > 0 and args[0] else self.name.split(".")[-1]
+        item_name = args[1] if len(args) > 1 and args[1] else "item"
+        attributes = len(args) > 2 and args[2] == "attributes"
+        return [to_nodes(ctx_value, name, item_name, attributes)]
+
     def xml(self, ctx_value, *args):
         e = etree.Element("div" if len(args) < 2 else args[1])
         e.text = ctx_value
@@ -246,7 +412,58 @@ class DjangoContextFunc(object):
     def __call__(self, ctx, *args):
         """Treat a django context variable as an XSLT callable.
 
-        If the context object supports the __xml__ protocol then the
+        See '_call' for the details. When the transform is being
+        profiled or measured the time spent in the call is recorded.
+
+        When the render's deadline has passed the variable isn't
+        evaluated, the fallback is returned instead; see
+        RenderDeadline.
+        """
+        deadline = getattr(djangothread, "deadline", None)
+        if deadline is not None and deadline.exceeded():
+            return self._degraded(deadline, args)
+        value = self._timed_call(ctx, *args)
+        if self.name in getattr(settings, "XSLT_RENDER_STALE", ()):
+            key = _stale_key(args)
+            stored = _stale_value(value)
+            if key is not None and stored is not None:
+                self._stale[key] = stored
+        return value
+
+    def _degraded(self, deadline, args):
+        """Return the stale value or the fallback for a call after the deadline."""
+        stored = self._stale.get(_stale_key(args))
+        if stored is not None:
+            deadline.stale.append(self.name)
+            return _unstale(stored)
+        deadline.skipped.append(self.name)
+        fallback = getattr(settings, "XSLT_RENDER_FALLBACK", "")
+        if isinstance(fallback, dict):
+            return fallback.get(self.name, "")
+        return fallback
+
+    def _timed_call(self, ctx, *args):
+        profile = getattr(djangothread, "profile", None)
+        callstats = getattr(djangothread, "callstats", None)
+        if profile is None and callstats is None:
+            return self._call(ctx, *args)
+        start = time.time()
+        try:
+            return self._call(ctx, *args)
+        finally:
+            elapsed = time.time() - start
+            if profile is not None:
+                profile.add_call(self.name, elapsed)
+            if callstats is not None:
+                callstats[0] += 1
+                callstats[1] += elapsed
+
+    def _call(self, ctx, *args):
+        """Treat a django context variable as an XSLT callable.
+
+        If the context object supports the __xml_events__ protocol the
+        events are built into an element and returned. Otherwise if
+        the context object supports the __xml__ protocol then the
         method is called (with any arguments) and the return value is
         expected to be some XML value like an lxml DOM or an XPath
         value, like a string.
@@ -269,6 +486,10 @@ class DjangoContextFunc(object):
             ctx_value = self._django_eval()
             self.logger.debug("context value %s" % ctx_value)
 
+            # If the context object streams XML events build the tree from them
+            if hasattr(ctx_value, "__xml_events__"):
+                return xml_events_element(ctx_value.__xml_events__(*args))
+
             # If the context object supports the render protocol use it
             try:
                 # We just EXPECT the value to be XML
@@ -347,71 +568,418 @@ class DjangoResolver(etree.Resolver):
     will cause the Django context variable 'contextvar' to be rendered
     with the renderer 'reported', presumably a custom renderer for that
     data type.
-    """
 
-    def __init__(self):
-        self.parser = etree.XMLParser()
+    Files the resolver reads, for xsl:include, xsl:import and
+    document(), are cached in the process, checking the file's mtime
+    each time a transform asks for the file, so each file is read and
+    scanned for xdjango: calls once. The cache holds at most
+    settings.XSLT_DOCUMENT_CACHE_SIZE (256) files and
+    settings.XSLT_DOCUMENT_CACHE = None turns it off ("process", the
+    default, and the old "render" turn it on).
+
+    libxslt asks for the document of a URI once a transform, however
+    many times document() is called with it, but it can only be given
+    the file's bytes so each transform parses the file again.
+    """
 
-    def _resolve(self, content, context, base_url=None):
-        xml = etree.parse(StringIO(content), self.parser)
+    def _scan(self, content):
+        """Parse 'content' and register the xdjango: functions it calls."""
+        xml = etree.parse(StringIO(content), xml_parser())
 
         # We should check this is an xslt document
-        results = xml.xpath(
-            "//@*",
-            namespaces={
-                # The tag used here is relied upon in the following regexing
-                "xdjango": DJANGO_NAMESPACE,
-                })
-        # Not a perfect regex here, {} should wrap, or not.
-        djangocalls = [r for r in results if FUNC_MATCH_RE1.search(r)]
-
         fns = etree.FunctionNamespace(DJANGO_NAMESPACE)
-        for call in djangocalls:
-            offset = 0
-            while True:
-                m = FUNC_MATCH_RE2.search(call, offset)
-                if m is None:
-                    break
-                name = m.group(1)
-                offset = m.end()
-                if name not in fns:
-                    fns[name] = DjangoContextFunc(name)
+        for element, attribute, name, args in xdjango_calls(xml):
+            if name not in fns:
+                fns[name] = DjangoContextFunc(name)
+
+    def _resolve(self, content, context, base_url=None):
+        self._scan(content)
         # We want to call the actual super here
         return super(DjangoResolver, self).resolve_string(
             content, 
             context, 
             base_url=base_url)
 
+    def _read(self, filename):
+        """Read and scan 'filename', or get it from the document cache."""
+        mtime = None
+        if getattr(settings, "XSLT_DOCUMENT_CACHE", "process"):
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
+                # Left for open to report
+                pass
+            cached = process_documents().get(filename)
+            if cached and cached[0] == mtime:
+                return cached[1]
+        with open(filename) as fd:
+            content = fd.read()
+        self._scan(content)
+        if mtime is not None:
+            process_documents()[filename] = (mtime, content)
+        return content
+
     def resolve(self, url, pubid, context):
         """Implement resolver for django transformers.
 
-        At the moment this seems to only be able to do file based resolving.
-        That's because I'm not sure how to differentiate on the url.
+        Two schemes give XSLT document() access to the context of the
+        running transform:
+
+          querydirect:name
+
+        is the XML of the context variable 'name', which should be a
+        queryset or support the __xml__ protocol, while:
+
+          django:name
+
+        is the context variable 'name' parsed as XML (or, if it isn't
+        XML, as the text of a 'value' element).
+
+        Variables are only evaluated when a stylesheet asks for them
+        and then only once per transform.
+
+        Otherwise resolving is file based.
         """
-        if url.partition(':')[0] not in ['http', 'django', 'querydirect']:
+        scheme, sep, name = url.partition(':')
+        if scheme in ['django', 'querydirect']:
+            documents = getattr(djangothread, "documents", None)
+            content = documents.get(url) if documents is not None else None
+            if content is None:
+                content = context_document(name, xml=(scheme == 'querydirect'))
+                if documents is not None:
+                    documents[url] = content
+            return super(DjangoResolver, self).resolve_string(
+                content, 
+                context, 
+                base_url=url)
+
+        if scheme not in ['http']:
             # FIXME
             # We need a decent error here to say we couldn't find it.
-            with open(url) as fd:
-                content = fd.read()
-                return self._resolve(content, context, base_url=url)
+            content = self._read(url)
+            return super(DjangoResolver, self).resolve_string(
+                content, 
+                context, 
+                base_url=url)
 
     def resolve_file(self, f, context, base_url=None):
         content = f.read()
         return self._resolve(content, context, base_url=base_url)
 
     def resolve_filename(self, filename, context):
-        with open(filename) as f:
-            content = f.read()
-            return self._resolve(content, context, base_url=filename)
+        content = self._read(filename)
+        return super(DjangoResolver, self).resolve_string(
+            content, 
+            context, 
+            base_url=filename)
     
     def resolve_string(self, content, context, base_url=None):
         return self._resolve(content, context, base_url=base_url)
 
 
+_process_documents = None
+
+def process_documents():
+    """The process wide document cache, filename -> (mtime, content)."""
+    global _process_documents
+    if _process_documents is None:
+        _process_documents = LRUCache(
+            getattr(settings, "XSLT_DOCUMENT_CACHE_SIZE", 256))
+    return _process_documents
+
+
+# Parser pools
+
+class ParserPool(threading.local):
+    """Parsers shared by everything running in a thread.
+
+    lxml parsers are not thread safe so each thread gets its own
+    pool. A pool holds one parser for each kind and set of parser
+    options asked for.
+    """
+    def __init__(self):
+        self.parsers = {}
+        self.resolver = DjangoResolver()
+
+    def get(self, parser_class, options, resolver=False):
+        key = (parser_class, resolver, tuple(sorted(options.items())))
+        parser = self.parsers.get(key)
+        if parser is None:
+            parser = parser_class(**options)
+            if resolver:
+                parser.resolvers.add(self.resolver)
+            self.parsers[key] = parser
+        return parser
+
+parser_pool = ParserPool()
+
+def stylesheet_parser(**options):
+    """Return this thread's XMLParser for stylesheets.
+
+    The parser carries the pool's DjangoResolver so xsl:include and
+    xsl:import are resolved through it.
+    """
+    return parser_pool.get(etree.XMLParser, options, resolver=True)
+
+def xml_parser(**options):
+    """Return this thread's XMLParser for documents, made with 'options'."""
+    return parser_pool.get(etree.XMLParser, options)
+
+def html_parser(**options):
+    """Return this thread's HTMLParser for documents, made with 'options'."""
+    return parser_pool.get(etree.HTMLParser, options)
+
+
+# Input document caches
+
+class InputDocuments(threading.local):
+    """Input documents parsed from strings, cached in each thread.
+
+    When settings.XSLT_INPUT_CACHE_SIZE is set (the default is 0, no
+    cache) Transformer.input_document keeps the documents it parses
+    from strings, keyed by the sha1 of the string and the parser
+    options, so repeated renders of the same string don't parse it.
+    Each thread holds at most that many; like parsers, documents
+    aren't shared between threads.
+
+    Transforms don't change their input but extensions could. When
+    settings.XSLT_INPUT_CACHE_VALIDATE (DEBUG by default) is on a
+    cached document is checked against the sha1 of its serialization
+    when it was cached before it's used again, and parsed again if it
+    has changed.
+    """
+    def __init__(self):
+        self.documents = None
+
+    def get(self, text, options, parser, size, validate):
+        """Return the document parsed from 'text' with 'parser'."""
+        if self.documents is None or self.documents.size != size:
+            self.documents = LRUCache(size)
+        data = text.encode("utf-8") if isinstance(text, unicode) else text
+        key = (isinstance(text, unicode), hashlib.sha1(data).hexdigest(),
+               tuple(sorted(options.items())))
+        cached = self.documents.get(key)
+        if cached is not None:
+            doc, digest = cached
+            # Documents cached without validation can't be checked
+            if not validate or digest is None or digest == _document_digest(doc):
+                return doc
+            logging.getLogger("xslt.InputDocuments").error(
+                "cached input document %s changed" % key[1])
+        doc = etree.fromstring(text, parser)
+        self.documents[key] = (doc, _document_digest(doc) if validate else None)
+        return doc
+
+    def clear(self):
+        self.documents = None
+
+def _document_digest(doc):
+    return hashlib.sha1(etree.tostring(doc)).hexdigest()
+
+input_documents = InputDocuments()
+
+
+# Profiling
+
+# libxslt reports profile times in ticks of 10 microseconds
+XSLT_PROFILE_TICKS_PER_SECOND = 100000.0
+
+class TransformProfile(object):
+    """The profile of a single transform.
+
+    'templates' is a list of dicts, one per xsl:template that was
+    instantiated, with the keys: name, match, mode, calls, time and
+    average. Template times are in seconds and do not include the time
+    spent in called templates.
+
+    'functions' maps each xdjango: function called during the
+    transform to a list of [calls, seconds].
+    """
+    def __init__(self, transformer):
+        self.transformer = transformer
+        self.templates = []
+        self.functions = {}
+
+    def add_call(self, name, seconds):
+        stats = self.functions.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+    def add_xslt_profile(self, profile_doc):
+        """Add the templates from lxml's profile_run result document."""
+        for template in profile_doc.getroot():
+            calls = int(template.get("calls"))
+            seconds = int(template.get("time")) / XSLT_PROFILE_TICKS_PER_SECOND
+            self.templates.append({
+                    "name": template.get("name"),
+                    "match": template.get("match"),
+                    "mode": template.get("mode"),
+                    "calls": calls,
+                    "time": seconds,
+                    "average": seconds / calls if calls else 0.0,
+                    })
+
+    def summary(self, limit=5):
+        """A one line summary of the slowest templates and functions."""
+        templates = sorted(self.templates, key=lambda t: -t["time"])[:limit]
+        functions = sorted(self.functions.items(), key=lambda f: -f[1][1])[:limit]
+        parts = ["template %s calls=%d time=%.3fms" % (
+                    t["name"] or "match=%s%s" % (
+                        t["match"], " mode=%s" % t["mode"] if t["mode"] else ""),
+                    t["calls"],
+                    t["time"] * 1000)
+                 for t in templates]
+        parts += ["xdjango:%s calls=%d time=%.3fms" % (name, calls, seconds * 1000)
+                  for name, (calls, seconds) in functions]
+        return "; ".join(parts)
+
+def last_profile():
+    """Return the TransformProfile of the last profiled transform in this thread."""
+    return getattr(djangothread, "last_profile", None)
+
+
+# Render deadlines
+
+class RenderDeadline(object):
+    """The time budget of a single transform.
+
+    Once 'budget' seconds have passed since the transform started
+    xdjango: calls don't evaluate their variables. Calls of the
+    variables named in settings.XSLT_RENDER_STALE return the value the
+    same call (with the same string arguments) last returned, in any
+    render, so only list variables which are the same for every user.
+    The values are kept serialized, for the last
+    settings.XSLT_RENDER_STALE_SIZE (100) different arguments of each
+    variable, and parsed again for every stale call.
+    Other calls return settings.XSLT_RENDER_FALLBACK, either a value
+    or a dict of variable name -> value; the default is "".
+
+    'skipped' and 'stale' list the names of the calls that got the
+    fallback and a stale value. A transform with either is degraded.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.start = time.time()
+        self.skipped = []
+        self.stale = []
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    def exceeded(self):
+        return self.elapsed > self.budget
+
+    @property
+    def degraded(self):
+        return bool(self.skipped or self.stale)
+
+def _stale_key(args):
+    """The args as a stale value key, None if they aren't all simple values.
+
+    Strings are copied, XPath results would keep their documents alive.
+    """
+    key = []
+    for arg in args:
+        if isinstance(arg, basestring):
+            arg = unicode(arg)
+        elif not isinstance(arg, (int, long, float, bool)):
+            return None
+        key.append(arg)
+    return tuple(key)
+
+def _is_error(value):
+    return isinstance(value, list) and len(value) > 0 \
+        and etree.iselement(value[0]) and value[0].tag == "error"
+
+def _stale_value(value):
+    """Return 'value' serialized for the stale values, None if it can't be.
+
+    Elements are kept as XML and strings as plain unicode copies so no
+    document is kept alive or shared between renders.
+    """
+    if _is_error(value):
+        return None
+    if isinstance(value, basestring):
+        return ("text", unicode(value))
+    if isinstance(value, (int, long, float, bool)):
+        return ("value", value)
+    if isinstance(value, etree._ElementTree):
+        value = value.getroot()
+    if etree.iselement(value):
+        value = [value]
+    if isinstance(value, (list, tuple)):
+        items = []
+        for item in value:
+            if isinstance(item, basestring):
+                items.append(("text", unicode(item)))
+            elif etree.iselement(item) and isinstance(item.tag, basestring):
+                items.append(("xml", etree.tostring(item, with_tail=False)))
+            else:
+                return None
+        return ("list", items)
+    return None
+
+def _unstale(stored):
+    """Return a new value from the '_stale_value' of a value."""
+    kind, value = stored
+    if kind != "list":
+        return value
+    return [etree.fromstring(item) if item_kind == "xml" else item
+            for item_kind, item in value]
+
+
+# Context documents
+
+def context_document(name, xml=True):
+    """Return the context variable 'name' as an XML document string.
+
+    If 'xml' is true the variable is rendered to XML: with its __xml__
+    method or, for querysets, by xmlifying all the model's fields.
+    Otherwise the variable's string value is used.
+
+    Values that aren't XML are made the text of a 'value' element and
+    multiple nodes are wrapped in a 'nodes' element. A variable that
+    doesn't exist is an empty 'value' element.
+    """
+    from django.db.models.query import QuerySet
+    try:
+        value = Variable(name).resolve(djangothread.context)
+    except VariableDoesNotExist, e:
+        logger = logging.getLogger("xslt.context_document")
+        logger.error("problem evaling variable %s %s" % (name, e))
+        value = ""
+    if xml:
+        if has_xml(value):
+            value = render_xml(value)
+        elif isinstance(value, QuerySet):
+            from managers import xmlify
+            fields = value.model._meta.fields
+            value = xmlify(
+                value,
+                **dict((f.attname, f.attname) for f in fields)
+                ).__xml__()
+
+    if isinstance(value, (list, tuple)):
+        if len(value) == 1:
+            value = value[0]
+        else:
+            value = E.nodes(*value)
+    if etree.iselement(value):
+        return etree.tostring(value)
+
+    value = value if isinstance(value, basestring) else unicode(value)
+    if value.lstrip().startswith("<"):
+        return value.encode("utf-8") if isinstance(value, unicode) else value
+    return etree.tostring(E.value(value))
+
+
 # Hook management
 
 _transformer_init_hook_list = []
 _transformer_percall_hook_list = []
+_transformer_profile_hook_list = []
+_transformer_degraded_hook_list = []
 
 def _transformer_init_hook(transformer_object):
     """Purely backward stuff
@@ -422,12 +990,30 @@ def _transformer_init_hook(transformer_object):
     for hook_func in _transformer_init_hook_list:
         hook_func(transformer_object)
 
-def _transformer_percall_hook(transformer_object, doc, context, **params):
+def _transformer_percall_hook(transformer_object, doc, context, params):
     for hook_func in _transformer_percall_hook_list:
         hook_func(transformer_object, doc, context, **params)
 
+def _transformer_profile_hook(transformer_object, profile):
+    for hook_func in _transformer_profile_hook_list:
+        hook_func(transformer_object, profile)
+
+def _transformer_degraded_hook(transformer_object, deadline):
+    for hook_func in _transformer_degraded_hook_list:
+        hook_func(transformer_object, deadline)
+
 def add_init_hook(hookfunc):
-    """Add the specified function to the list of functions called when we init a transformer."""
+    """Add the specified function to the list of functions called when we init a transformer.
+
+    The hook is called like this:
+
+      function(transformer_object)
+
+    before the stylesheet is parsed, so it may add resolvers to
+    transformer_object.parser. While there are init hooks each
+    transformer gets a parser of its own rather than the thread's
+    pooled one.
+    """
     global _transformer_init_hook_list
     if hookfunc not in _transformer_init_hook_list:
         _transformer_init_hook_list += [hookfunc]
@@ -445,6 +1031,271 @@ def add_percall_hook(hookfunc):
     if hookfunc not in _transformer_init_hook_list:
         _transformer_percall_hook_list += [hookfunc]
 
+def add_profile_hook(hookfunc):
+    """Add the specified function to the list of functions called with profiles.
+
+    The hooks are called after each profiled transform like this:
+
+      function(transformer_object, profile)
+
+    where profile is a TransformProfile.
+    """
+    global _transformer_profile_hook_list
+    if hookfunc not in _transformer_profile_hook_list:
+        _transformer_profile_hook_list += [hookfunc]
+
+def add_degraded_hook(hookfunc):
+    """Add the specified function to the list of functions called with degraded renders.
+
+    The hooks are called after each transform which ran out of its
+    budget and returned fallbacks or stale values, like this:
+
+      function(transformer_object, deadline)
+
+    where deadline is a RenderDeadline.
+    """
+    global _transformer_degraded_hook_list
+    if hookfunc not in _transformer_degraded_hook_list:
+        _transformer_degraded_hook_list += [hookfunc]
+
+
+# Stylesheet passes
+
+# Elements whose whitespace compact_stylesheet leaves alone
+WHITESPACE_PRESERVING_XSLT = ["text", "attribute", "comment", "processing-instruction"]
+WHITESPACE_PRESERVING_HTML = ["pre", "textarea", "script", "style"]
+WHITESPACE_RE = re.compile(r"[ \t\r\n]{2,}|[\t\r\n]")
+
+def _preserves_whitespace(el):
+    if not isinstance(el.tag, basestring):
+        return True
+    if el.get("{%s}space" % XML_NAMESPACE) == "preserve":
+        return True
+    namespace, sep, localname = el.tag[1:].partition("}") \
+        if el.tag.startswith("{") else ("", "", el.tag)
+    if namespace == XSLT_NAMESPACE:
+        return localname in WHITESPACE_PRESERVING_XSLT
+    return localname.lower() in WHITESPACE_PRESERVING_HTML
+
+def _compact_text(text):
+    if text is None or not text.strip():
+        return None
+    return WHITESPACE_RE.sub(" ", text)
+
+def _compact_element(el):
+    el.text = _compact_text(el.text)
+    for child in el:
+        if not _preserves_whitespace(child):
+            _compact_element(child)
+        child.tail = _compact_text(child.tail)
+
+def _root_result_element(root):
+    """The first literal result element of the stylesheet's root template."""
+    for template in root.iterchildren("{%s}template" % XSLT_NAMESPACE):
+        if template.get("match") == "/" and not template.get("mode"):
+            for el in template.iterdescendants():
+                if isinstance(el.tag, basestring) \
+                        and not el.tag.startswith("{%s}" % XSLT_NAMESPACE) \
+                        and not el.tag.startswith("{%s}" % DJANGO_NAMESPACE):
+                    return el
+    return None
+
+def html_output(xslt_doc):
+    """Does the stylesheet 'xslt_doc' produce HTML?
+
+    It does if its xsl:output method is html or xhtml, or is xml or
+    not given and its root template's first literal result element is
+    html or in the XHTML namespace. Only the stylesheet itself is
+    looked at, not its includes and imports.
+    """
+    root = xslt_doc.getroot() if hasattr(xslt_doc, "getroot") else xslt_doc
+    method = None
+    for output in root.iterchildren("{%s}output" % XSLT_NAMESPACE):
+        method = output.get("method") or method
+    if method in ("html", "xhtml"):
+        return True
+    if method not in (None, "xml"):
+        return False
+    el = _root_result_element(root)
+    if el is None:
+        return False
+    return el.tag.startswith("{%s}" % XHTML_NAMESPACE) or el.tag.lower() == "html"
+
+def compact_stylesheet(xslt_doc):
+    """Remove insignificant whitespace from the stylesheet 'xslt_doc'.
+
+    Whitespace only text is removed and other runs of whitespace are
+    collapsed to a single space. The content of xsl:text (and the
+    other xsl elements that make text), of pre, textarea, script and
+    style elements and of xml:space="preserve" elements is left
+    alone. Indenting in xsl:output is turned off.
+
+    Stylesheets which don't produce HTML (see html_output), text
+    output say, are left alone. Included and imported stylesheets are
+    not changed.
+    """
+    if not html_output(xslt_doc):
+        return xslt_doc
+    root = xslt_doc.getroot() if hasattr(xslt_doc, "getroot") else xslt_doc
+    _compact_element(root)
+    for output in root.iterchildren("{%s}output" % XSLT_NAMESPACE):
+        if output.get("indent") == "yes":
+            output.set("indent", "no")
+    return xslt_doc
+
+# An xdjango: call whose arguments are all string or number literals
+_LITERAL = r"""(?:'[^']*'|"[^"]*"|-?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))"""
+INVARIANT_CALL_RE = re.compile(
+    r"""xdjango:([^\s(),'"/\[\]|=<>!*+]+)\(\s*(?:%s\s*(?:,\s*%s\s*)*)?\)""" % (
+        _LITERAL, _LITERAL))
+AVT_RE = re.compile(r"{[^}]*}")
+HOISTED_VARIABLE = "xdjango-hoisted-%d"
+
+def hoist_invariant_calls(xslt_doc):
+    """Move loop invariant xdjango: calls out of xsl:for-each loops.
+
+    A call in the body of an xsl:for-each whose arguments are all
+    literals returns the same value on every iteration, so it is
+    replaced by a variable, declared just before the outermost
+    xsl:for-each, holding the value of one call. Calls in the
+    select and test attributes of xsl elements and in the attribute
+    value templates of literal result elements are hoisted. Calls of
+    variables used as xdjango:queryset destinations change with each
+    row so they're left alone.
+
+    The hoisted calls are made even if the loop has no iterations
+    and context values that change when they're called (iterators,
+    say) only change once, which is why this isn't the default.
+    Included and imported stylesheets are not changed. Returns the
+    number of calls hoisted.
+    """
+    root = xslt_doc.getroot() if hasattr(xslt_doc, "getroot") else xslt_doc
+    for_each = "{%s}for-each" % XSLT_NAMESPACE
+    dests = set(
+        queryset.get("dest")
+        for queryset in root.iter("{%s}queryset" % DJANGO_NAMESPACE))
+    hoisted = [0]
+
+    for loop in list(root.iter(for_each)):
+        if [a for a in loop.iterancestors(for_each)]:
+            continue
+        variables = []
+        names = {}
+
+        def variable(m):
+            call = m.group(0)
+            if m.group(1).split(".")[0] in dests:
+                return call
+            if call not in names:
+                hoisted[0] += 1
+                names[call] = HOISTED_VARIABLE % hoisted[0]
+                variables.append((names[call], call))
+            return "$%s" % names[call]
+
+        for el in loop.iterdescendants():
+            if not isinstance(el.tag, basestring):
+                continue
+            xsl = el.tag.startswith("{%s}" % XSLT_NAMESPACE)
+            for attribute, value in el.attrib.items():
+                if xsl and attribute in ("select", "test"):
+                    new = INVARIANT_CALL_RE.sub(variable, value)
+                elif not xsl and not attribute.startswith("{"):
+                    new = AVT_RE.sub(
+                        lambda avt: INVARIANT_CALL_RE.sub(variable, avt.group(0)),
+                        value)
+                else:
+                    continue
+                if new != value:
+                    el.set(attribute, new)
+
+        parent = loop.getparent()
+        position = parent.index(loop)
+        for name, call in reversed(variables):
+            declaration = etree.Element("{%s}variable" % XSLT_NAMESPACE)
+            declaration.set("name", name)
+            declaration.set("select", call)
+            parent.insert(position, declaration)
+    return hoisted[0]
+
+def _stylesheet_roots(xslt_doc):
+    """Yield the root of 'xslt_doc' and of the files it includes or imports.
+
+    Files which can't be read are skipped.
+    """
+    X = "{%s}" % XSLT_NAMESPACE
+    root = xslt_doc.getroot() if hasattr(xslt_doc, "getroot") else xslt_doc
+    roots = [root]
+    seen = set()
+    while roots:
+        root = roots.pop(0)
+        yield root
+        base = root.getroottree().docinfo.URL
+        for el in root.iterchildren(X + "include", X + "import"):
+            href = el.get("href")
+            if not href:
+                continue
+            url = urljoin(base, href) if base else href
+            if url in seen:
+                continue
+            seen.add(url)
+            try:
+                roots.append(etree.parse(url).getroot())
+            except (IOError, etree.XMLSyntaxError):
+                pass
+
+def has_template(xslt_doc, template=None, mode=None):
+    """Does 'xslt_doc' have a template named 'template', or in 'mode'?"""
+    X = "{%s}" % XSLT_NAMESPACE
+    for root in _stylesheet_roots(xslt_doc):
+        for t in root.iterchildren(X + "template"):
+            if (template and t.get("name") == template) \
+                    or (mode and t.get("mode") == mode):
+                return True
+    return False
+
+# Fragment root templates outrank the stylesheet's own
+FRAGMENT_PRIORITY = "1000000"
+
+def fragment_stylesheet(xslt_doc, template=None, mode=None):
+    """Return a copy of 'xslt_doc' rendering just the named 'template' or 'mode'.
+
+    The copy has a root template, outranking the stylesheet's, which
+    calls 'template' or applies templates to the root in 'mode'. The
+    xsl:params of the template, or of the stylesheet's templates in
+    the mode, are declared as stylesheet params, if there isn't a top
+    level param or variable of that name already, and passed on.
+
+    Returns (doc, params) where params are the names of the params.
+    The templates and top level params of included and imported
+    stylesheets count too, if their files can be read.
+    """
+    X = "{%s}" % XSLT_NAMESPACE
+    roots = list(_stylesheet_roots(xslt_doc))
+    templates = [t for r in roots for t in r.iterchildren(X + "template")
+                 if (template and t.get("name") == template)
+                 or (mode and t.get("mode") == mode)]
+    params = []
+    for t in templates:
+        for param in t.iterchildren(X + "param"):
+            if param.get("name") not in params:
+                params.append(param.get("name"))
+
+    declared = set(el.get("name") for r in roots
+                   for el in r.iterchildren(X + "param", X + "variable"))
+    derived = copy.deepcopy(xslt_doc)
+    root = derived.getroot() if hasattr(derived, "getroot") else derived
+    for name in params:
+        if name not in declared:
+            etree.SubElement(root, X + "param", name=name)
+    fragment = etree.SubElement(root, X + "template", match="/", priority=FRAGMENT_PRIORITY)
+    if template:
+        call = etree.SubElement(fragment, X + "call-template", name=template)
+    else:
+        call = etree.SubElement(fragment, X + "apply-templates", select="/", mode=mode)
+    for name in params:
+        etree.SubElement(call, X + "with-param", name=name, select="$%s" % name)
+    return derived, params
+
 
 # Transformers
 
@@ -453,7 +1304,15 @@ class Transformer(object):
                  content, 
                  resolv=lambda c,p: etree.fromstring(c,p),
                  parser=None,
-                 context=None):
+                 context=None,
+                 profile=None,
+                 name=None,
+                 input_parser_options=None,
+                 compact=None,
+                 hoist=None,
+                 functions=None,
+                 budget=None,
+                 prefetch=None):
         """Make a transformer object.
 
         The transformer wraps all the django specific functionality.
@@ -472,23 +1331,87 @@ class Transformer(object):
 
               lambda c,p: etree.fromstring(c,p)
 
-          parser is the XMLParser to use. a default is supplied. 
+          parser is the XMLParser to use. The default is the
+          thread's pooled stylesheet_parser(), which already has a
+          DjangoResolver, so transformers share parsers. When there
+          are init hooks, which may add resolvers to the parser, the
+          default is a new parser for each transformer instead.
+
+          profile, if true, makes every call of the transformer
+          collect a TransformProfile of the templates and xdjango:
+          functions. The profile is passed to the profile hooks. The
+          default is settings.XSLT_PROFILE or False.
+
+          name is used to label the transformer's metrics, see the
+          metrics module.
+
+          input_parser_options are the XMLParser options used to
+          parse documents passed to __call__ as strings, files or
+          filenames; for example, for very large documents:
+
+              {"huge_tree": True, "collect_ids": False}
+
+          The default is settings.XSLT_INPUT_PARSER or no options.
+
+          compact, if true, removes insignificant whitespace from the
+          stylesheet before compiling it; see compact_stylesheet. The
+          default is settings.XSLT_COMPACT_OUTPUT or False.
+
+          hoist, if true, moves loop invariant xdjango: calls out of
+          xsl:for-each loops; see hoist_invariant_calls. The default
+          is settings.XSLT_HOIST_CALLS or False.
+
+          functions is a list of the xdjango: functions the
+          stylesheet calls, those of the stylesheet a fragment is
+          made from say. If it's given
+          the stylesheet isn't scanned for them.
+
+          budget is the time, in seconds, each call of the
+          transformer has before xdjango: calls return fallbacks
+          instead of evaluating; see RenderDeadline. The default is
+          settings.XSLT_RENDER_BUDGET or no budget.
+
+          prefetch is the number of threads calls of the transformer
+          evaluate the context's querysets and xmlify objects on
+          before transforming; see the prefetch module. The default
+          is settings.XSLT_PREFETCH_WORKERS or no prefetching.
         """
         context = context if context else {}
+        start = time.time()
 
         global DJANGO_NAMESPACE
         self.logger = logging.getLogger("xslt.Transformer")
+        self.profile = profile if profile is not None \
+            else getattr(settings, "XSLT_PROFILE", False)
+        self.name = metrics.metric_name(name if name else "string")
+        self.input_parser_options = input_parser_options \
+            if input_parser_options is not None \
+            else getattr(settings, "XSLT_INPUT_PARSER", {})
+        self.compact = compact if compact is not None \
+            else getattr(settings, "XSLT_COMPACT_OUTPUT", False)
+        self.hoist = hoist if hoist is not None \
+            else getattr(settings, "XSLT_HOIST_CALLS", False)
+        self.budget = budget if budget is not None \
+            else getattr(settings, "XSLT_RENDER_BUDGET", None)
+        self.prefetch = prefetch if prefetch is not None \
+            else getattr(settings, "XSLT_PREFETCH_WORKERS", None)
         fns = etree.FunctionNamespace(DJANGO_NAMESPACE)
 
         # Setup the rest of the environment
-        self.parser = parser if parser else etree.XMLParser()
+        if not parser and _transformer_init_hook_list:
+            # The hooks may change the parser, don't let them change the pool's
+            parser = etree.XMLParser()
+        self.parser = parser if parser else stylesheet_parser()
 
         # We call out here to anything that's defined
         _transformer_init_hook(self)
 
         # Setup the djangoxslt resolver
-        self.resolver = DjangoResolver()
-        self.parser.resolvers.add(self.resolver)
+        if parser:
+            self.resolver = DjangoResolver()
+            self.parser.resolvers.add(self.resolver)
+        else:
+            self.resolver = parser_pool.resolver
 
         # lxml doesn't seem to use the parser's resolver for this
         # Hence we need to do the great big hack below
@@ -496,31 +1419,74 @@ class Transformer(object):
 
         ## Great big hack
         # We should check this is an xslt document
-        xml = self.xslt_doc
-        results = xml.xpath(
-            "//@*",
-            namespaces={
-                # The tag used here is relied upon in the following regexing
-                "xdjango": DJANGO_NAMESPACE,
-                })
-        # Not a perfect regex here, {} should wrap, or not.
-        djangocalls = [r for r in results if FUNC_MATCH_RE1.search(r)]
-        for call in djangocalls:
-            offset = 0
-            while True:
-                m = FUNC_MATCH_RE2.search(call, offset)
-                if m is None:
-                    break
-                name = m.group(1)
-                offset = m.end()
-                if name not in fns:
-                    fns[name] = DjangoContextFunc(name)
+        if functions is None:
+            functions = [name for element, attribute, name, args
+                         in xdjango_calls(self.xslt_doc)]
+        for name in functions:
+            if name not in fns:
+                fns[name] = DjangoContextFunc(name)
         # End Great big hack
+        self.functions = functions
+        self._fragments = LRUCache(getattr(settings, "XSLT_FRAGMENT_CACHE_SIZE", 100))
+
+        if self.prefetch:
+            import prefetch as prefetching
+            self.prefetch_references = prefetching.references(
+                self.xslt_doc, functions, DJANGO_NAMESPACE)
+
+        if self.compact:
+            compact_stylesheet(self.xslt_doc)
+        if self.hoist:
+            hoist_invariant_calls(self.xslt_doc)
 
-        qs_extension = QuerySetTemplateElement()
+        qs_extension = QuerySetTemplateElement(self.name)
         extensions = {(DJANGO_NAMESPACE, 'queryset'): qs_extension}
         self.xslt = etree.XSLT(self.xslt_doc, extensions=extensions)
 
+        sink = metrics.sink()
+        if sink is not None:
+            sink.timing("compile.%s" % self.name, time.time() - start)
+
+    def fragment(self, template=None, mode=None):
+        """Return a transformer rendering just the named 'template' or 'mode'.
+
+        For endpoints which update part of a page. The transformer
+        compiles a copy of this one's stylesheet, see
+        fragment_stylesheet, and is cached so each fragment is
+        compiled once. Its 'fragment_params' are the names of the
+        params it passes on to the template.
+
+        Raises TemplateDoesNotExist if no template of the stylesheet,
+        or of the files it includes or imports, has the name or mode.
+        The cache holds settings.XSLT_FRAGMENT_CACHE_SIZE (100)
+        fragments.
+        """
+        if bool(template) == bool(mode):
+            raise ValueError("a fragment is a template or a mode")
+        key = (template, mode)
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            if not has_template(self.xslt_doc, template, mode):
+                from django.template import TemplateDoesNotExist
+                raise TemplateDoesNotExist("%s has no %s %s" % (
+                        self.name, "template" if template else "mode", template or mode))
+            doc, params = fragment_stylesheet(self.xslt_doc, template, mode)
+            fragment = Transformer(
+                doc,
+                resolv=lambda c, p: c,
+                profile=self.profile,
+                name="%s.%s" % (self.name, template or mode),
+                input_parser_options=self.input_parser_options,
+                # Already compacted and hoisted
+                compact=False,
+                hoist=False,
+                functions=self.functions,
+                budget=self.budget,
+                prefetch=self.prefetch)
+            fragment.fragment_params = params
+            self._fragments[key] = fragment
+        return fragment
+
     def __xslt_error__(self, errorlist):
         """Format an errorlist.
 
@@ -537,27 +1503,109 @@ class Transformer(object):
                  doc=None, 
                  context=None, 
                  **params):
+        """Transform 'doc' with 'context' and return the output string.
+
+        'doc' may be an lxml element or tree, a string of XML, a file
+        like object or a FileInput naming a file (or URL). Files are
+        parsed straight from the stream with the input parser, so
+        large documents aren't read into a string first.
+
+        The params are passed to the XSLT as stylesheet parameters.
+        """
+        return self._transform(doc, context, params, True)
+
+    def tree(self,
+             doc=None,
+             context=None,
+             **params):
+        """Transform 'doc' with 'context' and return the result tree.
+
+        This is __call__ without serializing the result, for passing
+        it on to another transform; see the pipeline module.
+        """
+        return self._transform(doc, context, params, False)
+
+    def _transform(self, doc, context, params, serialize):
         from django.template import Context
         global djangothread
         djangothread.context = context if context != None else Context()
         doc = doc if doc is not None else EMPTYDOC
 
         # Call out to the percall hooks
-        _transformer_percall_hook(self, doc, context, **params)
+        _transformer_percall_hook(self, doc, context, params)
+
+        doc = self.input_document(doc)
+        return self._render_call(
+            doc, djangothread.context, metrics.sink(), params, serialize)
+
+    def _render_call(self, doc, context, sink, params, serialize):
+        """Prefetch the context's variables, if the transformer does, and _render."""
+        pushed = False
+        if self.prefetch:
+            import prefetch as prefetching
+            pushed = prefetching.push(
+                context, self.prefetch_references, self.prefetch, self.name)
+        try:
+            return self._render(doc, context, sink, params, serialize)
+        finally:
+            if pushed:
+                context.pop()
 
-        # accept a string for document as well
-        if isinstance(doc, basestring):
-            doc = etree.fromstring(doc)
+    def input_document(self, doc):
+        """Parse 'doc' if it is a string of XML, a file or a FileInput.
 
+        Strings are only ever parsed as XML, never read as filenames.
+        Documents parsed from strings may come from the input
+        document cache, see InputDocuments.
+        """
+        if hasattr(doc, "read"):
+            return etree.parse(doc, self.input_parser())
+        elif isinstance(doc, FileInput):
+            return etree.parse(doc.filename, self.input_parser())
+        elif isinstance(doc, basestring):
+            size = getattr(settings, "XSLT_INPUT_CACHE_SIZE", 0)
+            if size:
+                return input_documents.get(
+                    doc, self.input_parser_options, self.input_parser(), size,
+                    getattr(settings, "XSLT_INPUT_CACHE_VALIDATE", settings.DEBUG))
+            return etree.fromstring(doc, self.input_parser())
+        return doc
+
+    def render_document(self, doc, context, sink, params):
+        """Transform the parsed 'doc' with 'context' and return the output string.
+
+        This is __call__ without the hooks and input parsing, for
+        callers like bulk.render_many which do those once; the context
+        is prefetched and the render budget kept as in __call__.
+        'sink' is the metrics sink or None.
+        """
+        return self._render_call(doc, context, sink, params, True)
+
+    def _render(self, doc, context, sink, params, serialize):
+        """Transform the parsed 'doc', returning the output string if 'serialize'.
+
+        Otherwise the result tree is returned, and in DEBUG the
+        error document is returned as a tree too.
+        """
+        global djangothread
+        djangothread.context = context
+
+        # django: and querydirect: documents of this transform are cached here
+        djangothread.documents = {}
+        deadline = RenderDeadline(self.budget) if self.budget else None
+        djangothread.deadline = deadline
         try:
-            return str(self.xslt(doc, **params))
+            if sink is not None:
+                return self._measured(sink, doc, serialize, params)
+            result = self._apply(doc, params)
+            return str(result) if serialize else result
         except etree.XSLTApplyError, e:
             self.logger.error("couldn't transform %s" % e.error_log)
             self.logger.error("couldn't transform %s" % e)
             self.logger.debug(self.__xslt_error__(e.error_log))
 
             if settings.DEBUG:
-                return etree.tostring(self.__xslt_error__(e.error_log))
+                return self._error_output(e.error_log, serialize)
             else:
                 raise
         except etree.XMLSyntaxError, e:
@@ -565,12 +1613,88 @@ class Transformer(object):
                 self.logger.error("couldn't transform %s" % i)
                 self.logger.debug(traceback.format_exc())
             if settings.DEBUG:
-                return etree.tostring(self.__xslt_error__(e.error_log))
+                return self._error_output(e.error_log, serialize)
             else:
                 raise
+        finally:
+            djangothread.documents = None
+            djangothread.deadline = None
+            if deadline is not None and deadline.degraded:
+                self._degraded(sink, deadline)
+
+    def _error_output(self, errorlist, serialize):
+        errordoc = self.__xslt_error__(errorlist)
+        if serialize:
+            return etree.tostring(errordoc)
+        return etree.ElementTree(errordoc)
+
+    def _degraded(self, sink, deadline):
+        """Report a transform that ran out of its budget."""
+        self.logger.warning(
+            "%s degraded after %.3fs, fallbacks for %s, stale values for %s" % (
+                self.name, deadline.elapsed,
+                ", ".join(deadline.skipped) or "nothing",
+                ", ".join(deadline.stale) or "nothing"))
+        if sink is not None:
+            sink.incr("degraded.%s" % self.name)
+            sink.histogram("degraded_calls.%s" % self.name,
+                           len(deadline.skipped) + len(deadline.stale))
+        _transformer_degraded_hook(self, deadline)
+
+    def input_parser(self):
+        """Return the parser for documents passed to __call__."""
+        return xml_parser(**self.input_parser_options)
+
+    def _apply(self, doc, params):
+        """Run the transform, profiled if the transformer is.
+
+        'params' is the dict of stylesheet params. It isn't passed as
+        keywords so the params can have any name.
+        """
+        if self.profile:
+            return self._profiled(doc, params)
+        return self.xslt(doc, **params)
+
+    def _measured(self, sink, doc, serialize, params):
+        """Run the transform with 'params' sending its metrics to 'sink'.
+
+        output_bytes is only sent when the output is serialized.
+        """
+        global djangothread
+        callstats = [0, 0.0]
+        djangothread.callstats = callstats
+        start = time.time()
+        try:
+            output = self._apply(doc, params)
+            if serialize:
+                output = str(output)
+        finally:
+            djangothread.callstats = None
+        sink.timing("transform.%s" % self.name, time.time() - start)
+        sink.histogram("callbacks.%s" % self.name, callstats[0])
+        sink.timing("callback_time.%s" % self.name, callstats[1])
+        if serialize:
+            sink.histogram("output_bytes.%s" % self.name, len(output))
+        return output
+
+    def _profiled(self, doc, params):
+        """Run the transform collecting a TransformProfile."""
+        global djangothread
+        profile = TransformProfile(self)
+        djangothread.profile = profile
+        djangothread.last_profile = None
+        try:
+            result = self.xslt(doc, profile_run=True, **params)
+        finally:
+            djangothread.profile = None
+        profile.add_xslt_profile(result.xslt_profile)
+        djangothread.last_profile = profile
+        _transformer_profile_hook(self, profile)
+        return result
 
 
 from os.path import join as joinpath
+from os.path import basename
 
 def transformer_file_resolv_callback(c, p):
     """A resolver function for Transformer.
@@ -596,6 +1720,7 @@ class TransformerFile(Transformer):
         try:
             stylesheet = joinpath(filename_parts)
             self.stylesheet = stylesheet
+            kwargs.setdefault("name", basename(joinpath(*filename_parts)))
             super(TransformerFile, self).__init__(
                 stylesheet, 
                 resolv=transformer_file_resolv_callback,
@@ -605,21 +1730,84 @@ class TransformerFile(Transformer):
             e.message = "%s {%s}" % (e.message, e.stylesheet)
             raise
 
+class Template(object):
+    """A compiled XSLT template.
+
+    This gives a Transformer the interface of a Django Template. Use
+    the loader module to get Templates by name.
+    """
+    def __init__(self, transformer, name=None):
+        self.transformer = transformer
+        self.name = name
+
+    def render(self, context=None, doc=None, **params):
+        """Render the template with 'context', a Context or a dict.
+
+        'doc' is the input document, EMPTYDOC by default. The params
+        are passed to the XSLT as stylesheet parameters.
+        """
+        from django.template import Context
+        if not isinstance(context, Context):
+            context = Context(context)
+        return self.transformer(
+            doc if doc is not None else EMPTYDOC,
+            context=context,
+            **params)
+
+    def render_fragment(self, context=None, template=None, mode=None, doc=None,
+                        params=None):
+        """Render just the named 'template' or 'mode' with 'context'.
+
+        See Transformer.fragment. 'params' is a dict of the params
+        passed to the template, so they can have any name.
+        """
+        from django.template import Context
+        if not isinstance(context, Context):
+            context = Context(context)
+        fragment = self.transformer.fragment(template, mode)
+        return fragment._transform(
+            doc if doc is not None else EMPTYDOC, context, params or {}, True)
+
+    def render_many(self, contexts, doc=None, **kwargs):
+        """Render the template with each of 'contexts', yielding the outputs.
+
+        See bulk.render_many.
+        """
+        from bulk import render_many
+        return render_many(self.transformer, contexts, doc, **kwargs)
+
 from django.http import HttpResponse
 def render_to_response(xslt, context, mimetype="text/html"):
-    t = TransformerFile(settings.TRANSFORMS, xslt)
-    return HttpResponse(t(context=context), mimetype="text/html")
+    import loader
+    t = loader.get_template(xslt)
+    return HttpResponse(t.render(context), mimetype="text/html")
 
 class QuerySetTemplateElement(etree.XSLTExtension):
+    """The xdjango:queryset element.
+
+      <xdjango:queryset key="people" dest="person" limit="20"/>
+
+    applies templates to an xdjango:person element for each item of
+    the context variable 'people', with the item as the context
+    variable 'person'. The optional 'limit' is the most items used.
+    """
+    def __init__(self, name="string"):
+        self.name = name
+
     def execute(self, context, self_node, input_node, output_parent):
         ctx = djangothread.context
         key = self_node.get('key')
         dest = self_node.get('dest')
+        limit = self_node.get('limit')
         if '.' in key:
             qs = DjangoContextFunc(key, context=ctx)(None, 'pass')
         else:
             qs = ctx[key]
+        if limit:
+            qs = qs[:int(limit)]
+        rows = 0
         for item in qs:
+            rows += 1
             ctx[dest] = item
             el = etree.Element('{%s}%s' % (DJANGO_NAMESPACE, dest))
             #self.apply_templates(context, el, output_parent)
@@ -635,4 +1823,8 @@ class QuerySetTemplateElement(etree.XSLTExtension):
                 #raise RuntimeError('template not specified')
             del ctx[dest]
 
+        sink = metrics.sink()
+        if sink is not None:
+            sink.histogram("queryset_rows.%s" % self.name, rows)
+
 # End
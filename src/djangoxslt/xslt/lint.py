@@ -0,0 +1,198 @@
+# Stylesheet performance lint
+from __future__ import with_statement
+
+"""Find costly xdjango: usage in stylesheets.
+
+Every xdjango: function call is a round trip into Python, so calls in
+the body of a loop are made once per iteration. The lint looks at the
+calls found by engine.xdjango_calls and reports:
+
+ * loop-call       a call made once per iteration of a loop
+ * loop-parse      a 'parse' or 'parsehtml' call made per iteration,
+                   parsing a string every time
+ * queryset-limit  an xdjango:queryset without a 'limit'
+
+The loops are xsl:for-each bodies, named templates which call
+themselves (directly or through other named templates), templates
+matching the rows of an xdjango:queryset and named templates called
+from any of those.
+
+Each report also estimates the callbacks made by one render, assuming
+every for-each and recursion goes round 'loop_size' times and every
+unlimited xdjango:queryset has 'queryset_rows' rows; the defaults are
+settings.XSLT_LINT_LOOP_SIZE (10) and settings.XSLT_LINT_QUERYSET_ROWS
+(100). Templates run by xsl:apply-templates are counted once.
+
+  python manage.py xsltlint --max-callbacks=500
+"""
+
+from django.conf import settings
+
+from lxml import etree
+import re
+
+from engine import xdjango_calls
+from engine import DJANGO_NAMESPACE
+from engine import XSLT_NAMESPACE
+
+LOOP_SIZE = 10
+QUERYSET_ROWS = 100
+
+PARSE_RENDERERS = ("parse", "parsehtml")
+FIRST_ARG_RE = re.compile(r"""^\s*['"]([^'"]*)['"]""")
+
+def _xsl(name):
+    return "{%s}%s" % (XSLT_NAMESPACE, name)
+
+FOR_EACH = _xsl("for-each")
+TEMPLATE = _xsl("template")
+CALL_TEMPLATE = _xsl("call-template")
+QUERYSET = "{%s}queryset" % DJANGO_NAMESPACE
+
+
+class Finding(object):
+    """A problem found in a stylesheet."""
+    def __init__(self, kind, line, message):
+        self.kind = kind
+        self.line = line
+        self.message = message
+
+    def __str__(self):
+        return "%s: %s: %s" % (self.line, self.kind, self.message)
+
+
+class Report(object):
+    """The findings and estimated callbacks of one stylesheet."""
+    def __init__(self, filename, findings, callbacks):
+        self.filename = filename
+        self.findings = findings
+        self.callbacks = callbacks
+
+    def lines(self):
+        lines = ["%s:%s" % (self.filename, finding) for finding in self.findings]
+        lines.append("%s: about %d callbacks per render" % (
+                self.filename, self.callbacks))
+        return lines
+
+
+class _Loops(object):
+    """Works out the loops each element of a stylesheet runs in."""
+    def __init__(self, doc, loop_size, queryset_rows):
+        self.loop_size = loop_size
+        self.named = {}
+        self.callers = {}
+        for template in doc.iter(TEMPLATE):
+            if template.get("name"):
+                self.named[template.get("name")] = template
+        for call in doc.iter(CALL_TEMPLATE):
+            self.callers.setdefault(call.get("name"), []).append(call)
+
+        # The templates run for each row of an xdjango:queryset
+        self.rows = {}
+        for queryset in doc.iter(QUERYSET):
+            limit = queryset.get("limit")
+            self.rows[queryset.get("dest")] = (
+                queryset, int(limit) if limit else queryset_rows)
+
+        self.recursive = set(
+            name for name in self.named if self._reaches(name, name, set()))
+        self._template_loops = {}
+
+    def _called(self, name):
+        template = self.named.get(name)
+        if template is None:
+            return []
+        return [call.get("name") for call in template.iter(CALL_TEMPLATE)]
+
+    def _reaches(self, start, target, seen):
+        for name in self._called(start):
+            if name == target:
+                return True
+            if name not in seen:
+                seen.add(name)
+                if self._reaches(name, target, seen):
+                    return True
+        return False
+
+    def element_loops(self, element, attribute=None):
+        """Return a list of (multiplier, description) for the loops 'element' runs in."""
+        loops = []
+        template = None
+        for ancestor in element.iterancestors():
+            if ancestor.tag == FOR_EACH:
+                loops.append((self.loop_size, "xsl:for-each at line %s" % ancestor.sourceline))
+            elif ancestor.tag == TEMPLATE:
+                template = ancestor
+                break
+        if element.tag == FOR_EACH and attribute not in (None, "select"):
+            loops.append((self.loop_size, "xsl:for-each at line %s" % element.sourceline))
+        if template is not None:
+            loops.extend(self.template_loops(template))
+        return loops
+
+    def template_loops(self, template):
+        key = id(template)
+        if key not in self._template_loops:
+            # Guard against call-template cycles while working it out
+            self._template_loops[key] = []
+            loops = []
+            name = template.get("name")
+            if name in self.recursive:
+                loops.append((self.loop_size, "recursive template %s" % name))
+            match = template.get("match") or ""
+            for dest, (queryset, rows) in self.rows.iteritems():
+                if re.search(r"\bxdjango:%s\b" % re.escape(dest), match):
+                    loops.append((rows, "xdjango:queryset at line %s" % queryset.sourceline))
+                    loops.extend(self.element_loops(queryset))
+            if name:
+                # The most expensive call site outside the template itself
+                sites = [self.element_loops(call)
+                         for call in self.callers.get(name, [])
+                         if template not in call.iterancestors()]
+                if sites:
+                    loops.extend(max(sites, key=_multiplier))
+            self._template_loops[key] = loops
+        return self._template_loops[key]
+
+
+def _multiplier(loops):
+    total = 1
+    for multiplier, description in loops:
+        total *= multiplier
+    return total
+
+def lint(doc, filename="<string>", loop_size=None, queryset_rows=None):
+    """Lint the stylesheet document 'doc' and return a Report."""
+    if loop_size is None:
+        loop_size = getattr(settings, "XSLT_LINT_LOOP_SIZE", LOOP_SIZE)
+    if queryset_rows is None:
+        queryset_rows = getattr(settings, "XSLT_LINT_QUERYSET_ROWS", QUERYSET_ROWS)
+    loops = _Loops(doc, loop_size, queryset_rows)
+    findings = []
+    callbacks = 0
+    for element, attribute, name, args in xdjango_calls(doc):
+        call_loops = loops.element_loops(element, attribute)
+        callbacks += _multiplier(call_loops)
+        if not call_loops:
+            continue
+        m = FIRST_ARG_RE.match(args)
+        renderer = m.group(1) if m else None
+        kind = "loop-parse" if renderer in PARSE_RENDERERS else "loop-call"
+        findings.append(Finding(
+                kind, element.sourceline,
+                "xdjango:%s(%s) is called about %d times, in %s" % (
+                    name, args, _multiplier(call_loops),
+                    ", ".join(description for multiplier, description in call_loops))))
+    for queryset in doc.iter(QUERYSET):
+        if not queryset.get("limit"):
+            findings.append(Finding(
+                    "queryset-limit", queryset.sourceline,
+                    "xdjango:queryset of %s has no limit" % queryset.get("key")))
+    findings.sort(key=lambda finding: finding.line)
+    return Report(filename, findings, callbacks)
+
+def lint_file(filename, **options):
+    """Lint the stylesheet file 'filename' and return a Report."""
+    return lint(etree.parse(filename), filename, **options)
+
+# End
@@ -0,0 +1,210 @@
+# XSLT template loading
+from __future__ import with_statement
+
+"""Load XSLT templates by name, like django.template.loader.
+
+Templates are looked for in the directories in
+settings.XSLT_TEMPLATE_DIRS (by default just settings.TRANSFORMS) and
+then in the 'transforms' directory of each installed app.
+
+The stylesheets in those directories are indexed by name when they
+are first needed so finding a template is a dict lookup. The
+directories are checked for added or removed files at most every
+settings.XSLT_INDEX_CHECK_INTERVAL seconds (2 by default, None turns
+checking off) and the index is rebuilt when they change.
+
+Templates are compiled the first time they're asked for and then
+cached, so each stylesheet is compiled once per process. When
+settings.XSLT_TEMPLATE_CHECK_MTIME is true (the default is
+settings.DEBUG) a template is recompiled if its file has changed.
+"""
+
+from django.conf import settings
+from django.template import TemplateDoesNotExist
+
+from os.path import join
+from os.path import dirname
+from os.path import isdir
+from os.path import relpath
+import os
+import threading
+import logging
+import time
+
+from engine import Template
+from engine import TransformerFile
+
+APP_TRANSFORMS_DIR = "transforms"
+
+_app_transform_dirs = None
+
+def app_transform_dirs():
+    """The 'transforms' directories of the installed apps."""
+    global _app_transform_dirs
+    if _app_transform_dirs is None:
+        dirs = []
+        for app in settings.INSTALLED_APPS:
+            mod = __import__(app, {}, {}, [''])
+            transforms = join(dirname(mod.__file__), APP_TRANSFORMS_DIR)
+            if isdir(transforms):
+                dirs.append(transforms)
+        _app_transform_dirs = dirs
+    return _app_transform_dirs
+
+def template_dirs():
+    """All the directories templates are looked for in, in order."""
+    dirs = getattr(settings, "XSLT_TEMPLATE_DIRS", None)
+    if dirs is None:
+        dirs = [settings.TRANSFORMS]
+    return list(dirs) + app_transform_dirs()
+
+
+class StylesheetIndex(object):
+    """An index of the files in the template directories.
+
+    Files are indexed by their name relative to the template directory
+    they're in, with '/' separators. When a name is in more than one
+    directory the first directory wins.
+    """
+    def __init__(self, dirs=None):
+        self.logger = logging.getLogger("xslt.loader.StylesheetIndex")
+        self._dirs = dirs
+        self.lock = threading.Lock()
+        # name -> filename
+        self.paths = None
+        # directory -> mtime
+        self.mtimes = {}
+        self.checked = 0
+
+    def dirs(self):
+        return self._dirs if self._dirs is not None else template_dirs()
+
+    def build(self):
+        paths = {}
+        mtimes = {}
+        for template_dir in self.dirs():
+            for directory, subdirs, files in os.walk(template_dir):
+                mtimes[directory] = os.stat(directory).st_mtime
+                for filename in files:
+                    path = join(directory, filename)
+                    name = relpath(path, template_dir).replace(os.sep, "/")
+                    paths.setdefault(name, path)
+        self.logger.debug("indexed %d stylesheets" % len(paths))
+        self.paths = paths
+        self.mtimes = mtimes
+        self.checked = time.time()
+
+    def changed(self):
+        """Have any of the indexed directories changed?"""
+        for directory, mtime in self.mtimes.iteritems():
+            try:
+                if os.stat(directory).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def refresh(self):
+        """Build the index or, if it's time to check, rebuild it if it's changed."""
+        if self.paths is None:
+            with self.lock:
+                if self.paths is None:
+                    self.build()
+            return
+        interval = getattr(settings, "XSLT_INDEX_CHECK_INTERVAL", 2)
+        if interval is not None and time.time() - self.checked >= interval:
+            with self.lock:
+                self.checked = time.time()
+                if self.changed():
+                    self.build()
+
+    def find(self, name):
+        """Return the filename of stylesheet 'name' or None."""
+        self.refresh()
+        return self.paths.get(name)
+
+    def page(self, namespace, page, pattern):
+        """Return the filename of the 'pattern' stylesheet for 'namespace' and 'page'."""
+        return self.find(pattern % (namespace, page))
+
+    def names(self):
+        self.refresh()
+        return self.paths.keys()
+
+    def reset(self):
+        with self.lock:
+            self.paths = None
+            self.mtimes = {}
+
+stylesheet_index = StylesheetIndex()
+
+def find_template(name):
+    """Return the filename of template 'name' or raise TemplateDoesNotExist."""
+    filename = stylesheet_index.find(name)
+    if filename is None:
+        raise TemplateDoesNotExist(name)
+    return filename
+
+
+class CachedLoader(object):
+    """Finds, compiles and caches templates."""
+    def __init__(self):
+        self.logger = logging.getLogger("xslt.loader.CachedLoader")
+        self.lock = threading.Lock()
+        # name -> (template, filename, mtime)
+        self.templates = {}
+
+    def get_template(self, name):
+        check_mtime = getattr(settings, "XSLT_TEMPLATE_CHECK_MTIME", settings.DEBUG)
+        cached = self.templates.get(name)
+        if cached:
+            template, filename, mtime = cached
+            if not check_mtime:
+                return template
+            try:
+                if os.stat(filename).st_mtime == mtime:
+                    return template
+            except OSError:
+                pass
+
+        filename = find_template(name)
+        mtime = os.stat(filename).st_mtime
+        self.logger.debug("compiling %s from %s" % (name, filename))
+        template = Template(TransformerFile(filename), name=name)
+        with self.lock:
+            self.templates[name] = (template, filename, mtime)
+        return template
+
+    def reset(self):
+        with self.lock:
+            self.templates = {}
+
+cached_loader = CachedLoader()
+
+def reset():
+    """Forget all the compiled templates and the stylesheet index."""
+    cached_loader.reset()
+    stylesheet_index.reset()
+
+def get_template(name):
+    """Return the compiled Template called 'name'."""
+    return cached_loader.get_template(name)
+
+def select_template(names):
+    """Return the first of the Templates called 'names' that exists."""
+    for name in names:
+        try:
+            return get_template(name)
+        except TemplateDoesNotExist:
+            continue
+    raise TemplateDoesNotExist(", ".join(names))
+
+def render_to_string(name, context=None, **params):
+    """Render the template 'name' (or a list of names) with 'context'."""
+    if isinstance(name, (list, tuple)):
+        template = select_template(name)
+    else:
+        template = get_template(name)
+    return template.render(context, **params)
+
+# End
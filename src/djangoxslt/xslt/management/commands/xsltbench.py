@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from optparse import make_option
+
+def intlist(value):
+    return tuple(int(v) for v in value.split(",") if v)
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--output', action='store', dest='output',
+            help='write the results as JSON to this file'),
+        make_option('--compare', action='store', dest='compare',
+            help='compare the results with this JSON baseline file'),
+        make_option('--threshold', action='store', dest='threshold',
+            type='float', default=0.1,
+            help='the fraction slower than baseline that counts as a regression'),
+        make_option('--only', action='store', dest='only', default='',
+            help='comma separated substrings of the benchmarks to run'),
+        make_option('--rows', action='store', dest='rows',
+            default='100,10000,100000',
+            help='comma separated row counts for the row benchmarks'),
+        make_option('--calls', action='store', dest='calls', default='10,100',
+            help='comma separated xdjango: call counts for the call benchmarks'),
+        make_option('--repeat', action='store', dest='repeat',
+            type='int', default=5,
+            help='the number of samples to take of each benchmark'),
+    )
+    help = 'Runs the XSLT engine microbenchmarks against an in-memory test database.'
+
+    requires_model_validation = False
+
+    def handle(self, *args, **options):
+        from django.conf import settings
+        from django.db import connection
+        from djangoxslt.xslt import benchmarks
+
+        verbosity = int(options.get('verbosity', 1))
+        baseline = None
+        if options.get('compare'):
+            baseline = benchmarks.load(options['compare'])
+
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = benchmarks.run(
+                only=[o for o in options['only'].split(",") if o],
+                log=(lambda line: self.stdout_write(line)) if verbosity else None,
+                rows=intlist(options['rows']),
+                calls=intlist(options['calls']),
+                repeat=options['repeat'],
+                )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options.get('output'):
+            benchmarks.save(results, options['output'])
+
+        if baseline:
+            regressions = []
+            for name, base, current, ratio, regressed in benchmarks.compare(
+                results, baseline, threshold=options['threshold']):
+                self.stdout_write("%-40s %12.6fms %12.6fms %6.2fx%s" % (
+                        name, base * 1000, current * 1000, ratio,
+                        " REGRESSED" if regressed else ""))
+                if regressed:
+                    regressions.append(name)
+            if regressions:
+                raise CommandError("%d benchmarks regressed: %s" % (
+                        len(regressions), ", ".join(regressions)))
+
+    def stdout_write(self, line):
+        print line
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--remove', action='store_true', dest='remove', default=False,
+            help='remove the bundles instead of making them'),
+    )
+    help = 'Flattens XSLT stylesheets and their includes and imports into bundles.'
+    args = '[template name or stylesheet file ...]'
+
+    requires_model_validation = False
+
+    def handle(self, *args, **options):
+        from djangoxslt.xslt import bundle
+        from djangoxslt.xslt import loader
+        from os.path import exists
+
+        names = args or sorted(
+            name for name in loader.stylesheet_index.names()
+            if name.endswith(".xslt"))
+        for name in names:
+            filename = name if exists(name) else loader.find_template(name)
+            if options['remove']:
+                bundle.remove(filename)
+                self.stdout_write("%-40s removed" % name)
+                continue
+            try:
+                manifest = bundle.bundle(filename)
+            except bundle.BundleError, e:
+                bundle.remove(filename)
+                self.stdout_write("%-40s not bundled: %s" % (name, e))
+            else:
+                self.stdout_write("%-40s bundled %d files, %d functions" % (
+                        name, len(manifest["files"]), len(manifest["functions"])))
+
+    def stdout_write(self, line):
+        print line
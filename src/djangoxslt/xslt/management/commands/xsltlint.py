@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--max-callbacks', action='store', dest='max_callbacks',
+            type='int', default=None,
+            help='fail if a stylesheet is estimated to make more callbacks per render'),
+        make_option('--max-findings', action='store', dest='max_findings',
+            type='int', default=None,
+            help='fail if a stylesheet has more findings'),
+        make_option('--loop-size', action='store', dest='loop_size',
+            type='int', default=None,
+            help='the iterations assumed for each loop'),
+        make_option('--queryset-rows', action='store', dest='queryset_rows',
+            type='int', default=None,
+            help='the rows assumed for each xdjango:queryset without a limit'),
+    )
+    help = 'Reports xdjango: calls in loops and estimates callbacks per render.'
+    args = '[template name or stylesheet file ...]'
+
+    requires_model_validation = False
+
+    def handle(self, *args, **options):
+        from django.conf import settings
+        from djangoxslt.xslt import lint
+        from djangoxslt.xslt import loader
+        from os.path import exists
+
+        max_callbacks = options['max_callbacks']
+        if max_callbacks is None:
+            max_callbacks = getattr(settings, "XSLT_LINT_MAX_CALLBACKS", None)
+        max_findings = options['max_findings']
+        if max_findings is None:
+            max_findings = getattr(settings, "XSLT_LINT_MAX_FINDINGS", None)
+
+        names = args or sorted(
+            name for name in loader.stylesheet_index.names()
+            if name.endswith(".xslt"))
+        failed = []
+        for name in names:
+            filename = name if exists(name) else loader.find_template(name)
+            report = lint.lint_file(
+                filename,
+                loop_size=options['loop_size'],
+                queryset_rows=options['queryset_rows'])
+            for line in report.lines():
+                self.stdout_write(line)
+            if (max_callbacks is not None and report.callbacks > max_callbacks) \
+                    or (max_findings is not None and len(report.findings) > max_findings):
+                failed.append(name)
+        if failed:
+            raise CommandError("%d stylesheets over the lint thresholds: %s" % (
+                    len(failed), ", ".join(failed)))
+
+    def stdout_write(self, line):
+        print line
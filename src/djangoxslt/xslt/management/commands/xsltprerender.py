@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--output', action='store', dest='output',
+            help='the directory to write the pages to'),
+        make_option('--namespace', action='store', dest='namespace', default='',
+            help='the page namespace, as passed to djangoxslt.xslt.views.page'),
+        make_option('--processes', action='store', dest='processes',
+            type='int', default=None,
+            help='the number of processes to render with (default: the CPU count)'),
+        make_option('--context', action='store', dest='context', default=None,
+            help='dotted name of a callable(request, page) returning extra context'),
+        make_option('--extension', action='store', dest='extension', default='.html',
+            help='the extension of the written files'),
+        make_option('--force', action='store_true', dest='force', default=False,
+            help='render pages even if they have not changed'),
+    )
+    help = 'Renders the XSLT pages matching XSLT_PAGE_PATTERN to static and gzipped files.'
+
+    def handle(self, *args, **options):
+        from djangoxslt.xslt import prerender
+
+        if not options.get('output'):
+            raise CommandError("--output is required")
+        verbosity = int(options.get('verbosity', 1))
+        results = prerender.prerender(
+            options['output'],
+            namespace=options['namespace'],
+            processes=options['processes'],
+            context=options['context'],
+            force=options['force'],
+            extension=options['extension'],
+            log=(lambda line: self.stdout_write(line)) if verbosity else None,
+            )
+        failed = [page for page, result in results.iteritems()
+                  if result not in ("rendered", "skipped")]
+        if failed:
+            raise CommandError("%d pages failed: %s" % (
+                    len(failed), ", ".join(sorted(failed))))
+
+    def stdout_write(self, line):
+        print line
@@ -3,13 +3,89 @@
 from django.db import models
 from django.template import Template
 from django.template import Context
+from lxml import etree
 import types
 
 class XPathRenderer(object):
-    """This is an interface for objects that have __xml__"""
+    """This is an interface for objects that have __xml__
+
+    Renderers can also have __xml_events__, returning an iterable of
+    events describing a single element:
+
+      ("start", tag, attrib)
+      ("data", text)
+      ("end", tag)
+
+    The attrib dict of a start event may be left out. When an object
+    has __xml_events__ it is used in preference to __xml__, the events
+    go straight into an lxml TreeBuilder so there is no XML string to
+    serialize and parse.
+    """
     def __xml__(self, *args):
         return ""
 
+def xml_events_element(events):
+    """Build the element described by the __xml_events__ 'events'."""
+    builder = etree.TreeBuilder()
+    for event in events:
+        kind = event[0]
+        if kind == "start":
+            builder.start(event[1], event[2] if len(event) > 2 else {})
+        elif kind == "data":
+            builder.data(event[1])
+        elif kind == "end":
+            builder.end(event[1])
+        else:
+            raise ValueError("unknown xml event %r" % (kind,))
+    return builder.close()
+
+def render_xml(obj, *args):
+    """Render 'obj' with __xml_events__ if it has it, else __xml__."""
+    events = getattr(obj, "__xml_events__", None)
+    if events is not None:
+        return xml_events_element(events(*args))
+    return obj.__xml__(*args)
+
+def has_xml(obj):
+    """Does 'obj' support either of the XML rendering protocols?"""
+    return hasattr(obj, "__xml_events__") or hasattr(obj, "__xml__")
+
+# The number of fragments joined into each chunk fed to the parser
+FRAGMENT_CHUNK = 1000
+
+def _wrapped_fragment(wrapper):
+    if len(wrapper) != 1 or (wrapper.text or "").strip() \
+            or (wrapper[0].tail or "").strip():
+        raise ValueError("fragment is not a single element")
+    return wrapper[0]
+
+def parse_fragments(fragments, chunk=FRAGMENT_CHUNK):
+    """Parse the XML strings 'fragments', returning a list of elements.
+
+    All the fragments are fed, each wrapped in a 'row' element, to one
+    incremental parser so there is a single parse rather than one per
+    fragment. If that fails (a fragment isn't well formed, isn't a
+    single element, has an XML declaration or str and unicode
+    fragments don't mix) each fragment is parsed on its own, so bad
+    fragments raise just as etree.XML does.
+    """
+    if not fragments:
+        return []
+    try:
+        parser = etree.XMLParser()
+        parser.feed("<rows><row>")
+        for start in xrange(0, len(fragments), chunk):
+            if start:
+                parser.feed("</row><row>")
+            parser.feed("</row><row>".join(fragments[start:start + chunk]))
+        parser.feed("</row></rows>")
+        root = parser.close()
+        if len(root) != len(fragments):
+            raise ValueError("fragment count changed")
+        return [_wrapped_fragment(wrapper) for wrapper in root]
+    except (etree.XMLSyntaxError, ValueError, UnicodeError):
+        return [etree.XML(fragment) for fragment in fragments]
+
 def xmlify(qs, use_values=True, **kwargs):
     """XML serializer for queryset qs using the template described in kwargs.
 
@@ -80,30 +156,34 @@ def xmlify(qs, use_values=True, **kwargs):
                             if getattr(value, 'is_text', False):
                                 text_fields.append(field)
                     else:
-                        row_result = row.__xml__()
+                        row_result = render_xml(row)
 
                     rows += [row_result]
 
             # Make a nice list of template outputed rows
-            from lxml import etree
             xmlname = captured_qs.model.__name__
             xmlroot = etree.Element("%ss" % xmlname.lower())
             #import pdb
             #pdb.set_trace()
+            if not template_list:
+                # Parse all the rows' XML strings in one go
+                strings = [record for record in rows if not etree.iselement(record)]
+                parsed = iter(parse_fragments(strings))
+                for record in rows:
+                    child = etree.SubElement(xmlroot, xmlname.lower())
+                    child.append(record if etree.iselement(record) else parsed.next())
+                return xmlroot
+
             for record in rows:
                 c = Context()
                 c.update(record)
                 child = etree.SubElement(xmlroot, xmlname.lower())
-                if template_list:
-                    for name,template in template_list:
-                        if name in text_fields:
-                            elem = etree.SubElement(child, name)
-                            elem.text = template.render(c)
-                        else:
-                            child.attrib[name] = template.render(c)
-                else:
-                    parsed = etree.XML(record)
-                    elem = child.append(parsed)
+                for name,template in template_list:
+                    if name in text_fields:
+                        elem = etree.SubElement(child, name)
+                        elem.text = template.render(c)
+                    else:
+                        child.attrib[name] = template.render(c)
 
             return xmlroot
                 
@@ -182,24 +262,61 @@ def xmlifyiter(iterator, name, **kwargs):
 
 from django.db.models.query import QuerySet
 class XmlQuerySet(QuerySet):
-    """A queryset that does xmlifying"""
+    """A queryset that does xmlifying.
+
+    'xml' returns a clone of the queryset with an xml spec, the kwargs
+    of an 'xmlify' call. Querysets with a spec support the __xml__
+    protocol, rendering themselves with 'xmlify'. The spec and
+    'use_values' are plain attributes, copied to every clone, so
+    further filtering keeps them:
+
+      qs = Person.objects.xml(username="user__username")
+      xmldata = qs.filter(age__gte=18).__xml__()
+    """
+    def __init__(self, model=None, query=None, use_values=True, xml_spec=None):
+        super(XmlQuerySet, self).__init__(model, query)
+        self.use_values = use_values
+        self._xml_spec = xml_spec
+        self._xml_cache = None
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        if klass is None or issubclass(klass, XmlQuerySet):
+            kwargs.setdefault("use_values", self.use_values)
+            kwargs.setdefault("_xml_spec", self._xml_spec)
+        return super(XmlQuerySet, self)._clone(klass, setup, **kwargs)
+
     def xml(self, **kwargs):
-        return xmlify(self, use_values=getattr(self, "use_values", True), **kwargs)
+        """Return a clone which renders with 'xmlify' and 'kwargs'."""
+        return self._clone(_xml_spec=kwargs)
 
     def xml_objects(self, **kwargs):
         """Don't do a values query. Use the full object instead."""
-        return xmlify(self, use_values=getattr(self, "use_values", False), **kwargs)
+        return self._clone(use_values=False, _xml_spec=kwargs)
+
+    @property
+    def __xml__(self):
+        # A property so that querysets without a spec don't have __xml__
+        if self._xml_spec is None:
+            raise AttributeError("__xml__")
+        return self._render_xml
+
+    def _render_xml(self, *args):
+        if self._xml_cache is None:
+            self._xml_cache = xmlify(
+                self, use_values=self.use_values, **self._xml_spec
+                ).__xml__(*args)
+        return self._xml_cache
 
 
 def monkey_qs(qs, use_values=True):
-    """Clone the queryset adding an 'xml' method.
+    """Clone the queryset as an XmlQuerySet, adding an 'xml' method.
 
     The 'xml' method works like 'xmlify', pass kwargs for rendering
     arguments and it returns an object which supports the __xml__
     protocol.
 
-    The objects returned from the 'xml' object attached with
-    'monkey_qs' are also querysets which can be further cloned.
+    The objects returned from the 'xml' method are also querysets
+    which can be further cloned.
 
     For example:
 
@@ -209,32 +326,11 @@ def monkey_qs(qs, use_values=True):
       qs4 = qs3.filter(age__gte=18)
       xmldata = qs4.__xml__()
     """
-    capturedclone = qs._clone
-
-    def baseclone(xml_closure):
-        newclone = capturedclone()
-        newclone.__xml__ = lambda *args: xml_closure.__xml__(*args)
-        newclone._clone = lambda: baseclone(xml_closure)
-        return newclone
-
-    def adapt(*args, **kwargs):
-        newclone = capturedclone(*args, **kwargs)
-        xml_protocol_obj = xmlify(qs, use_values=use_values, **kwargs)
-        newclone.__dict__["__xml__"] = lambda *args: xml_protocol_obj.__xml__(*args)
-        newclone.__dict__["_clone"] = lambda: baseclone(xml_protocol_obj)
-        return newclone
-
-    def xmlclone(selfarg, *args, **kwargs):
-        newclone = capturedclone(*args, **kwargs)
-        newclone.__dict__["xml"] = lambda *args,**kwargs: adapt(*args, **kwargs)
-        newclone.__dict__["use_values"] = use_values
-        newclone.__dict__["_clone"] = types.MethodType(xmlclone, selfarg, selfarg.__class__)
-        return newclone
-    return xmlclone(qs)
+    return qs._clone(klass=XmlQuerySet, use_values=use_values, _xml_spec=None)
 
 
 class RenderingManager(models.Manager):
-    """Use monkey_qs to decorate the queryset.
+    """A manager whose querysets are XmlQuerySets.
 
     This makes querysets that use values calls by default. To get a
     queryset that will render without using values create the manager
@@ -247,7 +343,9 @@ class RenderingManager(models.Manager):
         self.use_values = use_values
 
     def get_query_set(self):
-        qs = super(RenderingManager, self).get_query_set()
-        return monkey_qs(qs)
+        return XmlQuerySet(self.model, use_values=self.use_values)
+
+    def xml(self, **kwargs):
+        return self.get_query_set().xml(**kwargs)
 
 # End
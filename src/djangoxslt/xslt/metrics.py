@@ -0,0 +1,181 @@
+# Metrics
+from __future__ import with_statement
+
+"""Metrics for the XSLT engine.
+
+The engine reports, per stylesheet:
+
+ * compile.NAME          timing, compiling the stylesheet
+ * transform.NAME        timing, running a transform
+ * callbacks.NAME        histogram, xdjango: calls made by a transform
+ * callback_time.NAME    timing, time spent in those calls
+ * queryset_rows.NAME    histogram, rows looped over by xdjango:queryset
+ * prefetch.NAME         timing, prefetching context variables (see the
+                         prefetch module)
+ * output_bytes.NAME     histogram, size of the transform output
+ * pipeline.NAME         timing, running a pipeline (see the pipeline
+                         module), NAME is the pipeline's name
+ * degraded.NAME         counter, transforms which ran out of their
+                         budget (see engine.RenderDeadline)
+ * degraded_calls.NAME   histogram, xdjango: calls a degraded transform
+                         answered with fallbacks or stale values
+
+where NAME is the transformer's name (the stylesheet file name for
+TransformerFile).
+
+The metrics go to a sink, which is configured in settings with
+XSLT_METRICS_SINK, either a sink object or the dotted name of a
+callable that returns one:
+
+  XSLT_METRICS_SINK = "djangoxslt.xslt.metrics.StatsdSink"
+
+or set with 'set_sink'. When there is no sink (the default) the engine
+doesn't collect anything.
+"""
+
+from django.conf import settings
+
+import threading
+import socket
+import logging
+import re
+
+class MetricsSink(object):
+    """The interface for metrics sinks.
+
+    Times are in seconds.
+    """
+    def timing(self, name, seconds):
+        pass
+
+    def histogram(self, name, value):
+        pass
+
+    def incr(self, name, count=1):
+        pass
+
+
+class Stats(object):
+    """Aggregated values of one metric.
+
+    'buckets' maps power of 2 upper bounds to the number of values that
+    fell in the bucket.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        bound = 1
+        while bound < value:
+            bound *= 2
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+    @property
+    def mean(self):
+        return self.total / float(self.count) if self.count else 0.0
+
+
+class AggregatingSink(MetricsSink):
+    """A sink which aggregates the metrics in process.
+
+    Timings are aggregated in milliseconds.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _add(self, name, value):
+        with self.lock:
+            stats = self.metrics.get(name)
+            if stats is None:
+                stats = self.metrics[name] = Stats()
+            stats.add(value)
+
+    def timing(self, name, seconds):
+        self._add(name, seconds * 1000)
+
+    def histogram(self, name, value):
+        self._add(name, value)
+
+    def incr(self, name, count=1):
+        self._add(name, count)
+
+    def get(self, name):
+        return self.metrics.get(name)
+
+    def reset(self):
+        with self.lock:
+            self.metrics = {}
+
+
+class StatsdSink(MetricsSink):
+    """A sink which sends the metrics to statsd over UDP.
+
+    The defaults come from settings XSLT_STATSD_HOST (localhost),
+    XSLT_STATSD_PORT (8125) and XSLT_STATSD_PREFIX (xslt).
+
+    Sending is best effort, socket errors are logged and dropped.
+    """
+    def __init__(self, host=None, port=None, prefix=None):
+        self.logger = logging.getLogger("xslt.metrics.StatsdSink")
+        self.address = (
+            host or getattr(settings, "XSLT_STATSD_HOST", "localhost"),
+            port or getattr(settings, "XSLT_STATSD_PORT", 8125))
+        self.prefix = prefix if prefix is not None \
+            else getattr(settings, "XSLT_STATSD_PREFIX", "xslt")
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind):
+        data = "%s%s:%s|%s" % (
+            "%s." % self.prefix if self.prefix else "", name, value, kind)
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error, e:
+            self.logger.debug("couldn't send %s %s" % (data, e))
+
+    def timing(self, name, seconds):
+        self._send(name, "%.3f" % (seconds * 1000), "ms")
+
+    def histogram(self, name, value):
+        self._send(name, value, "h")
+
+    def incr(self, name, count=1):
+        self._send(name, count, "c")
+
+
+# The configured sink
+
+_UNSET = object()
+_sink = _UNSET
+
+def sink():
+    """Return the configured sink or None if metrics are disabled."""
+    global _sink
+    if _sink is _UNSET:
+        configured = getattr(settings, "XSLT_METRICS_SINK", None)
+        if isinstance(configured, basestring):
+            from engine import dotted_import
+            configured = dotted_import(configured)()
+        _sink = configured
+    return _sink
+
+def set_sink(new_sink):
+    """Set the sink, None disables metrics."""
+    global _sink
+    _sink = new_sink
+
+METRIC_NAME_RE = re.compile(r"[^A-Za-z0-9_-]+")
+
+def metric_name(name):
+    """Make 'name' safe for use as a part of a metric name."""
+    return METRIC_NAME_RE.sub("_", name)
+
+# End
@@ -0,0 +1,104 @@
+# Transform pipelines
+from __future__ import with_statement
+
+"""Chain transforms, passing result trees rather than strings.
+
+Pages made by more than one transform, a content pass then a layout
+pass say, would serialize the output of each transform for the next
+one to parse. A Pipeline passes the lxml result tree of each stage
+straight to the next and only serializes the last:
+
+  from djangoxslt.xslt import loader
+  from djangoxslt.xslt.pipeline import Pipeline
+
+  pages = Pipeline(
+      loader.get_template("content.xslt"),
+      loader.get_template("layout.xslt"),
+      name="page")
+  html = pages(context=context)
+
+Every stage is run with the same context and params. The output of a
+stage other than the last must be a document, not text. In DEBUG a
+stage that fails returns the error document, which ends the run.
+
+'run' returns a PipelineResult with the time each stage took. The
+total time goes to the pipeline.NAME metric; the stages report their
+own transform metrics as usual.
+"""
+
+from lxml import etree
+
+import logging
+import time
+
+import metrics
+
+class PipelineResult(object):
+    """The result tree of a pipeline run and the time each stage took.
+
+    'timings' is a list of (stage name, seconds). str() serializes the
+    tree as the last stage's xsl:output says, or the error document
+    of a stage that failed in DEBUG.
+    """
+    def __init__(self, tree, timings):
+        self.tree = tree
+        self.timings = timings
+
+    @property
+    def total(self):
+        return sum(seconds for name, seconds in self.timings)
+
+    def __str__(self):
+        if isinstance(self.tree, etree._XSLTResultTree):
+            return str(self.tree)
+        return etree.tostring(self.tree)
+
+    def summary(self):
+        """A one line summary of the stage times."""
+        return "; ".join("%s time=%.3fms" % (name, seconds * 1000)
+                         for name, seconds in self.timings)
+
+
+class Pipeline(object):
+    """A chain of transformers, each transforming the output of the last.
+
+    The stages are Transformers or Templates.
+    """
+    def __init__(self, *stages, **kwargs):
+        self.logger = logging.getLogger("xslt.Pipeline")
+        if not stages:
+            raise ValueError("a pipeline needs a stage")
+        self.stages = [getattr(stage, "transformer", stage) for stage in stages]
+        self.name = metrics.metric_name(
+            kwargs.get("name") or "-".join(stage.name for stage in self.stages))
+
+    def run(self, doc=None, context=None, **params):
+        """Run the stages on 'doc' with 'context' and return a PipelineResult.
+
+        'doc' is the first stage's input, as for Transformer.__call__,
+        and 'context' a Context or a dict.
+        """
+        from django.template import Context
+        if not isinstance(context, Context):
+            context = Context(context)
+        timings = []
+        start = time.time()
+        for stage in self.stages:
+            stage_start = time.time()
+            doc = stage.tree(doc, context=context, **params)
+            timings.append((stage.name, time.time() - stage_start))
+            if not isinstance(doc, etree._XSLTResultTree):
+                # The error document of a failed stage
+                break
+        result = PipelineResult(doc, timings)
+        sink = metrics.sink()
+        if sink is not None:
+            sink.timing("pipeline.%s" % self.name, time.time() - start)
+        self.logger.debug("%s %s" % (self.name, result.summary()))
+        return result
+
+    def __call__(self, doc=None, context=None, **params):
+        """Run the stages and return the output string."""
+        return str(self.run(doc, context, **params))
+
+# End
@@ -0,0 +1,195 @@
+# Context prefetching
+from __future__ import with_statement
+
+"""Evaluate the context variables a stylesheet uses before transforming.
+
+Views put querysets and xmlify objects in the context and the
+transform evaluates them one after another as it reaches them. With
+'prefetch' workers (the Transformer argument or
+settings.XSLT_PREFETCH_WORKERS) Transformer.__call__ first evaluates
+all of them at once on a pool of threads, each thread with its own
+database connection, and pushes the results onto the context for the
+transform:
+
+ * the queryset of an xdjango:queryset element with a limit is
+   replaced by the list of its first 'limit' rows
+ * other querysets have their result cache filled
+ * objects with __xml__ or __xml_events__ are rendered (with no
+   arguments) and replaced by a Prefetched object returning the
+   rendered element
+
+So the wait is about as long as the slowest variable rather than all
+of them added up. Only variables used with top level names, like
+xdjango:people() or key="people", are prefetched. The names are
+looked up in the context without calling anything, so callables and
+variables of other types are left for the transform, as are variables
+that fail to evaluate, so their errors are reported as usual.
+
+The pool threads' connections can't see the changes the request has
+made but not yet committed, in a managed transaction. Once Django
+knows of such changes (transaction.is_dirty(), which writes through
+the ORM set) the variables are evaluated in the calling thread, as
+they are with an in-memory sqlite database whose tables other threads
+can't see. Writes with a raw cursor don't set it: commit them, or
+don't prefetch, before transforming.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.query import QuerySet
+
+from multiprocessing.pool import ThreadPool
+import threading
+import logging
+import time
+
+from managers import render_xml
+from managers import has_xml
+import metrics
+
+QUERYSET = "queryset"
+CALL = "call"
+
+class Prefetched(object):
+    """A context object whose __xml__ was rendered by the prefetch.
+
+    Anything but a call of __xml__ with no arguments goes to the
+    original object.
+    """
+    def __init__(self, obj, xml):
+        self._prefetched_obj = obj
+        self._prefetched_xml = xml
+
+    def __xml__(self, *args):
+        if args:
+            return render_xml(self._prefetched_obj, *args)
+        return self._prefetched_xml
+
+    def __getattr__(self, name):
+        # Our __xml__ must be used, not the original's events
+        if name == "__xml_events__":
+            raise AttributeError(name)
+        return getattr(self._prefetched_obj, name)
+
+    def __getitem__(self, key):
+        return self._prefetched_obj[key]
+
+    def __iter__(self):
+        return iter(self._prefetched_obj)
+
+
+def references(xslt_doc, functions, namespace):
+    """Return {name: (kind, limit)} of the prefetchable variables of 'xslt_doc'.
+
+    'functions' are the names of the xdjango: functions the
+    stylesheet calls and 'namespace' the xdjango: namespace. A
+    variable used both ways is prefetched as a CALL.
+    """
+    found = {}
+    for queryset in xslt_doc.iter("{%s}queryset" % namespace):
+        key = queryset.get("key")
+        if key and "." not in key:
+            limit = queryset.get("limit")
+            limit = int(limit) if limit else None
+            if key in found and found[key][1] != limit:
+                # Used with different limits, fill the whole queryset
+                limit = None
+            found[key] = (QUERYSET, limit)
+    for name in functions:
+        if "." not in name:
+            found[name] = (CALL, None)
+    return found
+
+def evaluate(context, name, kind, limit=None):
+    """Return the prefetched value of 'name' or None if it isn't prefetchable.
+
+    Only querysets and objects with __xml__ or __xml_events__ are
+    evaluated; nothing else in the context is called.
+    """
+    try:
+        value = context[name]
+    except KeyError:
+        return None
+    if kind == QUERYSET and isinstance(value, QuerySet):
+        if limit is not None:
+            return list(value[:limit])
+        len(value)
+        return value
+    if has_xml(value):
+        return Prefetched(value, render_xml(value))
+    if isinstance(value, QuerySet):
+        len(value)
+        return value
+    return None
+
+def _evaluate_logged(context, name, kind, limit):
+    try:
+        return evaluate(context, name, kind, limit)
+    except Exception, e:
+        logging.getLogger("xslt.prefetch").debug(
+            "couldn't prefetch %s %s %s" % (name, e.__class__.__name__, e))
+        return None
+
+def _evaluate_job(job):
+    from django.db import connection
+    try:
+        return _evaluate_logged(*job)
+    finally:
+        # Pool threads outlive requests, don't keep their connections open
+        connection.close()
+
+
+def threads_share_database():
+    """Can pool threads see the calling thread's database?"""
+    return not (settings.DATABASE_ENGINE == "sqlite3"
+                and settings.DATABASE_NAME in ("", ":memory:"))
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _pool(workers):
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = ThreadPool(workers)
+        return pool
+
+def prefetch(context, refs, workers, threads=None):
+    """Return {name: value} for the 'refs' variables of 'context'.
+
+    'refs' is from 'references'. The variables are evaluated on a pool
+    of 'workers' threads, or in the calling thread if 'threads' is
+    false; the default is to use threads unless
+    threads_share_database says they can't or the calling thread's
+    transaction has changes other connections can't see yet.
+    """
+    jobs = [(context, name, kind, limit) for name, (kind, limit) in refs.iteritems()]
+    if threads is None:
+        threads = threads_share_database() and not transaction.is_dirty()
+    if threads and workers > 1 and len(jobs) > 1:
+        values = _pool(workers).map(_evaluate_job, jobs)
+    else:
+        values = [_evaluate_logged(*job) for job in jobs]
+    return dict((job[1], value) for job, value in zip(jobs, values)
+                if value is not None)
+
+def push(context, refs, workers, name="string"):
+    """Push the prefetched 'refs' variables onto 'context'.
+
+    Returns true if a dict was pushed, which the caller must pop
+    after the transform. Transformer 'name' labels the prefetch.NAME
+    timing.
+    """
+    if not refs or not hasattr(context, "update") or isinstance(context, dict):
+        return False
+    start = time.time()
+    values = prefetch(context, refs, workers)
+    sink = metrics.sink()
+    if sink is not None:
+        sink.timing("prefetch.%s" % name, time.time() - start)
+    if not values:
+        return False
+    context.update(values)
+    return True
+
+# End
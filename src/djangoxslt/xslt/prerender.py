@@ -0,0 +1,232 @@
+# Offline page rendering
+from __future__ import with_statement
+
+"""Render views.page pages to static files.
+
+Pages whose stylesheets don't depend on the request can be rendered
+at deploy time and served by the web server. The pages are the
+stylesheets the loader finds (so the ones views.page serves) whose
+names match settings.XSLT_PAGE_PATTERN for the namespace; each one is
+rendered by
+calling views.page with a request for "/PAGE/" and written, with a
+gzipped copy, to the output directory:
+
+  OUTPUT/PAGE.html
+  OUTPUT/PAGE.html.gz
+
+The request's context can be extended with a callable, named with
+settings.XSLT_PRERENDER_CONTEXT or passed to 'prerender', which is
+called with the request and the page and returns a dict passed to
+views.page as extra context.
+
+A page is skipped when its dependency hash, over the stylesheet and
+the files it includes, imports or reads with a literal document()
+call, is the one recorded in OUTPUT/manifest.json by the last run and
+its output files exist.
+"""
+
+from django.conf import settings
+from django.http import HttpRequest
+from django.utils import simplejson as json
+
+from lxml import etree
+from os.path import join
+from os.path import dirname
+from os.path import basename
+from os.path import exists
+from os.path import isabs
+import multiprocessing
+import hashlib
+import gzip
+import os
+import re
+
+import views
+import loader
+
+MANIFEST = "manifest.json"
+EXTENSION = ".html"
+
+XSLT = {"xsl": "http://www.w3.org/1999/XSL/Transform"}
+DOCUMENT_RE = re.compile(r"""document\(\s*['"]([^'"]+)['"]""")
+
+def page_pattern_re(namespace, pattern=None):
+    """A regex matching stylesheet names of 'namespace' pages, the page in group 1."""
+    if pattern is None:
+        pattern = getattr(settings, "XSLT_PAGE_PATTERN", views.DEFAULT_PAGE_PATTERN)
+    marker = "\0"
+    prefix, suffix = (pattern % (namespace, marker)).split(marker)
+    return re.compile("^%s(.+)%s$" % (re.escape(prefix), re.escape(suffix)))
+
+def pages(namespace=views.DEFAULT_PAGE_NAMESPACE, pattern=None):
+    """Return a sorted list of (page, filename) for the namespace's pages.
+
+    The pages are looked up like views.page does, with the loader, so
+    'filename' is the stylesheet the view would render.
+    """
+    page_re = page_pattern_re(namespace, pattern)
+    found = []
+    for name in loader.stylesheet_index.names():
+        m = page_re.match(name)
+        if m:
+            found.append((m.group(1), loader.find_template(name)))
+    return sorted(found)
+
+def dependencies(filename, seen=None):
+    """Return the files 'filename' depends on, itself first.
+
+    Dependencies are xsl:include and xsl:import hrefs and literal
+    document() arguments. Files that can't be read are still listed.
+    """
+    seen = seen if seen is not None else []
+    if filename in seen:
+        return seen
+    seen.append(filename)
+    try:
+        doc = etree.parse(filename)
+    except (IOError, etree.XMLSyntaxError):
+        return seen
+    hrefs = doc.xpath("/xsl:stylesheet/xsl:include/@href|/xsl:stylesheet/xsl:import/@href",
+                      namespaces=XSLT)
+    for attribute in doc.xpath("//@*"):
+        hrefs.extend(DOCUMENT_RE.findall(attribute))
+    for href in hrefs:
+        if ":" in href.split("/")[0]:
+            # django:, querydirect: and remote documents aren't files
+            continue
+        dependencies(href if isabs(href) else join(dirname(filename), href), seen)
+    return seen
+
+def dependency_hash(filename, extra=""):
+    """The sha1 of 'filename' and its dependencies (and 'extra')."""
+    digest = hashlib.sha1(extra)
+    for path in dependencies(filename):
+        digest.update(path)
+        try:
+            with open(path) as fd:
+                digest.update(fd.read())
+        except IOError:
+            digest.update("\0missing")
+    return digest.hexdigest()
+
+def page_request(page):
+    """A GET request for 'page', as views.page is normally called."""
+    from django.contrib.auth.models import AnonymousUser
+    request = HttpRequest()
+    request.method = "GET"
+    request.path = request.path_info = "/%s/" % page
+    request.META = {
+        "SERVER_NAME": getattr(settings, "XSLT_PRERENDER_HOST", "localhost"),
+        "SERVER_PORT": "80",
+        }
+    request.user = AnonymousUser()
+    return request
+
+def _context_func(context):
+    if context is None:
+        context = getattr(settings, "XSLT_PRERENDER_CONTEXT", None)
+    if isinstance(context, basestring):
+        from engine import dotted_import
+        context = dotted_import(context)
+    return context
+
+def render_page(page, namespace=views.DEFAULT_PAGE_NAMESPACE, context=None):
+    """Render 'page' with views.page and return the output."""
+    request = page_request(page)
+    context = _context_func(context)
+    extra = context(request, page) if context else {}
+    return views.page(request, page, namespace=namespace, **extra).content
+
+def write_page(output, page, content, extension=EXTENSION):
+    """Write 'content' and a gzipped copy for 'page' under 'output'."""
+    filename = join(output, page + extension)
+    if not exists(dirname(filename)):
+        os.makedirs(dirname(filename))
+    with open(filename, "wb") as fd:
+        fd.write(content)
+    # mtime 0 so unchanged content gives identical .gz files
+    with open(filename + ".gz", "wb") as fd:
+        gz = gzip.GzipFile(basename(filename), "wb", 9, fd, mtime=0)
+        try:
+            gz.write(content)
+        finally:
+            gz.close()
+    return filename
+
+def _init_worker():
+    # Don't share the parent's database connection
+    from django.db import connection
+    connection.close()
+
+def _render_job(job):
+    output, page, namespace, context, extension = job
+    try:
+        content = render_page(page, namespace, context)
+        write_page(output, page, content, extension)
+        return page, None
+    except Exception, e:
+        return page, "%s: %s" % (e.__class__.__name__, e)
+
+def prerender(output, namespace=views.DEFAULT_PAGE_NAMESPACE, processes=None,
+              context=None, force=False, extension=EXTENSION, log=None):
+    """Render the 'namespace' pages to 'output'.
+
+    'processes' is the size of the process pool, the default is the
+    number of CPUs; 1 renders in this process. 'context' is a callable,
+    or its dotted name, returning extra context for a request and a
+    page (settings.XSLT_PRERENDER_CONTEXT by default); it must be a
+    dotted name to be used by the pool. Pages which haven't changed
+    are skipped unless 'force' is true. 'log' is an optional callable
+    passed a line per page.
+
+    Returns a dict of page -> "rendered", "skipped" or the error.
+    """
+    if not exists(output):
+        os.makedirs(output)
+    manifest_file = join(output, MANIFEST)
+    manifest = {}
+    if exists(manifest_file):
+        with open(manifest_file) as fd:
+            manifest = json.load(fd)
+
+    if context is None:
+        context = getattr(settings, "XSLT_PRERENDER_CONTEXT", None)
+    extra = "%s\0%s\0%s" % (namespace, extension, context if isinstance(context, basestring) else "")
+    results = {}
+    hashes = {}
+    jobs = []
+    for page, filename in pages(namespace):
+        hashes[page] = dependency_hash(filename, extra)
+        outfile = join(output, page + extension)
+        if not force and manifest.get(page) == hashes[page] \
+                and exists(outfile) and exists(outfile + ".gz"):
+            results[page] = "skipped"
+            continue
+        jobs.append((output, page, namespace, context, extension))
+
+    processes = processes or multiprocessing.cpu_count()
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes, _init_worker)
+        try:
+            rendered = pool.map(_render_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        rendered = [_render_job(job) for job in jobs]
+
+    for page, error in rendered:
+        results[page] = error or "rendered"
+        if error:
+            manifest.pop(page, None)
+        else:
+            manifest[page] = hashes[page]
+    with open(manifest_file, "w") as fd:
+        json.dump(manifest, fd, indent=2, sort_keys=True)
+
+    if log:
+        for page in sorted(results):
+            log("%-40s %s" % (page, results[page]))
+    return results
+
+# End
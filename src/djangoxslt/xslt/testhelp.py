@@ -1,9 +1,46 @@
 from lxml import etree
 from StringIO import StringIO
+import hashlib
+
+from cache import LRUCache
 
 # This is used as a parsed-XML cache
-# We put all the content we parse here keyed by content
-XMLCACHE={}
+# We put the documents we parse here keyed by a digest of the content
+XMLCACHE_SIZE = 100
+XMLCACHE = LRUCache(XMLCACHE_SIZE)
+
+# Compiled XPath expressions keyed by expression and namespaces
+XPATHCACHE_SIZE = 1000
+XPATHCACHE = LRUCache(XPATHCACHE_SIZE)
+
+def _document(xml, html=False):
+    """Return the parsed 'xml' document, from the cache if possible."""
+    content = xml.encode("utf-8") if isinstance(xml, unicode) else xml
+    key = (hashlib.sha1(content).hexdigest(), html)
+    doc = XMLCACHE.get(key)
+    if doc is None:
+        parser = etree.HTMLParser() if html else etree.XMLParser()
+        doc = etree.parse(StringIO(xml), parser)
+        XMLCACHE[key] = doc
+    return doc
+
+def _xpath(xpr, namespaces=None):
+    """Return the compiled XPath for 'xpr', from the cache if possible."""
+    key = (xpr, tuple(sorted(namespaces.items())) if namespaces else ())
+    compiled = XPATHCACHE.get(key)
+    if compiled is None:
+        compiled = etree.XPath(xpr, namespaces=namespaces) \
+            if namespaces else etree.XPath(xpr)
+        XPATHCACHE[key] = compiled
+    return compiled
+
+def _failure(doc, xpr, assertion_message="", namespaces=None):
+    """Return the failure message if 'xpr' doesn't eval against 'doc'."""
+    ret = _xpath(xpr, namespaces)(doc)
+    if not ret:
+        return assertion_message \
+            if assertion_message \
+            else "{%s} did not evaluate with the specified document" % xpr
 
 def assertXpath(xml, xpr, assertion_message="", namespaces=None, html=False):
     """Assert the Xpath 'xpr' evals against the 'xml' document.
@@ -12,22 +49,27 @@ def assertXpath(xml, xpr, assertion_message="", namespaces=None, html=False):
     namespaces can be specified as a list of namespace key:url pairs to be passed to XSLT
     html is boolean to specify whether to parse the document as HTML or not.
     """
+    failure = _failure(_document(xml, html), xpr, assertion_message, namespaces)
+    if failure:
+        raise AssertionError(failure)
+
+def assertXpaths(xml, xprs, namespaces=None, html=False):
+    """Assert all the Xpaths in 'xprs' eval against the 'xml' document.
 
-    namespaces = {} if not namespaces else namespaces
-    try:
-        doc = XMLCACHE.get(xml)
-        if not doc:
-            parser = etree.HTMLParser() if html else etree.XMLParser()
-            doc = etree.parse(StringIO(xml), parser)
-            XMLCACHE[xml] = doc
-    except Exception, e:
-        raise e
-    else:
-        ret = doc.xpath(xpr, namespaces=namespaces) if namespaces else doc.xpath(xpr)
-        if not ret:
-            assertion_message = assertion_message \
-                if assertion_message \
-                else "{%s} did not evaluate with the specified document" % xpr
-            raise AssertionError(assertion_message)
+    The document is parsed once. Each of 'xprs' is either an XPath or
+    an (XPath, assertion_message) pair. All the Xpaths are evaluated
+    and the failures reported together.
+
+    namespaces and html are as for assertXpath.
+    """
+    doc = _document(xml, html)
+    failures = []
+    for xpr in xprs:
+        xpr, assertion_message = xpr if isinstance(xpr, tuple) else (xpr, "")
+        failure = _failure(doc, xpr, assertion_message, namespaces)
+        if failure:
+            failures.append(failure)
+    if failures:
+        raise AssertionError("\n".join(failures))
 
 # End        
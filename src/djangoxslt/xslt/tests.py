@@ -6,11 +6,14 @@ import time
 import re
 from django.template import Context
 from testhelp import assertXpath
+from testhelp import assertXpaths
 from unittest import TestCase
 from djangoxslt import xslt
 import logging
 logging.basicConfig()
 
+XHTML = {"xhtml": "http://www.w3.org/1999/xhtml"}
+
 BLANK = """<?xml version="1.0" encoding="utf-8"?>
 <xsl:stylesheet  version="1.0" 
                  xmlns="http://www.w3.org/1999/xhtml"
@@ -54,6 +57,47 @@ class DjangoContextFuncTest(TestCase):
         result = self.func(u"téstv☃al")
         assert result == u'☃☃☃☃☃'
 
+    def test_nodes(self):
+        from lxml import etree
+        value = [{"name": "nic", "age": 40, "tags": ["a", "b"]}]
+        result = self.func.nodes(value, "people", "person", "attributes")
+        assertXpaths(etree.tostring(result[0]), [
+                '/people/person[@name="nic"][@age="40"]',
+                '/people/person/tags/person[1][.="a"]',
+                '/people/person/tags/person[2][.="b"]',
+                ])
+
+    def test_nodes_defaults(self):
+        from lxml import etree
+        value = {"first name": u"sí", "ok": True, "none": None}
+        result = self.func.nodes(value)
+        assertXpaths(etree.tostring(result[0]), [
+                u'/testfunc/item[@name="first name"][.="sí"]',
+                '/testfunc/ok[.="true"]',
+                '/testfunc/none[not(node())]',
+                ])
+
+    def test_nodes_keys(self):
+        from lxml import etree
+        value = {1: "a", "": "b", "\xc3\xa9t\xc3\xa9": "c"}
+        result = self.func.nodes(value, "keys")
+        assertXpaths(etree.tostring(result[0], encoding="utf-8"), [
+                '/keys/item[@name="1"][.="a"]',
+                '/keys/item[@name=""][.="b"]',
+                u'/keys/été[.="c"]',
+                ])
+
+    def test_nodes_attribute_keys(self):
+        from lxml import etree
+        value = {1: "a", "first name": "b", "": "c", "ok": 2}
+        result = self.func.nodes(value, "keys", "item", "attributes")
+        assertXpaths(etree.tostring(result[0]), [
+                '/keys[@ok="2"]',
+                '/keys/item[@name="1"][.="a"]',
+                '/keys/item[@name="first name"][.="b"]',
+                '/keys/item[@name=""][.="c"]',
+                ])
+
     def tearDown(self):
         xslt.djangothread.context = None
 
@@ -71,6 +115,31 @@ class XSLTTest(TestCase):
         response = self.client.get("/testtransform/simplepage/")
         self.assertEquals(response.status_code, 200)
         # We should really assert some xpath things about it.
+
+    def test_missing_page(self):
+        """Test that pages without an XSLT are 404s."""
+        from django.http import HttpRequest
+        from django.http import Http404
+        from djangoxslt.xslt import views
+        self.assertRaises(
+            Http404,
+            views.page, HttpRequest(), "nosuchpage", namespace="testtransform_")
+
+    def test_profile_header(self):
+        """Test that profiled pages report the profile in DEBUG."""
+        from django.conf import settings
+        debug = settings.DEBUG
+        settings.DEBUG = settings.XSLT_PROFILE = True
+        # Profiling is set when the template is compiled
+        loader.reset()
+        try:
+            response = self.client.get("/testtransform/simplepage/")
+        finally:
+            settings.DEBUG = debug
+            del settings.XSLT_PROFILE
+            loader.reset()
+        self.assertEquals(response.status_code, 200)
+        self.assert_("match=/" in response["X-XSLT-Profile"])
         
 from djangoxslt.xslt import managers as xsltmanagers
 
@@ -122,6 +191,86 @@ class IterableTest(TestCase):
             '//simples/simple[@attriba="%s"]' % 10
             )
 
+class EventsRenderer(object):
+    """A renderer with both protocols, __xml_events__ should win."""
+    def __init__(self, names):
+        self.names = names
+
+    def __xml__(self, *args):
+        return "<wrong/>"
+
+    def __xml_events__(self, *args):
+        yield ("start", "names", {"count": str(len(self.names))})
+        for name in self.names:
+            yield ("start", "name")
+            yield ("data", name)
+            yield ("end", "name")
+        yield ("end", "names")
+
+class XmlEventsTestCase(TestCase):
+    def test_events_element(self):
+        from lxml import etree
+        el = xsltmanagers.xml_events_element(EventsRenderer(["a", "b"]).__xml_events__())
+        self.assertEquals(
+            etree.tostring(el),
+            '<names count="2"><name>a</name><name>b</name></names>')
+
+    def test_unknown_event(self):
+        self.assertRaises(
+            ValueError,
+            xsltmanagers.xml_events_element, [("start", "a"), ("comment", "x")])
+
+    def test_transform(self):
+        transformer = xslt.Transformer(BLANK % """
+        <xsl:copy-of select="xdjango:renderer()"/>
+        """)
+        res = transformer(context=Context({"renderer": EventsRenderer(["a", "b"])}))
+        assertXpaths(res, [
+                '//names[@count="2"]/name[2][.="b"]',
+                'not(//wrong)',
+                ])
+
+    def test_xmlify(self):
+        from models import XSLTTestModel
+        name = "events%d" % int(time.time() * 1000)
+        XSLTTestModel(name=name, about="about", count=1).save()
+        XSLTTestModel.__xml_events__ = lambda self: iter([
+                ("start", "events"), ("data", self.name), ("end", "events")])
+        try:
+            qs = XSLTTestModel.objects.filter(name=name)
+            xml = xsltmanagers.xmlify(qs, use_values=False).__xml__()
+        finally:
+            del XSLTTestModel.__xml_events__
+        from lxml import etree
+        assertXpath(
+            etree.tostring(xml),
+            '/xslttestmodels/xslttestmodel/events[.="%s"]' % name)
+
+class ParseFragmentsTestCase(TestCase):
+    def test_parse(self):
+        from lxml import etree
+        parsed = xsltmanagers.parse_fragments(
+            ["<a>1</a>", u"<b x='sí'/>", "<c><d/></c>"], chunk=2)
+        self.assertEquals(
+            [etree.tostring(el) for el in parsed[::2]],
+            ["<a>1</a>", "<c><d/></c>"])
+        self.assertEquals(parsed[1].get("x"), u"sí")
+
+    def test_fallback(self):
+        """Fragments the batch can't take are parsed one at a time."""
+        parsed = xsltmanagers.parse_fragments(
+            ['<?xml version="1.0"?><a/>', "<b/>"])
+        self.assertEquals([el.tag for el in parsed], ["a", "b"])
+
+    def test_bad_fragment(self):
+        from lxml import etree
+        self.assertRaises(
+            etree.XMLSyntaxError,
+            xsltmanagers.parse_fragments, ["<a/>", "<b>"])
+        self.assertRaises(
+            etree.XMLSyntaxError,
+            xsltmanagers.parse_fragments, ["<a/><b/>"])
+
 class QSRenderTestCase(TestCase):
     def setUp(self):
         super(QSRenderTestCase, self).setUp()
@@ -332,19 +481,20 @@ class QSRenderTestCase(TestCase):
         qs = base_qs.filter(count__lte=12)
 
         # Check it has the xml method
-        self.assert_("xml" in qs.__dict__)
+        self.assert_(hasattr(qs, "xml"))
+        self.failIf(hasattr(qs, "__xml__"))
 
         # Call the 'xml' method to store the xml to be generated and return a new qs
         qs_from_xml = qs.xml(name="name",  about_text="about", count="count")
 
         # Check it has the __xml__ method
-        self.assert_("__xml__" in qs_from_xml.__dict__)
+        self.assert_(hasattr(qs_from_xml, "__xml__"))
 
         # Make another qs from the 'xml' decorated one
         selected = qs_from_xml.filter(count__lte=3)
 
         # Check the sub-queryset has the __xml__ method
-        self.assert_("__xml__" in selected.__dict__)
+        self.assert_(hasattr(selected, "__xml__"))
 
         xml_result = _qs_eval_helper(selected)
         self.assert_(re.search(""" name="name%s"[ /]""" % self.time, xml_result))
@@ -360,9 +510,29 @@ class QSRenderTestCase(TestCase):
             '//xslttestmodels/xslttestmodel[@about_text="about%s"]' % self.time,
             )
 
-        ##### TODO!!!!
-        ### need to assert we have the RIGHT number of xslttestmodel objects
-        ### it should be 12 and not 3 because we do the .xml(...) before the lte=3
+    def test_queryset_render_filtered_after_xml(self):
+        """Filters applied after xml() restrict the rendered rows."""
+        from models import XSLTTestModel
+        for i in range(1, 6):
+            XSLTTestModel(name="chain%s" % self.time, about="about", count=i).save()
+        qs = XSLTTestModel.objects.xml(count="count").filter(
+            name="chain%s" % self.time)
+        selected = qs.filter(count__gte=2).exclude(count=5).order_by("count")
+        assertXpaths(_qs_eval_helper(selected), [
+                'count(/xslttestmodels/xslttestmodel)=3',
+                '/xslttestmodels/xslttestmodel[1][@count="2"]',
+                ])
+        # Querysets further down the chain don't share the rendering
+        self.assert_(qs.__xml__() is not selected.__xml__())
+
+    def test_rendering_manager_use_values(self):
+        """The manager's use_values is kept through cloning."""
+        from models import XSLTTestModel
+        manager = xsltmanagers.RenderingManager(use_values=False)
+        manager.model = XSLTTestModel
+        qs = manager.filter(count__gte=0).xml()
+        self.failIf(qs.use_values)
+        self.failIf(qs.filter(count__lte=1000)._clone().use_values)
     
 
 
@@ -459,4 +629,1416 @@ class AVTTestCase(TestCase):
                 }
             )
 
+class ParserPoolTestCase(TestCase):
+    def setUp(self):
+        super(ParserPoolTestCase, self).setUp()
+        self.time = int(time.time() * 1000)
+
+    def test_shared_parsers(self):
+        tmpl = BLANK % """
+        <xsl:value-of select="xdjango:foo%d()"/>
+        """ % self.time
+        t1 = xslt.Transformer(tmpl)
+        t2 = xslt.Transformer(tmpl)
+        self.assert_(t1.parser is t2.parser)
+        self.assert_(t1.parser is xslt.stylesheet_parser())
+        self.assert_(xslt.xml_parser() is xslt.xml_parser())
+        self.assert_(xslt.xml_parser() is not xslt.xml_parser(huge_tree=True))
+
+    def test_init_hook_parsers(self):
+        """Init hooks get a parser of their own to add resolvers to."""
+        from lxml import etree
+        class Resolver(etree.Resolver):
+            def resolve(self, url, pubid, context):
+                return None
+        def hook(transformer):
+            transformer.parser.resolvers.add(Resolver())
+        xslt.add_init_hook(hook)
+        try:
+            tmpl = BLANK % """<xsl:value-of select="xdjango:foo%d()"/>""" % self.time
+            t1 = xslt.Transformer(tmpl)
+            t2 = xslt.Transformer(tmpl)
+        finally:
+            xslt.engine._transformer_init_hook_list.remove(hook)
+        self.assert_(t1.parser is not t2.parser)
+        self.assert_(t1.parser is not xslt.stylesheet_parser())
+        c = Context({'foo%d' % self.time: 'hooked'})
+        self.assertEquals(t1(context=c), 'hooked\n')
+        self.assert_(xslt.Transformer(tmpl).parser is xslt.stylesheet_parser())
+
+    def test_thread_parsers(self):
+        import threading
+        parsers = []
+        thread = threading.Thread(
+            target=lambda: parsers.append(xslt.stylesheet_parser()))
+        thread.start()
+        thread.join()
+        self.assert_(parsers[0] is not xslt.stylesheet_parser())
+
+    def test_include(self):
+        """Includes are resolved, and scanned, through the pooled parser."""
+        import tempfile
+        import shutil
+        from os.path import join
+        tmpdir = tempfile.mkdtemp()
+        try:
+            include = open(join(tmpdir, "include.xslt"), "w")
+            include.write(BLANK.replace(
+                    'match="/"', 'name="included"'
+                    ) % """<xsl:value-of select="xdjango:foo%d()"/>""" % self.time)
+            include.close()
+            main = open(join(tmpdir, "main.xslt"), "w")
+            main.write(BLANK % """
+            <xsl:call-template name="included"/>
+            </xsl:template>
+            <xsl:include href="include.xslt"/>
+            <xsl:template name="unused">""")
+            main.close()
+            t = xslt.TransformerFile(tmpdir, "main.xslt")
+            c = Context({'foo%d' % self.time: 'included value'})
+            self.assertEquals(t(context=c), 'included value\n')
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class InputTestCase(TestCase):
+    INPUT = "<items><item>one</item><item>two</item></items>"
+
+    def setUp(self):
+        super(InputTestCase, self).setUp()
+        self.transformer = xslt.Transformer(
+            BLANK % """<xsl:value-of select="count(//item)"/>""",
+            input_parser_options={"huge_tree": True, "remove_blank_text": True}
+            )
+
+    def test_string(self):
+        self.assertEquals(self.transformer(self.INPUT), "2\n")
+
+    def test_file(self):
+        from StringIO import StringIO
+        self.assertEquals(self.transformer(StringIO(self.INPUT)), "2\n")
+
+    def test_filename(self):
+        import tempfile
+        import os
+        fd, filename = tempfile.mkstemp(suffix=".xml")
+        try:
+            os.write(fd, self.INPUT)
+            os.close(fd)
+            self.assertEquals(self.transformer(xslt.FileInput(filename)), "2\n")
+            # A plain string is XML, never a filename
+            from lxml import etree
+            self.assertRaises(etree.XMLSyntaxError, self.transformer, filename)
+        finally:
+            os.remove(filename)
+
+    def test_input_parser(self):
+        parser = self.transformer.input_parser()
+        self.assert_(parser is xslt.xml_parser(
+                huge_tree=True, remove_blank_text=True))
+
+class InputCacheTestCase(TestCase):
+    INPUT = "<items><item>one</item><item>two</item></items>"
+
+    def setUp(self):
+        super(InputCacheTestCase, self).setUp()
+        from django.conf import settings
+        settings.XSLT_INPUT_CACHE_SIZE = 2
+        xslt.input_documents.clear()
+        self.transformer = xslt.Transformer(
+            BLANK % """<xsl:value-of select="count(//item)"/>""")
+
+    def tearDown(self):
+        from django.conf import settings
+        del settings.XSLT_INPUT_CACHE_SIZE
+        if hasattr(settings, "XSLT_INPUT_CACHE_VALIDATE"):
+            del settings.XSLT_INPUT_CACHE_VALIDATE
+        xslt.input_documents.clear()
+
+    def test_cached(self):
+        doc = self.transformer.input_document(self.INPUT)
+        self.assert_(doc is self.transformer.input_document(self.INPUT))
+        self.assertEquals(self.transformer(self.INPUT), "2\n")
+        self.assert_(doc is not self.transformer.input_document(unicode(self.INPUT)))
+        other = xslt.Transformer(BLANK % "", input_parser_options={"huge_tree": True})
+        self.assert_(doc is not other.input_document(self.INPUT))
+
+    def test_bounded(self):
+        doc = self.transformer.input_document(self.INPUT)
+        for i in range(2):
+            self.transformer.input_document("<other%d/>" % i)
+        self.assert_(doc is not self.transformer.input_document(self.INPUT))
+
+    def test_validate(self):
+        from django.conf import settings
+        settings.XSLT_INPUT_CACHE_VALIDATE = True
+        doc = self.transformer.input_document(self.INPUT)
+        self.assert_(doc is self.transformer.input_document(self.INPUT))
+        doc.append(doc.makeelement("item", {}))
+        self.assertEquals(self.transformer(self.INPUT), "2\n")
+        self.assert_(doc is not self.transformer.input_document(self.INPUT))
+
+
+from djangoxslt.xslt import loader
+from django.template import TemplateDoesNotExist
+
+class LoaderTestCase(TestCase):
+    def setUp(self):
+        super(LoaderTestCase, self).setUp()
+        import tempfile
+        from django.conf import settings
+        self.time = int(time.time() * 1000)
+        self.tmpdir = tempfile.mkdtemp()
+        self.write("page.xslt", "first")
+        settings.XSLT_TEMPLATE_DIRS = [self.tmpdir]
+        loader.reset()
+
+    def tearDown(self):
+        import shutil
+        from django.conf import settings
+        del settings.XSLT_TEMPLATE_DIRS
+        loader.reset()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        from os.path import join
+        fd = open(join(self.tmpdir, name), "w")
+        fd.write(BLANK % (
+                """%s <xsl:value-of select="xdjango:foo%d()"/>""" % (text, self.time)))
+        fd.close()
+
+    def test_get_template(self):
+        template = loader.get_template("page.xslt")
+        self.assert_(template is loader.get_template("page.xslt"))
+        self.assertEquals(
+            template.render({'foo%d' % self.time: 'value'}).strip(), 'first value')
+
+    def test_render_to_string(self):
+        self.assertEquals(
+            loader.render_to_string(
+                ["missing.xslt", "page.xslt"],
+                Context({'foo%d' % self.time: 'value'})).strip(),
+            'first value')
+
+    def test_does_not_exist(self):
+        self.assertRaises(
+            TemplateDoesNotExist, loader.get_template, "missing.xslt")
+
+    def test_index(self):
+        import os
+        from os.path import join
+        self.assertEquals(
+            loader.stylesheet_index.page("", "page", "%s%s.xslt"),
+            join(self.tmpdir, "page.xslt"))
+        os.mkdir(join(self.tmpdir, "emails"))
+        self.write("emails/welcome.xslt", "welcome")
+        loader.stylesheet_index.checked = 0
+        self.assertEquals(
+            loader.stylesheet_index.find("emails/welcome.xslt"),
+            join(self.tmpdir, "emails", "welcome.xslt"))
+        self.assertEquals(loader.stylesheet_index.find("missing.xslt"), None)
+
+    def test_check_mtime(self):
+        import os
+        from os.path import join
+        from django.conf import settings
+        settings.XSLT_TEMPLATE_CHECK_MTIME = True
+        try:
+            template = loader.get_template("page.xslt")
+            self.write("page.xslt", "second")
+            filename = join(self.tmpdir, "page.xslt")
+            mtime = os.stat(filename).st_mtime + 10
+            os.utime(filename, (mtime, mtime))
+            template = loader.get_template("page.xslt")
+            self.assertEquals(
+                template.render({'foo%d' % self.time: 'value'}).strip(), 'second value')
+        finally:
+            del settings.XSLT_TEMPLATE_CHECK_MTIME
+
+
+class ContextDocumentTestCase(TestCase):
+    def setUp(self):
+        super(ContextDocumentTestCase, self).setUp()
+        self.time = int(time.time() * 1000)
+
+    def test_querydirect(self):
+        t = xslt.Transformer(BLANK % """
+        <div><xsl:for-each select="document('querydirect:items%d')//simple">
+          <p><xsl:value-of select="@a"/></p>
+        </xsl:for-each></div>
+        """ % self.time)
+        items = xsltmanagers.xmlifyiter(
+            [{"a": 10}, {"a": 11}], "Simple", a="a")
+        res = t(context=Context({'items%d' % self.time: items}))
+        assertXpaths(res, ['//xhtml:p[1][.="10"]', '//xhtml:p[2][.="11"]'], namespaces=XHTML)
+
+    def test_querydirect_queryset(self):
+        from models import XSLTTestModel
+        XSLTTestModel(name="name%s" % self.time, about="about", count=3).save()
+        t = xslt.Transformer(BLANK % """
+        <p><xsl:value-of select="document('querydirect:models')//xslttestmodel/@count"/></p>
+        """)
+        res = t(context=Context({
+                    'models': XSLTTestModel.objects.filter(name="name%s" % self.time)
+                    }))
+        assertXpath(res, '//xhtml:p[.="3"]', namespaces=XHTML)
+
+    def test_django(self):
+        t = xslt.Transformer(BLANK % """
+        <div>
+          <p><xsl:value-of select="document('django:doc')/a/@href"/></p>
+          <p><xsl:value-of select="document('django:text')/value"/></p>
+          <p><xsl:value-of select="count(document('django:missing')/value)"/></p>
+        </div>
+        """)
+        res = t(context=Context({
+                    'doc': '<a href="/here">here</a>',
+                    'text': 'some text',
+                    }))
+        assertXpaths(res, ['//xhtml:p[1][.="/here"]', '//xhtml:p[2][.="some text"]', '//xhtml:p[3][.="1"]'], namespaces=XHTML)
+
+    def test_lazy(self):
+        """Context variables are only evaluated when document() asks."""
+        calls = []
+        class Lazy(object):
+            def __xml__(self):
+                calls.append(1)
+                return "<lazy/>"
+        t = xslt.Transformer(BLANK % """
+        <xsl:if test="false()">
+          <xsl:copy-of select="document('querydirect:lazy')"/>
+        </xsl:if>
+        <xsl:for-each select="document('django:list')//i">
+          <xsl:copy-of select="document('querydirect:lazy2')"/>
+        </xsl:for-each>
+        """)
+        res = t(context=Context({
+                    'lazy': Lazy(),
+                    'lazy2': Lazy(),
+                    'list': '<l><i/><i/><i/></l>',
+                    }))
+        self.assertEquals(len(calls), 1)
+
+
+class DocumentCacheTestCase(TestCase):
+    STYLESHEET = """<xsl:stylesheet version="1.0"
+                        xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+      <xsl:output omit-xml-declaration="yes"/>
+      <xsl:template match="/">
+        <r><xsl:for-each select="document('lookup.xml')//i">
+          <xsl:value-of select="document('lookup.xml')//i[@k=current()/@k]"/>
+        </xsl:for-each></r>
+      </xsl:template>
+    </xsl:stylesheet>"""
+
+    def setUp(self):
+        super(DocumentCacheTestCase, self).setUp()
+        import tempfile
+        from os.path import join
+        self.tmpdir = tempfile.mkdtemp()
+        for name, content in [
+            ("lookup.xml", """<l><i k="a">A</i><i k="b">B</i></l>"""),
+            ("page.xslt", self.STYLESHEET)]:
+            fd = open(join(self.tmpdir, name), "w")
+            fd.write(content)
+            fd.close()
+        self.reads = []
+        self.real_scan = xslt.DjangoResolver._scan
+        def scan(resolver, content):
+            self.reads.append(content)
+            return self.real_scan(resolver, content)
+        xslt.DjangoResolver._scan = scan
+        xslt.process_documents().clear()
+
+    def tearDown(self):
+        import shutil
+        from django.conf import settings
+        xslt.DjangoResolver._scan = self.real_scan
+        if hasattr(settings, "XSLT_DOCUMENT_CACHE"):
+            del settings.XSLT_DOCUMENT_CACHE
+        shutil.rmtree(self.tmpdir)
+
+    def render_twice(self):
+        t = xslt.TransformerFile(self.tmpdir, "page.xslt")
+        self.reads = []
+        self.assertEquals(t(), "<r>AB</r>\n")
+        self.assertEquals(t(), "<r>AB</r>\n")
+        return len(self.reads)
+
+    def test_no_cache(self):
+        from django.conf import settings
+        settings.XSLT_DOCUMENT_CACHE = None
+        self.assertEquals(self.render_twice(), 2)
+
+    def test_process_cache(self):
+        self.assertEquals(self.render_twice(), 1)
+        from django.conf import settings
+        settings.XSLT_DOCUMENT_CACHE = "render"
+        self.assertEquals(self.render_twice(), 0)
+
+    def test_parsed_once(self):
+        """Repeated document() calls don't read or parse the file again."""
+        resolved = []
+        real_resolve = xslt.DjangoResolver.resolve
+        def resolve(resolver, url, pubid, context):
+            resolved.append(url)
+            return real_resolve(resolver, url, pubid, context)
+        t = xslt.TransformerFile(self.tmpdir, "page.xslt")
+        xslt.DjangoResolver.resolve = resolve
+        try:
+            self.reads = []
+            self.assertEquals(t(), "<r>AB</r>\n")
+            self.assertEquals(t(), "<r>AB</r>\n")
+        finally:
+            xslt.DjangoResolver.resolve = real_resolve
+        # Asked for once a transform, read and scanned once
+        self.assertEquals(
+            [url.split("/")[-1] for url in resolved], ["lookup.xml", "lookup.xml"])
+        self.assertEquals(len(self.reads), 1)
+
+    def test_process_cache_mtime(self):
+        import os
+        from os.path import join
+        t = xslt.TransformerFile(self.tmpdir, "page.xslt")
+        self.assertEquals(t(), "<r>AB</r>\n")
+        lookup = join(self.tmpdir, "lookup.xml")
+        fd = open(lookup, "w")
+        fd.write("""<l><i k="a">C</i></l>""")
+        fd.close()
+        mtime = os.stat(lookup).st_mtime + 10
+        os.utime(lookup, (mtime, mtime))
+        self.assertEquals(t(), "<r>C</r>\n")
+
+
+class CompactTestCase(TestCase):
+    STYLESHEET = """<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0"
+                xmlns="http://www.w3.org/1999/xhtml"
+                xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+    <xsl:output method="xml" indent="yes" omit-xml-declaration="yes"/>
+    <xsl:template match="/">
+        <div>
+            <p>
+                Some   text
+                <b>bold</b>
+                more text
+            </p>
+            <pre>  keep
+   this  </pre>
+            <textarea>
+  and this</textarea>
+            <span><xsl:text>  and   this  </xsl:text></span>
+        </div>
+    </xsl:template>
+</xsl:stylesheet>
+"""
+
+    def test_compact(self):
+        plain = xslt.Transformer(self.STYLESHEET)()
+        compact = xslt.Transformer(self.STYLESHEET, compact=True)()
+        self.assert_(len(compact) < len(plain))
+        self.assertEquals(
+            compact,
+            '<div xmlns="http://www.w3.org/1999/xhtml">'
+            '<p> Some text <b>bold</b> more text </p>'
+            '<pre>  keep\n   this  </pre>'
+            '<textarea>\n  and this</textarea>'
+            '<span>  and   this  </span></div>'
+            )
+
+    def test_text_output(self):
+        """Text output, a plain text email say, isn't compacted."""
+        stylesheet = self.STYLESHEET.replace('method="xml"', 'method="text"')
+        self.assertEquals(
+            xslt.Transformer(stylesheet, compact=True)(),
+            xslt.Transformer(stylesheet)())
+        self.assert_("Some   text" in xslt.Transformer(stylesheet, compact=True)())
+
+    def test_html_output(self):
+        from lxml import etree
+        self.assert_(xslt.html_output(etree.XML(self.STYLESHEET)))
+        self.assert_(xslt.html_output(etree.XML(
+                    self.STYLESHEET.replace('method="xml"', 'method="html"'))))
+        self.assert_(not xslt.html_output(etree.XML(
+                    self.STYLESHEET.replace('xmlns="http://www.w3.org/1999/xhtml"', ""))))
+
+
+class BulkTestCase(TestCase):
+    def setUp(self):
+        self.transformer = xslt.Transformer(BLANK % """
+        <p><xsl:value-of select="xdjango:name()"/></p>
+        """)
+
+    def _names(self, outputs):
+        return [re.search("<p[^>]*>(.*)</p>", output).group(1) for output in outputs]
+
+    def test_render_many(self):
+        from djangoxslt.xslt import bulk
+        contexts = [{"name": "name%d" % i} for i in range(10)]
+        self.assertEquals(
+            self._names(bulk.render_many(self.transformer, contexts)),
+            ["name%d" % i for i in range(10)])
+
+    def test_render_many_workers(self):
+        from djangoxslt.xslt import bulk
+        contexts = [{"name": "name%d" % i} for i in range(50)]
+        self.assertEquals(
+            self._names(bulk.render_many(
+                    self.transformer, contexts, workers=3, window=4)),
+            ["name%d" % i for i in range(50)])
+
+    def test_window(self):
+        """Contexts aren't taken much faster than outputs are consumed."""
+        from djangoxslt.xslt import bulk
+        taken = []
+        def contexts():
+            for i in range(100):
+                taken.append(i)
+                yield {"name": "name%d" % i}
+        outputs = bulk.render_many(self.transformer, contexts(), workers=2, window=5)
+        outputs.next()
+        self.assert_(len(taken) <= 6)
+        self.assertEquals(len(list(outputs)), 99)
+
+    def test_hooks_called_once(self):
+        from djangoxslt.xslt import engine
+        calls = []
+        def hook(transformer, doc, context, **params):
+            calls.append(context)
+        engine._transformer_percall_hook_list.append(hook)
+        try:
+            template = xslt.Template(self.transformer)
+            outputs = list(template.render_many([{"name": "a"}, {"name": "b"}]))
+        finally:
+            engine._transformer_percall_hook_list.remove(hook)
+        self.assertEquals(self._names(outputs), ["a", "b"])
+        self.assertEquals(len(calls), 1)
+
+    def test_prefetch(self):
+        """Bulk renders prefetch the context like __call__."""
+        from djangoxslt.xslt import bulk
+        sink = metrics.AggregatingSink()
+        metrics.set_sink(sink)
+        try:
+            t = xslt.Transformer(BLANK % """
+            <xsl:copy-of select="xdjango:slow()"/>
+            """, name="bulkprefetch", prefetch=2)
+            renderers = [SlowRenderer("slow%d" % i) for i in range(3)]
+            outputs = list(bulk.render_many(t, [{"slow": r} for r in renderers]))
+        finally:
+            metrics.set_sink(None)
+        self.assertEquals([r.renders for r in renderers], [1, 1, 1])
+        self.assert_("<slow2" in outputs[2])
+        self.assertEquals(sink.get("prefetch.bulkprefetch").count, 3)
+
+class PrerenderTestCase(TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        from os.path import join
+        fd = open(join(self.tmpdir, name), "w")
+        fd.write(text)
+        fd.close()
+        return join(self.tmpdir, name)
+
+    def test_pages(self):
+        from djangoxslt.xslt import prerender
+        self.assertEquals(
+            [page for page, filename in prerender.pages("testtransform_")],
+            ["errorpage", "errorvalue", "simplepage"])
+        self.assertEquals(
+            [page for page, filename in prerender.pages("testtransform_", "%s-%s.xslt")],
+            [])
+
+    def test_pages_from_loader(self):
+        """Pages are the stylesheets views.page would find."""
+        from django.conf import settings
+        from djangoxslt.xslt import prerender
+        page = self.write("testtransform_other.xslt", BLANK % "other")
+        settings.XSLT_TEMPLATE_DIRS = [self.tmpdir]
+        loader.reset()
+        try:
+            self.assertEquals(prerender.pages("testtransform_"), [("other", page)])
+        finally:
+            del settings.XSLT_TEMPLATE_DIRS
+            loader.reset()
+
+    def test_dependency_hash(self):
+        from djangoxslt.xslt import prerender
+        page = self.write("page.xslt", BLANK.replace(
+                '<xsl:output', '<xsl:import href="common.xslt"/><xsl:output') % (
+                """<xsl:copy-of select="document('data.xml')"/>"""))
+        self.write("common.xslt", BLANK % "")
+        self.write("data.xml", "<data/>")
+        self.assertEquals(
+            [name.split("/")[-1] for name in prerender.dependencies(page)],
+            ["page.xslt", "common.xslt", "data.xml"])
+        first = prerender.dependency_hash(page)
+        self.assertEquals(first, prerender.dependency_hash(page))
+        self.write("data.xml", "<data>changed</data>")
+        self.assertNotEquals(first, prerender.dependency_hash(page))
+
+    def test_prerender(self):
+        import gzip
+        from os.path import join
+        from djangoxslt.xslt import prerender
+        results = prerender.prerender(self.tmpdir, "testtransform_", processes=1)
+        self.assertEquals(results["simplepage"], "rendered")
+        # The demo's error pages import a stylesheet that isn't there
+        self.assert_("IOError" in results["errorpage"])
+        html = open(join(self.tmpdir, "simplepage.html")).read()
+        self.assert_("This is a test page" in html)
+        self.assertEquals(
+            gzip.open(join(self.tmpdir, "simplepage.html.gz")).read(), html)
+
+        results = prerender.prerender(self.tmpdir, "testtransform_", processes=1)
+        self.assertEquals(results["simplepage"], "skipped")
+        self.assert_("IOError" in results["errorpage"])
+        results = prerender.prerender(
+            self.tmpdir, "testtransform_", processes=1, force=True)
+        self.assertEquals(results["simplepage"], "rendered")
+
+class LintTestCase(TestCase):
+    def lint(self, body):
+        from lxml import etree
+        from djangoxslt.xslt import lint
+        return lint.lint(etree.XML(BLANK % body), loop_size=10, queryset_rows=100)
+
+    def test_loop_calls(self):
+        report = self.lint("""
+        <p><xsl:value-of select="xdjango:title()"/></p>
+        <xsl:for-each select="xdjango:items('parse')//item">
+          <p><xsl:value-of select="xdjango:name()"/></p>
+          <xsl:for-each select="thing">
+            <xsl:copy-of select="xdjango:body('parsehtml')"/>
+          </xsl:for-each>
+        </xsl:for-each>
+        """)
+        self.assertEquals(
+            [(f.kind, f.message.split(")")[0]) for f in report.findings],
+            [("loop-call", "xdjango:name("), ("loop-parse", "xdjango:body('parsehtml'")])
+        # title and items once, name 10 times and body 100 times
+        self.assertEquals(report.callbacks, 112)
+
+    def test_recursive_and_queryset(self):
+        report = self.lint("""
+        <xdjango:queryset key="people" dest="person"/>
+        <xdjango:queryset key="few" dest="one" limit="5"/>
+        <xsl:call-template name="countdown"/>
+        </xsl:template>
+        <xsl:template match="xdjango:person">
+          <xsl:value-of select="xdjango:person.name()"/>
+        </xsl:template>
+        <xsl:template match="xdjango:one">
+          <xsl:call-template name="show"/>
+        </xsl:template>
+        <xsl:template name="show">
+          <xsl:value-of select="xdjango:one.name()"/>
+        </xsl:template>
+        <xsl:template name="countdown">
+          <xsl:value-of select="xdjango:tick()"/>
+          <xsl:call-template name="countdown"/>
+        """)
+        kinds = [f.kind for f in report.findings]
+        self.assertEquals(kinds.count("queryset-limit"), 1)
+        self.assertEquals(kinds.count("loop-call"), 3)
+        self.assertEquals(report.callbacks, 100 + 5 + 10)
+        self.assert_("recursive template countdown" in str(report.findings[-1]))
+
+    def test_queryset_limit(self):
+        transformer = xslt.Transformer(BLANK % """
+        <ul><xdjango:queryset key="items" dest="item" limit="2"/></ul>
+        </xsl:template>
+        <xsl:template match="xdjango:item">
+        <li><xsl:value-of select="xdjango:item()"/></li>
+        """)
+        res = transformer(context=Context({"items": ["a", "b", "c"]}))
+        assertXpaths(res, ["count(//xhtml:li)=2"], namespaces=XHTML)
+
+class HoistTestCase(TestCase):
+    LOOPS = BLANK % """
+    <xsl:variable name="doc" select="xdjango:items('parse')"/>
+    <xsl:for-each select="$doc//item">
+      <p class="{xdjango:cls()} {@id}" title="{xdjango:title('xml', 'span')}">
+        <xsl:if test="xdjango:flag() = 'yes'">
+          <xsl:value-of select="concat(xdjango:prefix(), .)"/>
+        </xsl:if>
+        <xsl:for-each select="sub">
+          <xsl:copy-of select="xdjango:rich('parse')//b"/>
+          <xsl:value-of select="xdjango:prefix()"/>
+        </xsl:for-each>
+      </p>
+    </xsl:for-each>
+    <ul><xdjango:queryset key="rows" dest="row"/></ul>
+    </xsl:template>
+    <xsl:template match="xdjango:row">
+      <xsl:for-each select="xdjango:items('parse')//item">
+        <li><xsl:value-of select="xdjango:row()"/><xsl:value-of select="xdjango:cls()"/></li>
+      </xsl:for-each>
+    """
+
+    def context(self):
+        return Context({
+                "items": "<items><item id='1'>a<sub/></item><item id='2'>b<sub/><sub/></item></items>",
+                "cls": "c", "title": "t", "flag": "yes", "prefix": "p-",
+                "rich": "<i><b>bold</b></i>",
+                "rows": ["r1", "r2"],
+                })
+
+    def render(self, tmpl, hoist):
+        sink = metrics.AggregatingSink()
+        metrics.set_sink(sink)
+        try:
+            t = xslt.Transformer(tmpl, hoist=hoist, name="hoist")
+            return t(context=self.context()), sink.get("callbacks.hoist").total
+        finally:
+            metrics.set_sink(None)
+
+    def test_equivalent_output(self):
+        plain, plain_calls = self.render(self.LOOPS, False)
+        hoisted, hoisted_calls = self.render(self.LOOPS, True)
+        self.assertEquals(hoisted, plain)
+        self.assert_(hoisted_calls < plain_calls)
+
+    def test_hoisted(self):
+        from lxml import etree
+        doc = etree.XML(self.LOOPS)
+        self.assertEquals(xslt.hoist_invariant_calls(doc), 6)
+        text = etree.tostring(doc)
+        # Node dependent and queryset row calls stay in the loops
+        self.assert_("{@id}" in text)
+        self.assert_('select="xdjango:row()"' in text)
+        self.assert_('select="concat($xdjango-hoisted-' in text)
+
+    def test_test_stylesheets(self):
+        """Hoisting doesn't change the output of the test stylesheets."""
+        from os.path import join
+        from django.conf import settings
+        for page in ("simplepage",):
+            filename = join(settings.TRANSFORMS, "testtransform_%s.xslt" % page)
+            self.assertEquals(
+                xslt.TransformerFile(filename, hoist=True)(context=self.context()),
+                xslt.TransformerFile(filename)(context=self.context()))
+        for body in (
+            """<xsl:for-each select="xdjango:items('parse')//item">
+                 <xsl:value-of select="xdjango:cls()"/></xsl:for-each>""",
+            """<xsl:copy-of select="xdjango:rich('parse')"/>""",
+            ):
+            self.assertEquals(
+                self.render(BLANK % body, True)[0], self.render(BLANK % body, False)[0])
+
+class FragmentTestCase(TestCase):
+    def setUp(self):
+        super(FragmentTestCase, self).setUp()
+        self.time = int(time.time() * 1000)
+        self.stylesheet = BLANK % ("""
+        <div><xsl:value-of select="xdjango:page%d()"/></div>
+        <xsl:call-template name="panel"/>
+        <xsl:apply-templates select="/" mode="side"/>
+        </xsl:template>
+        <xsl:template name="panel">
+        <xsl:param name="who" select="'nobody'"/>
+        <p><xsl:value-of select="xdjango:panel%d()"/> for <xsl:value-of select="$who"/></p>
+        </xsl:template>
+        <xsl:template match="/" mode="side">
+        <xsl:param name="side"/>
+        <aside><xsl:value-of select="$side"/></aside>
+        """ % (self.time, self.time))
+        self.context = Context({
+                "page%d" % self.time: "the page",
+                "panel%d" % self.time: "the panel",
+                })
+
+    def text(self, output):
+        return re.sub("<[^>]+>", " ", output).split()
+
+    def test_template(self):
+        t = xslt.Transformer(self.stylesheet, name="fragments")
+        self.assertEquals(
+            self.text(t(context=self.context)),
+            ["the", "page", "the", "panel", "for", "nobody"])
+        fragment = t.fragment("panel")
+        self.assert_(fragment is t.fragment("panel"))
+        self.assertEquals(fragment.fragment_params, ["who"])
+        self.assertEquals(fragment.name, "fragments_panel")
+        self.assertEquals(
+            self.text(fragment(context=self.context, who="'you'")),
+            ["the", "panel", "for", "you"])
+
+    def test_mode(self):
+        template = xslt.Template(xslt.Transformer(self.stylesheet))
+        self.assertEquals(
+            self.text(template.render_fragment(self.context, mode="side", params={"side": "'aside'"})),
+            ["aside"])
+        # Params named like the arguments
+        fragment = xslt.Template(xslt.Transformer(BLANK % """
+        <xsl:call-template name="named"/>
+        </xsl:template>
+        <xsl:template name="named">
+        <xsl:param name="mode"/><xsl:param name="doc"/>
+        <p><xsl:value-of select="$mode"/>, <xsl:value-of select="$doc"/></p>
+        """))
+        self.assertEquals(
+            self.text(fragment.render_fragment(
+                    self.context, "named", params={"mode": "'a'", "doc": "'b'"})),
+            ["a,", "b"])
+        self.assertRaises(ValueError, template.transformer.fragment)
+        self.assertRaises(ValueError, template.transformer.fragment, "panel", "side")
+
+    def test_missing(self):
+        t = xslt.Transformer(self.stylesheet)
+        self.assertRaises(TemplateDoesNotExist, t.fragment, "nosuch")
+        self.assertRaises(TemplateDoesNotExist, t.fragment, None, "nosuch")
+        self.assertEquals(len(t._fragments), 0)
+
+    def test_page(self):
+        import tempfile
+        import shutil
+        from os.path import join
+        from django.conf import settings
+        from djangoxslt.xslt import views
+        from djangoxslt.xslt import prerender
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fd = open(join(tmpdir, "fragment_page.xslt"), "w")
+            fd.write(self.stylesheet)
+            fd.close()
+            settings.XSLT_TEMPLATE_DIRS = [tmpdir]
+            loader.reset()
+            request = prerender.page_request("page")
+            request.GET = {"who": "you", "other": "ignored"}
+            kwargs = {
+                "page%d" % self.time: "the page",
+                "panel%d" % self.time: "the panel",
+                }
+            response = views.page(request, "page", "fragment_", fragment="panel", **kwargs)
+            self.assertEquals(self.text(response.content), ["the", "panel", "for", "you"])
+            response = views.page(request, "page", "fragment_", fragment="mode:side", **kwargs)
+            self.assertEquals(self.text(response.content), [])
+            from django.http import Http404
+            for fragment in ("nosuch", "mode:nosuch", "mode:"):
+                self.assertRaises(
+                    Http404, views.page, request, "page", "fragment_", fragment=fragment)
+            # Templates of included stylesheets are found
+            fd = open(join(tmpdir, "fragment_included.xslt"), "w")
+            fd.write(STYLESHEET % """<xsl:include href="fragment_page.xslt"/>""")
+            fd.close()
+            loader.reset()
+            response = views.page(request, "included", "fragment_", fragment="panel", **kwargs)
+            self.assertEquals(self.text(response.content), ["the", "panel", "for", "you"])
+        finally:
+            del settings.XSLT_TEMPLATE_DIRS
+            loader.reset()
+            shutil.rmtree(tmpdir)
+
+STYLESHEET = """<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0"
+                xmlns="http://www.w3.org/1999/xhtml"
+                xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+                xmlns:xdjango="http://djangoproject.com/template/xslt"
+                extension-element-prefixes="xdjango"
+                exclude-result-prefixes="xdjango">
+%s
+</xsl:stylesheet>
+"""
+
+class BundleTestCase(TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.write("common.xslt", """
+        <xsl:template match="/">
+          <div><xsl:apply-templates select="//item"/><xsl:call-template name="footer"/></div>
+        </xsl:template>
+        <xsl:template match="item" priority="5"><p>common item</p></xsl:template>
+        <xsl:template match="item[@special]" priority="10"><p>common special</p></xsl:template>
+        <xsl:template name="footer"><p>common footer</p></xsl:template>
+        <xsl:variable name="greeting" select="'common'"/>
+        """)
+        self.write("parts.xslt", """
+        <xsl:template name="footer"><p>footer <xsl:value-of select="$greeting"/></p></xsl:template>
+        """)
+        self.main = self.write("main.xslt", """
+        <xsl:import href="common.xslt"/>
+        <xsl:include href="parts.xslt"/>
+        <xsl:output omit-xml-declaration="yes"/>
+        <xsl:variable name="greeting" select="xdjango:greeting()"/>
+        <xsl:template match="item|*/item"><p>main <xsl:value-of select="."/></p></xsl:template>
+        """)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, body):
+        from os.path import join
+        fd = open(join(self.tmpdir, name), "w")
+        fd.write(STYLESHEET % body)
+        fd.close()
+        return join(self.tmpdir, name)
+
+    def render(self, bundled=False):
+        from djangoxslt.xslt import bundle
+        t = xslt.TransformerFile(bundle.bundle_path(self.main) if bundled else self.main)
+        return t("<items><item>a</item><item special='1'>b</item></items>",
+                 context=Context({"greeting": "hello"}))
+
+    def test_bundle(self):
+        from djangoxslt.xslt import bundle
+        plain = self.render()
+        manifest = bundle.bundle(self.main)
+        self.assertEquals(manifest["functions"], ["greeting"])
+        self.assertEquals(len(manifest["files"]), 3)
+        output = self.render(True)
+        self.assertEquals(output, plain)
+        # The importing stylesheet's rules and names win
+        assertXpaths(output, [
+                'count(//xhtml:p[starts-with(., "main")])=2',
+                '//xhtml:p[.="footer hello"]',
+                'not(//xhtml:p[starts-with(., "common")])',
+                ], namespaces=XHTML)
+
+    def test_stale(self):
+        import os
+        from djangoxslt.xslt import bundle
+        bundle.bundle(self.main)
+        common = os.path.join(self.tmpdir, "common.xslt")
+        mtime = os.stat(common).st_mtime
+        os.utime(common, (mtime + 10, mtime + 10))
+        self.assertEquals(bundle.fresh_manifest(self.main), None)
+
+    def test_unbundleable(self):
+        from os.path import join
+        from djangoxslt.xslt import bundle
+        self.write("common.xslt", """
+        <xsl:template match="item"><xsl:apply-imports/></xsl:template>
+        """)
+        self.assertRaises(bundle.BundleError, bundle.bundle, self.main)
+        # The xdjango prefix bound to another namespace
+        fd = open(join(self.tmpdir, "common.xslt"), "w")
+        fd.write(STYLESHEET.replace("http://djangoproject.com/template/xslt", "urn:other") % "")
+        fd.close()
+        self.assertRaises(bundle.BundleError, bundle.bundle, self.main)
+
+    def test_namespaces(self):
+        from os.path import join
+        from djangoxslt.xslt import bundle
+        # No default namespace and prefixes of its own
+        fd = open(join(self.tmpdir, "common.xslt"), "w")
+        fd.write("""<?xml version="1.0" encoding="utf-8"?>
+<xsl:stylesheet version="1.0"
+                xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+                xmlns:xdjango="http://djangoproject.com/template/xslt"
+                xmlns:foo="urn:foo"
+                xmlns:bar="urn:bar"
+                extension-element-prefixes="xdjango"
+                exclude-result-prefixes="xdjango">
+<xsl:template match="/">
+  <data><xsl:apply-templates select="//item"/><xsl:call-template name="footer"/></data>
+</xsl:template>
+<xsl:template name="footer"><foo:item bar:id="{count(//foo:x)}"/></xsl:template>
+</xsl:stylesheet>
+""")
+        fd.close()
+        self.write("parts.xslt", "")
+        plain = self.render()
+        self.assert_(plain.startswith('<data xmlns:'))
+        bundle.bundle(self.main)
+        output = self.render(True)
+        # The same but for the order of the namespace declarations
+        from lxml import etree
+        c14n = lambda xml: etree.tostring(etree.fromstring(xml), method="c14n")
+        self.assertEquals(c14n(output), c14n(plain))
+
+    def test_prefix_lists(self):
+        from djangoxslt.xslt import bundle
+        # Declares xdjango without excluding it
+        self.write("parts.xslt", "")
+        fd = open(self.main.replace("main", "common"), "w")
+        fd.write(STYLESHEET.replace(' exclude-result-prefixes="xdjango"', "") % "")
+        fd.close()
+        self.assertRaises(bundle.BundleError, bundle.bundle, self.main)
+
+    def test_output(self):
+        from djangoxslt.xslt import bundle
+        self.write("parts.xslt", """
+        <xsl:output indent="yes" cdata-section-elements="p"/>
+        """)
+        self.write("common.xslt", """
+        <xsl:template match="/"><div><p>common</p></div></xsl:template>
+        <xsl:output method="xml" omit-xml-declaration="no" cdata-section-elements="div"/>
+        """)
+        plain = self.render()
+        root, files = bundle.flatten(self.main)
+        outputs = root.findall("{http://www.w3.org/1999/XSL/Transform}output")
+        self.assertEquals(len(outputs), 1)
+        self.assertEquals(outputs[0].get("omit-xml-declaration"), "yes")
+        self.assertEquals(outputs[0].get("indent"), "yes")
+        self.assertEquals(outputs[0].get("method"), "xml")
+        self.assertEquals(outputs[0].get("cdata-section-elements"), "div p")
+        bundle.bundle(self.main)
+        self.assertEquals(self.render(True), plain)
+
+    def test_precedence(self):
+        from djangoxslt.xslt import bundle
+        for common, main in [
+            ('<xsl:strip-space elements="*"/>', '<xsl:preserve-space elements="item"/>'),
+            ('<xsl:attribute-set name="a"><xsl:attribute name="x">1</xsl:attribute></xsl:attribute-set>',
+             '<xsl:attribute-set name="a"><xsl:attribute name="x">2</xsl:attribute></xsl:attribute-set>'),
+            ]:
+            self.write("common.xslt", common)
+            self.write("parts.xslt", main)
+            self.assertRaises(bundle.BundleError, bundle.flatten, self.main)
+        # Only one precedence level, or keys which don't have one, are fine
+        self.write("common.xslt", """
+        <xsl:strip-space elements="*"/>
+        <xsl:key name="items" match="item" use="@special"/>
+        """)
+        self.write("parts.xslt", """
+        <xsl:key name="items" match="item" use="."/>
+        <xsl:template match="/"><div><xsl:apply-templates select="key('items', '1')"/></div></xsl:template>
+        """)
+        plain = self.render()
+        bundle.bundle(self.main)
+        self.assertEquals(self.render(True), plain)
+
+    def test_computed_document(self):
+        import os
+        from djangoxslt.xslt import bundle
+        self.write("parts.xslt", """
+        <xsl:template name="doc"><xsl:copy-of select="document(@href)"/></xsl:template>
+        """)
+        bundle.flatten(self.main)
+        os.mkdir(os.path.join(self.tmpdir, "lib"))
+        self.write("lib/parts.xslt", """
+        <xsl:template name="doc"><xsl:copy-of select="document(concat('a', '.xml'))"/></xsl:template>
+        """)
+        self.write("parts.xslt", '<xsl:include href="lib/parts.xslt"/>')
+        self.assertRaises(bundle.BundleError, bundle.flatten, self.main)
+
+    def test_default_priority(self):
+        from djangoxslt.xslt import bundle
+        self.assertEquals(
+            [bundle.default_priority(p) for p in (
+                        "item", "@id", "xhtml:*", "*", "text()", "/", "a/b", "item[1]")],
+            [0, 0, -0.25, -0.5, -0.5, 0.5, 0.5, 0.5])
+        self.assertEquals(
+            bundle._split_pattern("a|b[@x='|']|c"), ["a", "b[@x='|']", "c"])
+
+class ProfileTestCase(TestCase):
+    def setUp(self):
+        super(ProfileTestCase, self).setUp()
+        self.time = int(time.time() * 1000)
+        self.profiles = []
+        xslt.add_profile_hook(self.hook)
+
+    def hook(self, transformer, profile):
+        self.profiles.append(profile)
+
+    def tearDown(self):
+        xslt.engine._transformer_profile_hook_list.remove(self.hook)
+
+    def test_profile(self):
+        tmpl = BLANK % """
+        <xsl:call-template name="named"/>
+        </xsl:template>
+        <xsl:template name="named">
+        <xsl:value-of select="xdjango:foo%d()"/>
+        """ % self.time
+        t = xslt.Transformer(tmpl, profile=True)
+        c = Context({'foo%d' % self.time: 'hello world'})
+        self.assertEquals(t(context=c), 'hello world\n')
+
+        self.assertEquals(len(self.profiles), 1)
+        profile = self.profiles[0]
+        self.assert_(profile is xslt.last_profile())
+        self.assertEquals(
+            sorted((tmpl["name"], tmpl["match"], tmpl["calls"])
+                   for tmpl in profile.templates),
+            [("", "/", 1), ("named", "", 1)]
+            )
+        self.assertEquals(profile.functions['foo%d' % self.time][0], 1)
+        self.assert_("xdjango:foo%d calls=1" % self.time in profile.summary())
+
+    def test_not_profiled(self):
+        tmpl = BLANK % """
+        <xsl:value-of select="xdjango:foo%d()"/>
+        """ % self.time
+        t = xslt.Transformer(tmpl)
+        c = Context({'foo%d' % self.time: 'hello world'})
+        self.assertEquals(t(context=c), 'hello world\n')
+        self.assertEquals(self.profiles, [])
+
+
+import testhelp
+
+class TestHelpTestCase(TestCase):
+    DOC = """<doc><a href="/one">one</a><a href="/two">two</a></doc>"""
+
+    def test_caches(self):
+        testhelp.XMLCACHE.clear()
+        assertXpath(self.DOC, "//a[@href='/one']")
+        assertXpath(self.DOC, "//a[@href='/two']")
+        self.assertEquals(len(testhelp.XMLCACHE), 1)
+        assertXpath(self.DOC, "//a[@href='/one']", html=True)
+        self.assertEquals(len(testhelp.XMLCACHE), 2)
+        self.assert_(("//a[@href='/one']", ()) in testhelp.XPATHCACHE)
+
+    def test_bounded(self):
+        testhelp.XMLCACHE.clear()
+        for i in range(testhelp.XMLCACHE_SIZE + 10):
+            assertXpath("<doc%d/>" % i, "/*")
+        self.assertEquals(len(testhelp.XMLCACHE), testhelp.XMLCACHE_SIZE)
+
+    def test_assert_xpaths(self):
+        assertXpaths(self.DOC, ["//a[@href='/one']", "count(//a) = 2"])
+        try:
+            assertXpaths(self.DOC, [
+                    "//a[@href='/one']",
+                    ("//a[@href='/three']", "no three"),
+                    "//b",
+                    ])
+        except AssertionError, e:
+            self.assertEquals(
+                str(e),
+                "no three\n{//b} did not evaluate with the specified document")
+        else:
+            self.fail("assertXpaths didn't fail")
+
+
+from djangoxslt.xslt import metrics
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        super(MetricsTestCase, self).setUp()
+        self.time = int(time.time() * 1000)
+        self.sink = metrics.AggregatingSink()
+        metrics.set_sink(self.sink)
+
+    def tearDown(self):
+        metrics.set_sink(None)
+
+    def test_transform_metrics(self):
+        tmpl = BLANK % """
+        <ul><xdjango:queryset key="foo%d" dest="item"/></ul>
+        <xsl:value-of select="xdjango:bar%d()"/>
+        </xsl:template>
+        <xsl:template match="xdjango:item">
+        <li><xsl:value-of select="xdjango:item()"/></li>
+        """ % (self.time, self.time)
+        t = xslt.Transformer(tmpl, name="metrics test")
+        c = Context({
+                'foo%d' % self.time: ["a", "b", "c"],
+                'bar%d' % self.time: 'hello',
+                })
+        res = t(context=c)
+
+        self.assertEquals(self.sink.get("compile.metrics_test").count, 1)
+        self.assertEquals(self.sink.get("transform.metrics_test").count, 1)
+        self.assertEquals(self.sink.get("callbacks.metrics_test").total, 4)
+        self.assertEquals(self.sink.get("queryset_rows.metrics_test").total, 3)
+        self.assertEquals(
+            self.sink.get("output_bytes.metrics_test").total, len(res))
+
+    def test_param_names(self):
+        """Stylesheet params can be named like the internal arguments."""
+        t = xslt.Transformer(BLANK % """
+        <p><xsl:value-of select="$sink"/>, <xsl:value-of select="$serialize"/></p>
+        </xsl:template>
+        <xsl:param name="sink"/>
+        <xsl:param name="serialize"/>
+        <xsl:template match="/nothing">
+        """, name="params")
+        for profile in (False, True):
+            t.profile = profile
+            res = t(sink="'a'", serialize="'b'")
+            self.assert_(re.search("<p[^>]*>a, b</p>", res), res)
+        self.assertEquals(self.sink.get("transform.params").count, 2)
+
+    def test_statsd(self):
+        import socket
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        try:
+            sink = metrics.StatsdSink(
+                "127.0.0.1", server.getsockname()[1], prefix="test")
+            sink.timing("transform.page", 0.25)
+            sink.histogram("output_bytes.page", 1024)
+            sink.incr("errors.page")
+            self.assertEquals(
+                [server.recv(512) for i in range(3)],
+                ["test.transform.page:250.000|ms",
+                 "test.output_bytes.page:1024|h",
+                 "test.errors.page:1|c"]
+                )
+        finally:
+            server.close()
+
+
+class DeadlineTestCase(TestCase):
+    def setUp(self):
+        super(DeadlineTestCase, self).setUp()
+        self.time = int(time.time() * 1000)
+        self.deadlines = []
+        xslt.add_degraded_hook(self.hook)
+        self.sink = metrics.AggregatingSink()
+        metrics.set_sink(self.sink)
+
+    def hook(self, transformer, deadline):
+        self.deadlines.append(deadline)
+
+    def tearDown(self):
+        xslt.engine._transformer_degraded_hook_list.remove(self.hook)
+        metrics.set_sink(None)
+        from django.conf import settings
+        for name in ("XSLT_RENDER_FALLBACK", "XSLT_RENDER_STALE",
+                     "XSLT_RENDER_STALE_SIZE"):
+            if hasattr(settings, name):
+                delattr(settings, name)
+
+    def transformer(self):
+        return xslt.Transformer(BLANK % """
+        <p><xsl:value-of select="xdjango:slow%d.value()"/></p>
+        <p><xsl:value-of select="xdjango:other%d()"/></p>
+        """ % (self.time, self.time), name="deadline", budget=0.01)
+
+    def context(self, other="other"):
+        class Slow(object):
+            @property
+            def value(self):
+                time.sleep(0.03)
+                return "slow"
+        return Context({"slow%d" % self.time: Slow(), "other%d" % self.time: other})
+
+    def test_within_budget(self):
+        t = xslt.Transformer(BLANK % """
+        <p><xsl:value-of select="xdjango:other%d()"/></p>
+        """ % self.time, budget=10)
+        self.assert_("<p>other</p>" in re.sub("<p[^>]*>", "<p>", t(context=self.context())))
+        self.assertEquals(self.deadlines, [])
+        self.assertEquals(self.sink.get("degraded.string"), None)
+
+    def test_fallback(self):
+        from django.conf import settings
+        settings.XSLT_RENDER_FALLBACK = {"other%d" % self.time: "later"}
+        res = re.sub("<p[^>]*>", "<p>", self.transformer()(context=self.context()))
+        self.assert_("<p>slow</p>" in res)
+        self.assert_("<p>later</p>" in res)
+        self.assertEquals(len(self.deadlines), 1)
+        self.assertEquals(self.deadlines[0].skipped, ["other%d" % self.time])
+        self.assertEquals(self.sink.get("degraded.deadline").total, 1)
+        self.assertEquals(self.sink.get("degraded_calls.deadline").total, 1)
+
+    def test_stale(self):
+        from django.conf import settings
+        settings.XSLT_RENDER_STALE = ["other%d" % self.time]
+        t = xslt.Transformer(BLANK % """
+        <p><xsl:value-of select="xdjango:other%d()"/></p>
+        """ % self.time)
+        t(context=self.context("first"))
+        res = re.sub("<p[^>]*>", "<p>", self.transformer()(context=self.context("second")))
+        self.assert_("<p>first</p>" in res)
+        self.assertEquals(self.deadlines[0].stale, ["other%d" % self.time])
+        self.assertEquals(self.deadlines[0].skipped, [])
+
+    def test_stale_values(self):
+        from django.conf import settings
+        from lxml import etree
+        class Renderer(object):
+            def __xml__(self, arg):
+                return [etree.Element("value", arg=arg)]
+        settings.XSLT_RENDER_STALE = ["other%d" % self.time]
+        settings.XSLT_RENDER_STALE_SIZE = 2
+        func = xslt.engine.DjangoContextFunc(
+            "other%d" % self.time, Context({"other%d" % self.time: Renderer()}))
+        arg = etree.fromstring("<a>1</a>").xpath("string()")
+        rendered = func(None, arg)
+        func(None, "2")
+        func(None, "3")
+        # Only the last two
+        self.assertEquals(len(func._stale), 2)
+        self.assertEquals(func._degraded(xslt.RenderDeadline(0), ("1",)), "")
+        # A new element every time, parsed from the stored XML
+        first = func._degraded(xslt.RenderDeadline(0), ("3",))
+        second = func._degraded(xslt.RenderDeadline(0), ("3",))
+        self.assertEquals(first[0].get("arg"), "3")
+        self.failIf(first[0] is second[0])
+        self.failIf(first[0] is rendered[0])
+
+
+from djangoxslt.xslt import prefetch
+from lxml import etree
+
+class SlowRenderer(object):
+    def __init__(self, name):
+        self.name = name
+        self.renders = 0
+
+    def __xml__(self, *args):
+        time.sleep(0.05)
+        self.renders += 1
+        return etree.Element(self.name)
+
+class PrefetchTestCase(TestCase):
+    def setUp(self):
+        super(PrefetchTestCase, self).setUp()
+        self.time = int(time.time() * 1000)
+
+    def test_references(self):
+        t = xslt.Transformer(BLANK % """
+        <xsl:copy-of select="xdjango:people%d()"/>
+        <xsl:value-of select="xdjango:people%d.count()"/>
+        <xdjango:queryset key="rows%d" dest="row" limit="2"/>
+        """ % (self.time, self.time, self.time), prefetch=2)
+        self.assertEquals(t.prefetch_references, {
+                "people%d" % self.time: (prefetch.CALL, None),
+                "rows%d" % self.time: (prefetch.QUERYSET, 2),
+                })
+
+    def test_concurrent(self):
+        import threading
+        lock = threading.Lock()
+        started = []
+        everyone = threading.Event()
+        class Meeting(object):
+            """Renders once all the renderers are rendering at once."""
+            def __init__(self, name):
+                self.name = name
+                self.met = False
+            def __xml__(self, *args):
+                lock.acquire()
+                try:
+                    started.append(self.name)
+                    if len(started) == 4:
+                        everyone.set()
+                finally:
+                    lock.release()
+                self.met = everyone.wait(5)
+                return etree.Element(self.name)
+        renderers = [Meeting("r%d" % i) for i in range(4)]
+        c = Context(dict((r.name, r) for r in renderers))
+        refs = dict((r.name, (prefetch.CALL, None)) for r in renderers)
+        values = prefetch.prefetch(c, refs, 4, threads=True)
+        self.assertEquals([r.met for r in renderers], [True] * 4)
+        self.assertEquals(
+            sorted((name, value.__xml__().tag) for name, value in values.items()),
+            [("r%d" % i, "r%d" % i) for i in range(4)])
+
+    def test_evaluate(self):
+        calls = []
+        def people():
+            calls.append("people")
+            return "people"
+        c = Context({"people": people, "renderer": SlowRenderer("slow")})
+        self.assertEquals(prefetch.evaluate(c, "people", prefetch.CALL), None)
+        self.assertEquals(prefetch.evaluate(c, "missing", prefetch.CALL), None)
+        self.assertEquals(calls, [])
+        self.assertEquals(prefetch.evaluate(c, "renderer", prefetch.CALL).__xml__().tag, "slow")
+
+    def test_transform(self):
+        from models import XSLTTestModel
+        name = "prefetch%d" % self.time
+        for i in range(3):
+            XSLTTestModel(name=name, about="about", count=i).save()
+        renderer = SlowRenderer("slow")
+        c = Context({
+                "rows%d" % self.time: XSLTTestModel.objects.filter(name=name).order_by("count"),
+                "slow%d" % self.time: renderer,
+                })
+        t = xslt.Transformer(BLANK % """
+        <ul><xdjango:queryset key="rows%d" dest="row" limit="2"/></ul>
+        <xsl:copy-of select="xdjango:slow%d()"/>
+        </xsl:template>
+        <xsl:template match="xdjango:row">
+        <li><xsl:value-of select="xdjango:row.count()"/></li>
+        """ % (self.time, self.time), prefetch=2)
+        res = t(context=c)
+        self.assertEquals(re.findall(r"<li[^>]*>(\d)</li>", res), ["0", "1"])
+        self.assert_("<slow" in res)
+        self.assertEquals(renderer.renders, 1)
+        # The prefetched values are popped
+        self.assertEquals(len(c.dicts), 1)
+
+from djangoxslt.xslt.pipeline import Pipeline
+
+class PipelineTestCase(TestCase):
+    CONTENT = BLANK.replace('xmlns="http://www.w3.org/1999/xhtml"', "") % """
+        <content><xsl:value-of select="xdjango:title%d()"/></content>
+        """
+    LAYOUT = BLANK % """
+        <html><body><h1><xsl:value-of select="/content"/></h1></body></html>
+        """
+
+    def setUp(self):
+        super(PipelineTestCase, self).setUp()
+        self.time = int(time.time() * 1000)
+        self.content = xslt.Transformer(self.CONTENT % self.time, name="content")
+        self.layout = xslt.Transformer(self.LAYOUT, name="layout")
+        self.context = Context({"title%d" % self.time: "a title"})
+
+    def test_pipeline(self):
+        pipeline = Pipeline(self.content, xslt.Template(self.layout))
+        self.assertEquals(pipeline.name, "content-layout")
+        result = pipeline.run(context=self.context)
+        self.assertEquals([name for name, seconds in result.timings], ["content", "layout"])
+        self.assert_(result.total >= 0)
+        # The same as serializing and parsing between the stages
+        self.assertEquals(
+            str(result), self.layout(self.content(context=self.context), context=self.context))
+        assertXpath(str(result), "//xhtml:h1[text()='a title']", namespaces=XHTML)
+
+    def test_error(self):
+        failing = xslt.Transformer(BLANK % """
+        <xsl:message terminate="yes">no content</xsl:message>
+        """, name="failing")
+        pipeline = Pipeline(failing, self.layout)
+        from django.conf import settings
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            result = pipeline.run(context=self.context)
+        finally:
+            settings.DEBUG = debug
+        # The error document, not transformed by the layout
+        self.assertEquals([name for name, seconds in result.timings], ["failing"])
+        self.assert_("<h1>an error occurred</h1>" in str(result))
+        self.assert_("no content" in str(result))
+
+    def test_tree(self):
+        tree = self.content.tree(context=self.context)
+        self.assertEquals(tree.getroot().tag, "content")
+        self.assertRaises(ValueError, Pipeline)
+
+from djangoxslt.xslt import benchmarks
+
+class BenchmarkTest(TestCase):
+    def test_measure(self):
+        result = benchmarks.measure(lambda: None, repeat=3, min_time=0.001)
+        self.assertEquals(result["repeat"], 3)
+        self.assert_(result["min"] <= result["median"])
+
+    def test_compare(self):
+        baseline = {"results": {
+                "fast": {"median": 1.0},
+                "slow": {"median": 1.0},
+                "gone": {"median": 1.0},
+                }}
+        results = {"results": {
+                "fast": {"median": 0.5},
+                "slow": {"median": 1.5},
+                "new": {"median": 1.0},
+                }}
+        comparison = benchmarks.compare(results, baseline, threshold=0.1)
+        self.assertEquals(
+            [(name, regressed) for name, b, c, r, regressed in comparison],
+            [("fast", False), ("slow", True)]
+            )
+
 # End
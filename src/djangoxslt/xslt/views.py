@@ -1,18 +1,21 @@
 from django.http import HttpResponse
+from django.http import Http404
+from django.template import TemplateDoesNotExist
 from django.template import RequestContext
 from django.conf import settings
-from os.path import join
 
+from lxml import etree
 import logging
 
-from engine import TransformerFile
 from engine import EMPTYDOC
+from engine import last_profile
+from loader import get_template
 from django.conf import settings
 
 DEFAULT_PAGE_NAMESPACE=""        # WooMe's page namespace is "woome"
 DEFAULT_PAGE_PATTERN="%s%s.xslt" # WooMe's page pattern is "%s_%s.xslt"
 
-def page(request, page="index", namespace=DEFAULT_PAGE_NAMESPACE, **kwargs):
+def page(request, page="index", namespace=DEFAULT_PAGE_NAMESPACE, fragment=None, **kwargs):
     """A generic XSLT view which just runs a page name derived XSLT file.
 
     Pass in a page to be rendered (this could come from a urls
@@ -32,16 +35,52 @@ def page(request, page="index", namespace=DEFAULT_PAGE_NAMESPACE, **kwargs):
     example would require the following declared in settings.py:
 
        XSLT_PAGE_PATTERN="%s_%s.xslt"
+
+    The XSLT is loaded with the template loader so it is only compiled
+    once; see the loader module for where templates are looked for.
+    Pages which don't have an XSLT, or the fragment asked for, are 404s.
+
+    A 'fragment' renders just part of the page, for endpoints which
+    update one panel: the name of an xsl:template, or "mode:NAME" for
+    the templates of a mode (see Transformer.fragment). The fragment's
+    params are taken from the query string:
+
+      url(r'^panel/$', 'djangoxslt.xslt.views.page',
+          {"page": "main", "fragment": "panel"}),
+
+    If the transform is profiled (see settings.XSLT_PROFILE) and DEBUG
+    is on, a summary of the profile is sent in the X-XSLT-Profile
+    response header.
     """
     logger = logging.getLogger("xslt.views.page")
     logger.info("page = %s namespace = %s" % (page, namespace))
     page_pattern = getattr(settings, "XSLT_PAGE_PATTERN", DEFAULT_PAGE_PATTERN)
     p = page_pattern % (namespace, page)
-    t = TransformerFile(join(settings.TRANSFORMS, p))
+    try:
+        t = get_template(p)
+    except TemplateDoesNotExist:
+        raise Http404("no XSLT for page %s" % page)
     c = RequestContext(request, {})
     c.update(kwargs)
-    out = t(EMPTYDOC, context=c)
-    return HttpResponse(out)
+    if fragment:
+        if fragment.startswith("mode:"):
+            template, mode = None, fragment[len("mode:"):]
+        else:
+            template, mode = fragment, None
+        try:
+            transformer = t.transformer.fragment(template, mode)
+        except (TemplateDoesNotExist, ValueError):
+            raise Http404("no fragment %s of page %s" % (fragment, page))
+        params = dict((name, etree.XSLT.strparam(request.GET[name]))
+                      for name in transformer.fragment_params
+                      if name in request.GET)
+        out = transformer(EMPTYDOC, context=c, **params)
+    else:
+        out = t.render(c, EMPTYDOC)
+    response = HttpResponse(out)
+    if settings.DEBUG and t.transformer.profile and last_profile():
+        response["X-XSLT-Profile"] = last_profile().summary()
+    return response
 
 
 # End